@@ -0,0 +1,520 @@
+"""
+Benchmarks for the MBZ helpers in mbz_utils
+
+Usage:
+    python benchmark.py compress [--size-mb 200] [--workers N] [--level 6]
+    python benchmark.py codecs [--size-mb 1024] [--workers N] [--level 6]
+    python benchmark.py suite [--blobs 100 --blob-kb 512 ...] [-o results.json] [--baseline old.json]
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import argparse
+import platform
+import tempfile
+import tarfile
+import subprocess
+from xml.sax.saxutils import escape
+
+import mbz_utils
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows: peak memory is then not reported
+    resource = None
+
+
+# Operations timed by the suite, in the order they run (each needs the output of the previous ones)
+SUITE_OPERATIONS = ("create", "analyze", "extract", "list_xml_files")
+
+# Activity types used by the synthetic course generator
+MODULE_NAMES = ("quiz", "forum", "assign", "page", "resource", "url", "label")
+
+
+def generate_tree(root, size_mb, seed=0):
+    """
+    Generate a Moodle-like backup folder with XML files and files/ blobs
+
+    Roughly a tenth of the data goes into small, highly compressible XML files
+    and the rest into binary blobs that compress about as well as typical
+    course media (PDFs, office documents).
+
+    Args:
+        root (str): Folder to create
+        size_mb (int): Approximate total size of the generated files in MB
+        seed (int): Seed for the random generator, for repeatable trees
+
+    Returns:
+        int: Total number of bytes written
+    """
+    rng = random.Random(seed)
+    total = 0
+    target = size_mb * 1024 * 1024
+    words = [b"quiz", b"forum", b"section", b"course", b"question", b"answer",
+             b"feedback", b"grade", b"visible", b"timemodified"]
+
+    xml_target = target // 10
+    index = 0
+    while total < xml_target:
+        activity_dir = os.path.join(root, "activities", f"quiz_{index}")
+        os.makedirs(activity_dir, exist_ok=True)
+        body = b"".join(b"<%s>%d</%s>\n" % (rng.choice(words), rng.randrange(10 ** 6), rng.choice(words))
+                        for _ in range(rng.randint(50, 500)))
+        data = b'<?xml version="1.0" encoding="UTF-8"?>\n<activity>\n' + body + b"</activity>\n"
+        with open(os.path.join(activity_dir, "quiz.xml"), "wb") as f:
+            f.write(data)
+        total += len(data)
+        index += 1
+
+    blob_index = 0
+    while total < target:
+        size = min(rng.randint(64 * 1024, 4 * 1024 * 1024), target - total)
+        # Half random, half repeated text: compresses to roughly 55%
+        data = bytearray(os.urandom(size // 2))
+        data += (b"Moodle course material " * (size // 46 + 1))[:size - len(data)]
+        name = f"{blob_index:040x}"
+        blob_dir = os.path.join(root, "files", name[:2])
+        os.makedirs(blob_dir, exist_ok=True)
+        with open(os.path.join(blob_dir, name), "wb") as f:
+            f.write(data)
+        total += size
+        blob_index += 1
+
+    with open(os.path.join(root, "moodle_backup.xml"), "wb") as f:
+        f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<moodle_backup></moodle_backup>\n')
+
+    return total
+
+
+def _xml_padding(rng, size):
+    """Return repetitive XML elements adding up to about size bytes, like Moodle's verbose exports"""
+    words = ("intro", "visible", "timemodified", "grade", "feedback", "sortorder", "availability")
+    parts = []
+    total = 0
+    while total < size:
+        word = rng.choice(words)
+        part = f"    <{word}>{rng.randrange(10 ** 9)}</{word}>\n"
+        parts.append(part)
+        total += len(part)
+    return "".join(parts)
+
+
+def generate_course(root, sections=10, activities=50, xml_kb=20, blobs=100, blob_kb=512, seed=0):
+    """
+    Generate a synthetic Moodle backup folder
+
+    The folder has the layout of a real course backup: moodle_backup.xml
+    listing the activities, sections and course, one folder per activity with
+    module.xml and <module>.xml, section.xml files, course/course.xml, and a
+    files/ pool named after the SHA-1 of each blob and described in files.xml.
+    It passes mbz_utils.validate_mbz().
+
+    Args:
+        root (str): Folder to create
+        sections (int): Number of course sections
+        activities (int): Number of activities, spread over the sections
+        xml_kb (int): Approximate size of each activity's main XML file in KB
+        blobs (int): Number of files in the files/ pool
+        blob_kb (int): Average blob size in KB (sizes vary from half to one and a half times this)
+        seed (int): Seed for the random generator, for repeatable courses
+
+    Returns:
+        dict: "bytes" and "files" written
+    """
+    rng = random.Random(seed)
+    written = {"bytes": 0, "files": 0}
+
+    def write(name, data):
+        path = os.path.join(root, *name.split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with open(path, "wb") as f:
+            f.write(data)
+        written["bytes"] += len(data)
+        written["files"] += 1
+
+    header = '<?xml version="1.0" encoding="UTF-8"?>\n'
+    contents = []
+
+    for section in range(sections):
+        directory = f"sections/section_{section + 1}"
+        write(f"{directory}/section.xml",
+              f'{header}<section id="{section + 1}">\n  <number>{section}</number>\n'
+              f"  <name>Section {section}</name>\n{_xml_padding(rng, 1024)}</section>\n")
+        contents.append(f"      <section>\n        <sectionid>{section + 1}</sectionid>\n"
+                        f"        <title>Section {section}</title>\n"
+                        f"        <directory>{directory}</directory>\n      </section>\n")
+
+    activity_contents = []
+    for activity in range(activities):
+        module = MODULE_NAMES[activity % len(MODULE_NAMES)]
+        directory = f"activities/{module}_{activity + 1}"
+        section = activity % sections + 1 if sections else 0
+        write(f"{directory}/module.xml",
+              f'{header}<module id="{activity + 1}" version="2024100700">\n  <modulename>{module}</modulename>\n'
+              f"  <sectionid>{section}</sectionid>\n{_xml_padding(rng, 512)}</module>\n")
+        write(f"{directory}/{module}.xml",
+              f'{header}<activity id="{activity + 1}" modulename="{module}">\n  <{module} id="{activity + 1}">\n'
+              f"{_xml_padding(rng, xml_kb * 1024)}  </{module}>\n</activity>\n")
+        activity_contents.append(f"      <activity>\n        <moduleid>{activity + 1}</moduleid>\n"
+                                 f"        <sectionid>{section}</sectionid>\n"
+                                 f"        <modulename>{module}</modulename>\n"
+                                 f"        <title>{escape(module.title())} {activity + 1}</title>\n"
+                                 f"        <directory>{directory}</directory>\n      </activity>\n")
+
+    write("course/course.xml", f'{header}<course id="1">\n  <fullname>Benchmark course</fullname>\n'
+                               f"{_xml_padding(rng, 4096)}</course>\n")
+
+    file_records = []
+    for blob in range(blobs):
+        size = rng.randint(blob_kb * 512, blob_kb * 1536) if blob_kb else 0
+        # Half random, half repeated text: compresses to roughly 55%, like PDFs and office documents
+        data = bytearray(rng.getrandbits(8 * (size // 2)).to_bytes(size // 2, "little"))
+        data += (b"Moodle course material " * (size // 46 + 1))[:size - len(data)]
+        digest = hashlib.sha1(data).hexdigest()
+        write(f"files/{digest[:2]}/{digest}", bytes(data))
+        file_records.append(f'  <file id="{blob + 1}">\n    <contenthash>{digest}</contenthash>\n'
+                            f"    <component>mod_resource</component>\n    <filearea>content</filearea>\n"
+                            f"    <filepath>/</filepath>\n    <filename>document_{blob + 1}.pdf</filename>\n"
+                            f"    <filesize>{len(data)}</filesize>\n  </file>\n")
+    write("files.xml", f"{header}<files>\n{''.join(file_records)}</files>\n")
+
+    write("moodle_backup.xml",
+          f"{header}<moodle_backup>\n  <information>\n    <name>benchmark.mbz</name>\n    <contents>\n"
+          f"      <activities>\n{''.join(activity_contents)}      </activities>\n"
+          f"      <sections>\n{''.join(contents)}      </sections>\n"
+          f"      <course>\n        <courseid>1</courseid>\n        <title>Benchmark course</title>\n"
+          f"        <directory>course</directory>\n      </course>\n"
+          f"    </contents>\n  </information>\n</moodle_backup>\n")
+
+    return written
+
+
+def _time_call(func, *args, **kwargs):
+    """Run func and return (seconds, result)"""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def bench_compress(args):
+    """Compare single-threaded and parallel create_mbz on a generated tree"""
+    workdir = tempfile.mkdtemp(prefix="mbz_bench_")
+    try:
+        source = os.path.join(workdir, "course")
+        data_size = generate_tree(source, args.size_mb)
+        print(f"Generated {data_size / 1024 / 1024:.1f} MB in {source}")
+
+        parallel_workers = args.workers or os.cpu_count() or 1
+        runs = [("single-threaded", 1), (f"parallel ({parallel_workers} workers)", parallel_workers)]
+        baseline = None
+
+        print(f"{'engine':<28} {'time':>9} {'MB/s':>9} {'ratio':>7} {'speedup':>8}")
+        for label, workers in runs:
+            output = os.path.join(workdir, f"course_{workers}.mbz")
+            best = None
+            for _ in range(args.repeat):
+                seconds, (success, message) = _time_call(
+                    mbz_utils.create_mbz, source, output, workers=workers, compresslevel=args.level)
+                if not success:
+                    print(f"{label}: {message}")
+                    return 1
+                best = seconds if best is None else min(best, seconds)
+
+            # Make sure the archive reads back as a single tar stream
+            with tarfile.open(output, "r:gz") as tar:
+                tar.getmembers()
+
+            if baseline is None:
+                baseline = best
+            ratio = os.path.getsize(output) / data_size
+            print(f"{label:<28} {best:>8.2f}s {data_size / 1024 / 1024 / best:>9.1f} "
+                  f"{ratio:>7.3f} {baseline / best:>7.2f}x")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+def _inflate(path, codec):
+    """Decompress a whole archive with a codec, discarding the output"""
+    with open(path, "rb") as raw:
+        reader = codec.open_reader(raw)
+        try:
+            while reader.read(mbz_utils.STREAM_BUFSIZE):
+                pass
+        finally:
+            reader.close()
+
+
+def bench_codecs(args):
+    """Compare the gzip backends available on this machine"""
+    workdir = tempfile.mkdtemp(prefix="mbz_bench_")
+    try:
+        source = os.path.join(workdir, "course")
+        data_size = generate_tree(source, args.size_mb)
+        print(f"Generated {data_size / 1024 / 1024:.1f} MB in {source}")
+
+        # A single gzip stream, like the backups Moodle writes
+        archive = os.path.join(workdir, "course.mbz")
+        mbz_utils.set_codec("zlib")
+        success, message = mbz_utils.create_mbz(source, archive, workers=1, compresslevel=args.level)
+        if not success:
+            print(message)
+            return 1
+        archive_size = os.path.getsize(archive)
+
+        workers = args.workers or os.cpu_count() or 1
+        print(f"Decompressing {archive_size / 1024 / 1024:.1f} MB, compressing with {workers} workers")
+        print(f"{'codec':<10} {'inflate':>9} {'MB/s':>9} {'speedup':>8} {'deflate':>9} {'MB/s':>9} "
+              f"{'ratio':>7} {'speedup':>8}")
+        baseline = None
+        for name in ["zlib"] + [name for name in mbz_utils.available_codecs() if name != "zlib"]:
+            mbz_utils.set_codec(name)
+            codec = mbz_utils.get_codec()
+
+            inflate = min(_time_call(_inflate, archive, codec)[0] for _ in range(args.repeat))
+            output = os.path.join(workdir, f"course_{name}.mbz")
+            deflate = None
+            for _ in range(args.repeat):
+                seconds, (success, message) = _time_call(
+                    mbz_utils.create_mbz, source, output, workers=workers, compresslevel=args.level)
+                if not success:
+                    print(f"{name}: {message}")
+                    return 1
+                deflate = seconds if deflate is None else min(deflate, seconds)
+
+            if baseline is None:
+                baseline = (inflate, deflate)
+            ratio = os.path.getsize(output) / data_size
+            print(f"{name:<10} {inflate:>8.2f}s {data_size / 1024 / 1024 / inflate:>9.1f} "
+                  f"{baseline[0] / inflate:>7.2f}x {deflate:>8.2f}s {data_size / 1024 / 1024 / deflate:>9.1f} "
+                  f"{ratio:>7.3f} {baseline[1] / deflate:>7.2f}x")
+    finally:
+        mbz_utils.set_codec("auto")
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+def _peak_rss():
+    """Return the peak resident memory of this process in bytes, or None where it cannot be measured"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class _StatsCollector(mbz_utils.Observer):
+    """Observer keeping the stats of the last operation"""
+
+    def __init__(self):
+        self.stats = None
+
+    def on_finish(self, stats):
+        self.stats = stats
+
+
+def measure_operation(args):
+    """
+    Run one suite operation and print its measurements as JSON
+
+    Runs in a fresh child process started by bench_suite, so the peak memory
+    belongs to this operation alone.
+    """
+    workdir = args.workdir
+    source = os.path.join(workdir, "course")
+    archive = os.path.join(workdir, "course.mbz")
+    extracted = os.path.join(workdir, "extracted")
+    collector = _StatsCollector()
+
+    if args.operation == "create":
+        def run():
+            success, message = mbz_utils.create_mbz(source, archive, workers=args.workers,
+                                                    compresslevel=args.level, observer=collector)
+            if not success:
+                raise RuntimeError(message)
+    elif args.operation == "analyze":
+        def run():
+            info = mbz_utils.analyze_mbz(archive, use_cache=False, observer=collector)
+            if "error" in info:
+                raise RuntimeError(info["error"])
+    elif args.operation == "extract":
+        def run():
+            shutil.rmtree(extracted, ignore_errors=True)
+            result = mbz_utils.extract_mbz(archive, extracted, workers=args.workers, observer=collector)
+            if result.startswith("Error:"):
+                raise RuntimeError(result)
+    else:
+        def run():
+            for _ in mbz_utils.list_xml_files(os.path.join(extracted, "course"), observer=collector):
+                pass
+
+    best = None
+    for _ in range(args.repeat):
+        seconds, _ = _time_call(run)
+        if best is None or seconds < best[0]:
+            best = (seconds, collector.stats)
+
+    seconds, stats = best
+    print(json.dumps({
+        "seconds": seconds,
+        "files": stats.files,
+        "bytes": stats.uncompressed_bytes,
+        "throughput_mb_s": stats.uncompressed_bytes / seconds / 1024 / 1024 if stats.uncompressed_bytes else None,
+        "files_per_second": stats.files / seconds,
+        "peak_rss_mb": _peak_rss() / 1024 / 1024 if resource is not None else None,
+        "phases": stats.phases
+    }))
+    return 0
+
+
+def compare_results(results, baseline, threshold):
+    """
+    Compare suite results with a baseline run
+
+    Args:
+        results (dict): Output of bench_suite
+        baseline (dict): Earlier output of bench_suite
+        threshold (float): Allowed slowdown or memory growth, e.g. 0.1 for 10%
+
+    Returns:
+        list: Descriptions of the regressions found
+    """
+    regressions = []
+    if baseline.get("course") != results["course"]:
+        print("Warning: the baseline was measured on a different course, comparisons are approximate")
+
+    for operation, current in results["operations"].items():
+        previous = baseline.get("operations", {}).get(operation)
+        if previous is None:
+            continue
+        for metric, label in (("seconds", "time"), ("peak_rss_mb", "peak memory")):
+            if current.get(metric) is None or not previous.get(metric):
+                continue
+            change = current[metric] / previous[metric] - 1
+            if change > threshold:
+                regressions.append(f"{operation}: {label} {previous[metric]:.2f} -> {current[metric]:.2f} "
+                                   f"(+{change * 100:.0f}%)")
+    return regressions
+
+
+def bench_suite(args):
+    """Time the main operations on a generated course, optionally against a baseline"""
+    workdir = tempfile.mkdtemp(prefix="mbz_bench_")
+    try:
+        course = {
+            "sections": args.sections,
+            "activities": args.activities,
+            "xml_kb": args.xml_kb,
+            "blobs": args.blobs,
+            "blob_kb": args.blob_kb,
+            "seed": args.seed
+        }
+        written = generate_course(os.path.join(workdir, "course"), **course)
+        print(f"Generated {written['files']} files, {written['bytes'] / 1024 / 1024:.1f} MB in {workdir}")
+
+        results = {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "codec": mbz_utils.get_codec().name,
+            "course": course,
+            "course_bytes": written["bytes"],
+            "course_files": written["files"],
+            "operations": {}
+        }
+
+        print(f"{'operation':<16} {'time':>9} {'MB/s':>9} {'files/s':>10} {'peak RSS':>10}")
+        for operation in SUITE_OPERATIONS:
+            command = [sys.executable, os.path.abspath(__file__), "measure", operation, workdir,
+                       "--repeat", str(args.repeat), "--level", str(args.level)]
+            if args.workers:
+                command += ["--workers", str(args.workers)]
+            child = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            if child.returncode != 0:
+                print(f"{operation} failed:\n{child.stderr.strip()}")
+                return 1
+
+            result = json.loads(child.stdout.strip().splitlines()[-1])
+            results["operations"][operation] = result
+            throughput = f"{result['throughput_mb_s']:.1f}" if result["throughput_mb_s"] is not None else "-"
+            peak = f"{result['peak_rss_mb']:.0f} MB" if result["peak_rss_mb"] is not None else "-"
+            print(f"{operation:<16} {result['seconds']:>8.2f}s {throughput:>9} "
+                  f"{result['files_per_second']:>10.0f} {peak:>10}")
+        results["archive_bytes"] = os.path.getsize(os.path.join(workdir, "course.mbz"))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+        print(f"No regression above {args.threshold * 100:.0f}% against {args.baseline}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark MBZ operations")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    compress = subparsers.add_parser("compress", help="single-threaded vs parallel create_mbz")
+    compress.add_argument("--size-mb", type=int, default=200, help="size of the generated course")
+    compress.add_argument("--workers", type=int, default=None, help="parallel workers (default: all CPUs)")
+    compress.add_argument("--level", type=int, default=9, help="gzip compression level")
+    compress.add_argument("--repeat", type=int, default=1, help="runs per engine, best time is kept")
+    compress.set_defaults(func=bench_compress)
+
+    codecs = subparsers.add_parser("codecs", help="compare the available gzip backends")
+    codecs.add_argument("--size-mb", type=int, default=1024, help="size of the generated course")
+    codecs.add_argument("--workers", type=int, default=None, help="compression workers (default: all CPUs)")
+    codecs.add_argument("--level", type=int, default=6, help="gzip compression level")
+    codecs.add_argument("--repeat", type=int, default=1, help="runs per codec, best time is kept")
+    codecs.set_defaults(func=bench_codecs)
+
+    suite = subparsers.add_parser("suite", help="time analyze, extract, create and list_xml_files")
+    suite.add_argument("--sections", type=int, default=10, help="sections in the generated course")
+    suite.add_argument("--activities", type=int, default=50, help="activities in the generated course")
+    suite.add_argument("--xml-kb", type=int, default=20, help="size of each activity's main XML file in KB")
+    suite.add_argument("--blobs", type=int, default=100, help="files in the files/ pool")
+    suite.add_argument("--blob-kb", type=int, default=512, help="average size of the files/ pool files in KB")
+    suite.add_argument("--seed", type=int, default=0, help="seed of the course generator")
+    suite.add_argument("--workers", type=int, default=None, help="threads per operation (default: all CPUs)")
+    suite.add_argument("--level", type=int, default=6, help="gzip compression level")
+    suite.add_argument("--repeat", type=int, default=1, help="runs per operation, best time is kept")
+    suite.add_argument("-o", "--output", help="write the results to this JSON file")
+    suite.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    suite.add_argument("--threshold", type=float, default=0.1,
+                       help="slowdown or memory growth reported as a regression (default: 0.1 = 10%%)")
+    suite.set_defaults(func=bench_suite)
+
+    # Internal: runs one suite operation in a child process
+    measure = subparsers.add_parser("measure")
+    measure.add_argument("operation", choices=SUITE_OPERATIONS)
+    measure.add_argument("workdir")
+    measure.add_argument("--workers", type=int, default=None)
+    measure.add_argument("--level", type=int, default=6)
+    measure.add_argument("--repeat", type=int, default=1)
+    measure.set_defaults(func=measure_operation)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
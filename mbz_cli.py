@@ -0,0 +1,344 @@
+"""
+Command-line interface for processing many MBZ files at once
+
+Each input is handled in a separate worker process and produces one JSON
+object per line, so results can be piped into other tools:
+
+    python mbz_cli.py analyze /backups/nightly/ --jobs 8 -o analysis.jsonl
+    python mbz_cli.py validate /backups/nightly/ -o validation.jsonl
+    python mbz_cli.py extract "/backups/*.mbz" --dest /tmp/extracted
+    python mbz_cli.py create /tmp/extracted/* --dest /backups/repacked
+    python mbz_cli.py repack /backups/nightly/ --dest /backups/repacked --level 6
+    python mbz_cli.py extract /backups/nightly/ --dest /srv/courses --store /srv/blobs
+    python mbz_cli.py extract /backups/nightly/ --dest /tmp/quizzes --module quiz --xml-only
+    python mbz_cli.py store-gc /srv/blobs
+    python mbz_cli.py search /backups/nightly/ -e old.example.com
+    python mbz_cli.py search /backups/ --xpath -e ".//question_category[name='Retired']"
+
+With --resume, inputs that already have a successful record in the output
+file are skipped, so an interrupted run can be restarted where it stopped.
+"""
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import mbz_utils
+
+
+def expand_inputs(patterns, want_dirs=False):
+    """
+    Turn the command-line inputs into a sorted list of absolute paths
+
+    Args:
+        patterns (list): Paths or glob patterns
+        want_dirs (bool): Collect folders (for create) instead of .mbz files.
+            A folder given for MBZ files is searched recursively for *.mbz
+
+    Returns:
+        list: Absolute paths, without duplicates
+    """
+    paths = set()
+    for pattern in patterns:
+        matches = glob.glob(pattern) or [pattern]
+        for match in matches:
+            if want_dirs:
+                if os.path.isdir(match):
+                    paths.add(os.path.abspath(match))
+            elif os.path.isdir(match):
+                for root, dirs, files in os.walk(match):
+                    for file in files:
+                        if file.lower().endswith(".mbz"):
+                            paths.add(os.path.abspath(os.path.join(root, file)))
+            elif os.path.isfile(match):
+                paths.add(os.path.abspath(match))
+    return sorted(paths)
+
+
+def load_done(output_file, command):
+    """
+    Read the inputs already processed successfully from a previous run
+
+    Args:
+        output_file (str): JSON-lines results file
+        command (str): Only records of this command count
+
+    Returns:
+        set: Input paths to skip
+    """
+    done = set()
+    try:
+        with open(output_file, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A run killed mid-write can leave a truncated last line
+                    continue
+                if record.get("command") == command and record.get("ok"):
+                    done.add(record.get("input"))
+    except OSError:
+        pass
+    return done
+
+
+def _output_path(dest, path, extension):
+    """Return the output path for an input inside the destination folder"""
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(dest, name + extension)
+
+
+class StatsRecorder(mbz_utils.Observer):
+    """Observer keeping the stats of the operations run for one input"""
+
+    def __init__(self):
+        self.stats = []
+
+    def on_finish(self, stats):
+        self.stats.append(stats.as_dict())
+
+
+def run_task(command, path, options):
+    """
+    Process one input, in a worker process
+
+    Args:
+        command (str): analyze, validate, extract, create, repack, store-gc or store-stats
+        path (str): Input MBZ file, or folder for create and the store commands
+        options (dict): Command options (dest, level, threads, stats, codec,
+            store, link_mode, dry_run, reproducible, include, exclude, modules,
+            sections, xml_only)
+
+    Returns:
+        dict: Result record
+    """
+    record = {"command": command, "input": path, "ok": False}
+    start = time.perf_counter()
+    observer = StatsRecorder() if options.get("stats") else None
+
+    try:
+        if options.get("codec"):
+            # Worker processes do not always inherit the parent's module state
+            mbz_utils.set_codec(options["codec"])
+
+        if command == "analyze":
+            info = mbz_utils.analyze_mbz(path, observer=observer)
+            record["ok"] = "error" not in info
+            record["result"] = info
+
+        elif command == "validate":
+            info = mbz_utils.validate_mbz(path, observer=observer)
+            record["ok"] = info.get("valid", False)
+            record["result"] = info
+
+        elif command == "extract":
+            result = mbz_utils.extract_mbz(path, options["dest"], workers=options["threads"],
+                                           observer=observer, store=options["store"],
+                                           link_mode=options["link_mode"], include=options["include"],
+                                           exclude=options["exclude"], modules=options["modules"],
+                                           sections=options["sections"], xml_only=options["xml_only"])
+            record["ok"] = not result.startswith("Error:")
+            # A plain string, so the member records are not sent back to the parent process
+            record["output" if record["ok"] else "error"] = str(result)
+
+        elif command == "create":
+            output_file = _output_path(options["dest"], path, ".mbz")
+            success, message = mbz_utils.create_mbz(path, output_file, workers=options["threads"],
+                                                    compresslevel=options["level"], observer=observer,
+                                                    reproducible=options["reproducible"])
+            record["ok"] = success
+            record["output" if success else "error"] = output_file if success else message
+
+        elif command == "repack":
+            output_file = _output_path(options["dest"], path, ".mbz")
+            success, message = mbz_utils.transform_mbz(path, output_file, workers=options["threads"],
+                                                       compresslevel=options["level"], observer=observer)
+            record["ok"] = success
+            record["output" if success else "error"] = output_file if success else message
+
+        elif command in ("store-gc", "store-stats"):
+            if command == "store-gc":
+                info = mbz_utils.gc_store(path, dry_run=options["dry_run"])
+            else:
+                info = mbz_utils.store_stats(path)
+            record["ok"] = "error" not in info
+            record["result"] = info
+
+        else:
+            raise ValueError(f"Unknown command: {command}")
+
+    except Exception as e:
+        record["error"] = f"Error: {str(e)}"
+
+    record["seconds"] = round(time.perf_counter() - start, 3)
+    if observer is not None:
+        record["stats"] = observer.stats
+    return record
+
+
+def write_search_results(args, inputs, out):
+    """
+    Search the inputs and write every match as soon as it is found
+    
+    Match records carry the search_mbz() result under "result"; each archive
+    then gets a summary record with "ok" and its number of matches.
+    
+    Returns:
+        int: Number of archives that could not be searched
+    """
+    mode = "xpath" if args.xpath else "regex" if args.regex else "substring"
+    failures = 0
+    for record in mbz_utils.search_archives(inputs, args.query, mode, path_filter=args.path or None,
+                                            ignore_case=args.ignore_case, max_matches=args.max_matches,
+                                            workers=max(1, args.jobs)):
+        path = record.pop("archive")
+        if record.get("done"):
+            summary = {"command": "search", "input": path, "ok": record["error"] is None,
+                       "result": {"matches": record["matches"]}}
+            if record["error"] is not None:
+                summary["error"] = record["error"]
+                failures += 1
+            record = summary
+        else:
+            record = {"command": "search", "input": path, "result": record}
+        out.write(json.dumps(record) + "\n")
+        out.flush()
+    return failures
+
+
+def build_parser():
+    """Create the argument parser"""
+    parser = argparse.ArgumentParser(description="Process Moodle backup (.mbz) files in bulk")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("inputs", nargs="+", help="files, folders or glob patterns")
+    common.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes (default: all CPUs)")
+    common.add_argument("-o", "--output", help="write JSON lines to this file instead of stdout")
+    common.add_argument("--resume", action="store_true",
+                        help="skip inputs already processed successfully in the --output file")
+    common.add_argument("--stats", action="store_true",
+                        help="add counters and per-phase timings to every record")
+    common.add_argument("--codec", choices=("auto",) + mbz_utils.CODEC_NAMES,
+                        help="gzip backend (default: MBZ_CODEC or auto)")
+
+    writing = argparse.ArgumentParser(add_help=False)
+    writing.add_argument("--dest", required=True, help="folder receiving the results")
+    writing.add_argument("--threads", type=int, default=1,
+                         help="threads used inside each job (default: 1, parallelism comes from --jobs)")
+    writing.add_argument("--level", type=int, default=9, help="gzip compression level (1-9)")
+
+    subparsers.add_parser("analyze", parents=[common], help="analyze MBZ files")
+    subparsers.add_parser("validate", parents=[common], help="check that MBZ files are complete Moodle backups")
+    extract = subparsers.add_parser("extract", parents=[common, writing], help="extract MBZ files into --dest")
+    extract.add_argument("--store", help="content-addressed store shared by the extractions, for the files/ pool")
+    extract.add_argument("--link-mode", choices=mbz_utils.STORE_LINK_MODES, default="reflink",
+                         help="how stored files appear in the extracted folders (default: reflink, a copy where "
+                              "the filesystem cannot clone; hardlink shares the stored file, so never edit "
+                              "it in place)")
+    extract.add_argument("--include", action="append", metavar="GLOB",
+                         help="only extract members matching this pattern, or below a matching folder (repeatable)")
+    extract.add_argument("--exclude", action="append", metavar="GLOB", help="leave out matching members (repeatable)")
+    extract.add_argument("--module", action="append", dest="modules", metavar="TYPE",
+                         help="only extract activities of this type, e.g. quiz (repeatable)")
+    extract.add_argument("--section", action="append", dest="sections", metavar="ID",
+                         help="only extract this section and its activities (repeatable)")
+    extract.add_argument("--xml-only", action="store_true", help="only extract XML files, skipping the files/ pool")
+    create = subparsers.add_parser("create", parents=[common, writing],
+                                   help="compress folders into MBZ files in --dest")
+    create.add_argument("--reproducible", action="store_true",
+                        help="sort members and fix timestamps and owners, so identical folders give identical output")
+    subparsers.add_parser("repack", parents=[common, writing], help="recompress MBZ files into --dest")
+    gc = subparsers.add_parser("store-gc", parents=[common], help="remove store objects no extracted folder uses")
+    gc.add_argument("--dry-run", action="store_true", help="only report what would be removed")
+    subparsers.add_parser("store-stats", parents=[common], help="report the space saved by stores")
+    search = subparsers.add_parser("search", parents=[common], help="search the XML files of MBZ files")
+    search.add_argument("-e", "--query", required=True, help="text to look for (or pattern with --regex/--xpath)")
+    query_type = search.add_mutually_exclusive_group()
+    query_type.add_argument("--regex", action="store_true", help="the query is a regular expression")
+    query_type.add_argument("--xpath", action="store_true",
+                            help="the query is an ElementTree path, relative to the document root")
+    search.add_argument("-i", "--ignore-case", action="store_true", help="case-insensitive text and regex search")
+    search.add_argument("--path", default="*.xml", metavar="GLOB", help="members to search (default: *.xml)")
+    search.add_argument("--max-matches", type=int, help="stop searching an archive after this many matches")
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    if args.resume and not args.output:
+        print("Error: --resume needs --output", file=sys.stderr)
+        return 2
+
+    if args.codec:
+        try:
+            mbz_utils.set_codec(args.codec)
+        except ValueError as e:
+            print(f"Error: {str(e)}", file=sys.stderr)
+            return 2
+
+    inputs = expand_inputs(args.inputs, want_dirs=args.command in ("create", "store-gc", "store-stats"))
+    if args.resume:
+        done = load_done(args.output, args.command)
+        inputs = [path for path in inputs if path not in done]
+
+    options = {
+        "dest": getattr(args, "dest", None),
+        "threads": getattr(args, "threads", 1),
+        "level": getattr(args, "level", 9),
+        "stats": args.stats,
+        "codec": args.codec,
+        "store": os.path.abspath(args.store) if getattr(args, "store", None) else None,
+        "link_mode": getattr(args, "link_mode", "reflink"),
+        "dry_run": getattr(args, "dry_run", False),
+        "reproducible": getattr(args, "reproducible", False),
+        "include": getattr(args, "include", None),
+        "exclude": getattr(args, "exclude", None),
+        "modules": getattr(args, "modules", None),
+        "sections": getattr(args, "sections", None),
+        "xml_only": getattr(args, "xml_only", False)
+    }
+    if options["dest"]:
+        options["dest"] = os.path.abspath(options["dest"])
+        os.makedirs(options["dest"], exist_ok=True)
+
+    if args.output:
+        out = open(args.output, "a" if args.resume else "w", encoding="utf-8")
+    else:
+        out = sys.stdout
+
+    failures = 0
+    try:
+        if args.command == "search":
+            # Matches are streamed while the archives are read, not sent back when a task ends
+            try:
+                failures = write_search_results(args, inputs, out)
+            except ValueError as e:
+                print(f"Error: {str(e)}", file=sys.stderr)
+                return 2
+        else:
+            with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+                futures = [executor.submit(run_task, args.command, path, options) for path in inputs]
+                for future in as_completed(futures):
+                    record = future.result()
+                    if not record["ok"]:
+                        failures += 1
+                    out.write(json.dumps(record) + "\n")
+                    # Flush every record, so --resume sees everything finished before an interruption
+                    out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
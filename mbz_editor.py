@@ -1,8 +1,96 @@
+import time
+
+# Taken before the other imports, for --startup-timing
+IMPORT_STARTED = time.perf_counter()
+
 import os
+import sys
+import json
+import glob
+import queue
+import argparse
+import importlib
+import threading
 import tkinter as tk
-from tkinter import filedialog, messagebox, ttk, scrolledtext
-from pathlib import Path
-import mbz_utils
+from tkinter import ttk, scrolledtext
+
+
+# How often the UI checks for events from running jobs (milliseconds)
+POLL_INTERVAL_MS = 100
+
+# Minimum delay between two progress events sent by a job (seconds)
+PROGRESS_INTERVAL = 0.1
+
+# Number of operations that can run at the same time
+MAX_JOBS = 4
+
+# Rows of the contents browser until the table is drawn and can be measured
+BROWSE_WINDOW_ROWS = 40
+
+# Rows moved by one step of the mouse wheel in the contents browser
+BROWSE_WHEEL_ROWS = 3
+
+# Bytes of a member decompressed for the preview pane
+PREVIEW_MAX_BYTES = 64 * 1024
+
+# Search results shown before a search is stopped
+SEARCH_MAX_RESULTS = 5000
+
+
+class LazyModule:
+    """Module imported the first time one of its attributes is used"""
+    
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+    
+    def __getattr__(self, attr):
+        # Only called for attributes of the module, the import lock makes it thread safe
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+# Not needed to show the window, imported by the first operation or dialog that uses them
+mbz_utils = LazyModule("mbz_utils")
+filedialog = LazyModule("tkinter.filedialog")
+messagebox = LazyModule("tkinter.messagebox")
+pathlib = LazyModule("pathlib")
+
+
+class Job:
+    """State of an operation running on the background executor"""
+    
+    def __init__(self, job_id, label, on_done, on_item=None):
+        self.job_id = job_id
+        self.label = label
+        self.on_done = on_done
+        self.on_item = on_item
+        self.cancel_event = threading.Event()
+        self.started = time.monotonic()
+        self.bytes_done = 0
+        self.bytes_total = 0
+        self.files_done = 0
+        self.last_event = 0.0
+
+
+def format_size(size_bytes):
+    """Format a number of bytes as KB or MB"""
+    size_kb = size_bytes / 1024
+    size_mb = size_kb / 1024
+    
+    if size_mb >= 1:
+        return f"{size_mb:.2f} MB"
+    return f"{size_kb:.2f} KB"
+
+
+def format_duration(seconds):
+    """Format a number of seconds as M:SS or H:MM:SS"""
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{seconds:02d}"
+    return f"{minutes}:{seconds:02d}"
 
 
 class MBZEditor:
@@ -24,10 +112,18 @@ class MBZEditor:
         self.notebook = ttk.Notebook(main_frame)
         self.notebook.pack(fill=tk.BOTH, expand=True)
         
-        # Create tabs
-        self.create_decompress_tab()
-        self.create_compress_tab()
-        self.create_analyze_tab()
+        # Create tabs, each one is filled the first time it is selected
+        self.tab_builders = {}
+        for text, builder in (("Decompress", self.create_decompress_tab),
+                              ("Compress", self.create_compress_tab),
+                              ("Analyze", self.create_analyze_tab),
+                              ("Browse", self.create_browse_tab),
+                              ("Search", self.create_search_tab)):
+            tab = ttk.Frame(self.notebook, padding=10)
+            self.notebook.add(tab, text=text)
+            self.tab_builders[str(tab)] = builder
+        self.notebook.bind("<<NotebookTabChanged>>", self.build_selected_tab)
+        self.build_selected_tab()
         
         # Status section
         status_frame = ttk.Frame(main_frame)
@@ -38,14 +134,31 @@ class MBZEditor:
         status_label = ttk.Label(status_frame, textvariable=self.status_var, font=("Helvetica", 10))
         status_label.pack(side=tk.LEFT, pady=5)
         
-        # Progress bar
-        self.progress = ttk.Progressbar(status_frame, orient=tk.HORIZONTAL, length=200, mode='indeterminate')
+        # Cancel button and progress bar
+        self.cancel_btn = ttk.Button(status_frame, text="Cancel", command=self.cancel_jobs, state=tk.DISABLED)
+        self.cancel_btn.pack(side=tk.RIGHT, padx=(5, 0), pady=5)
+        
+        self.progress = ttk.Progressbar(status_frame, orient=tk.HORIZONTAL, length=200, mode='determinate')
         self.progress.pack(side=tk.RIGHT, pady=5)
+        
+        # Background operations report to the UI through this queue, the
+        # executor is created by the first one
+        self.executor = None
+        self.events = queue.Queue()
+        self.jobs = {}
+        self.next_job_id = 0
+        self.root.after(POLL_INTERVAL_MS, self.poll_events)
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+
+    def build_selected_tab(self, event=None):
+        """Fill the selected tab if it is shown for the first time"""
+        tab = str(self.notebook.select())
+        builder = self.tab_builders.pop(tab, None)
+        if builder is not None:
+            builder(self.notebook.nametowidget(tab))
 
-    def create_decompress_tab(self):
-        """Create the decompress tab"""
-        decompress_tab = ttk.Frame(self.notebook, padding=10)
-        self.notebook.add(decompress_tab, text="Decompress")
+    def create_decompress_tab(self, decompress_tab):
+        """Fill the decompress tab"""
         
         # Decompress section
         instructions = ttk.Label(decompress_tab, 
@@ -89,6 +202,24 @@ class MBZEditor:
                                          variable=self.open_after_var)
         open_after_check.pack(side=tk.LEFT)
         
+        self.xml_only_var = tk.BooleanVar(value=False)
+        xml_only_check = ttk.Checkbutton(option_frame, text="XML files only", variable=self.xml_only_var)
+        xml_only_check.pack(side=tk.LEFT, padx=(10, 0))
+        
+        # Partial extraction
+        filter_frame = ttk.Frame(decompress_tab)
+        filter_frame.pack(fill=tk.X, pady=5)
+        
+        modules_label = ttk.Label(filter_frame, text="Activity types:")
+        modules_label.pack(side=tk.LEFT, padx=(0, 10))
+        
+        self.modules_var = tk.StringVar()
+        modules_entry = ttk.Entry(filter_frame, textvariable=self.modules_var, width=30)
+        modules_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
+        
+        modules_hint = ttk.Label(filter_frame, text="e.g. quiz, forum (empty: all)")
+        modules_hint.pack(side=tk.LEFT)
+        
         # Decompress button
         decompress_btn = ttk.Button(decompress_tab, text="Decompress MBZ File", command=self.decompress_mbz)
         decompress_btn.pack(pady=10)
@@ -100,10 +231,8 @@ class MBZEditor:
         self.decompress_result = scrolledtext.ScrolledText(result_frame, height=5, wrap=tk.WORD)
         self.decompress_result.pack(fill=tk.BOTH, expand=True)
 
-    def create_compress_tab(self):
-        """Create the compress tab"""
-        compress_tab = ttk.Frame(self.notebook, padding=10)
-        self.notebook.add(compress_tab, text="Compress")
+    def create_compress_tab(self, compress_tab):
+        """Fill the compress tab"""
         
         # Compress section
         instructions = ttk.Label(compress_tab, 
@@ -138,6 +267,21 @@ class MBZEditor:
         browse_out_file_btn = ttk.Button(out_file_frame, text="Browse", command=self.browse_output_file)
         browse_out_file_btn.pack(side=tk.LEFT)
         
+        # Optional original MBZ, used to repack only what changed
+        reference_frame = ttk.Frame(compress_tab)
+        reference_frame.pack(fill=tk.X, pady=5)
+        
+        reference_label = ttk.Label(reference_frame, text="Original MBZ:")
+        reference_label.pack(side=tk.LEFT, padx=(0, 10))
+        
+        self.reference_file_var = tk.StringVar()
+        reference_entry = ttk.Entry(reference_frame, textvariable=self.reference_file_var, width=40)
+        reference_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
+        
+        browse_reference_btn = ttk.Button(reference_frame, text="Browse",
+                                          command=lambda: self.browse_file(self.reference_file_var))
+        browse_reference_btn.pack(side=tk.LEFT)
+        
         # Compress button
         compress_btn = ttk.Button(compress_tab, text="Compress to MBZ File", command=self.compress_to_mbz)
         compress_btn.pack(pady=10)
@@ -155,10 +299,8 @@ class MBZEditor:
         self.compress_result = scrolledtext.ScrolledText(result_frame, height=5, wrap=tk.WORD)
         self.compress_result.pack(fill=tk.BOTH, expand=True)
 
-    def create_analyze_tab(self):
-        """Create the analyze tab"""
-        analyze_tab = ttk.Frame(self.notebook, padding=10)
-        self.notebook.add(analyze_tab, text="Analyze")
+    def create_analyze_tab(self, analyze_tab):
+        """Fill the analyze tab"""
         
         # Analyze section
         instructions = ttk.Label(analyze_tab, 
@@ -180,9 +322,15 @@ class MBZEditor:
                                command=lambda: self.browse_file(self.analyze_file_var))
         browse_btn.pack(side=tk.LEFT)
         
-        # Analyze button
-        analyze_btn = ttk.Button(analyze_tab, text="Analyze MBZ File", command=self.analyze_mbz)
-        analyze_btn.pack(pady=10)
+        # Analyze and validate buttons
+        button_frame = ttk.Frame(analyze_tab)
+        button_frame.pack(pady=10)
+        
+        analyze_btn = ttk.Button(button_frame, text="Analyze MBZ File", command=self.analyze_mbz)
+        analyze_btn.pack(side=tk.LEFT, padx=5)
+        
+        validate_btn = ttk.Button(button_frame, text="Validate Backup", command=self.validate_mbz)
+        validate_btn.pack(side=tk.LEFT, padx=5)
         
         # Results frame
         result_frame = ttk.LabelFrame(analyze_tab, text="Analysis Results", padding=10)
@@ -191,6 +339,175 @@ class MBZEditor:
         self.analyze_result = scrolledtext.ScrolledText(result_frame, height=10, wrap=tk.WORD)
         self.analyze_result.pack(fill=tk.BOTH, expand=True)
 
+    def create_browse_tab(self, browse_tab):
+        """Fill the browse tab"""
+        
+        # File selection
+        file_frame = ttk.Frame(browse_tab)
+        file_frame.pack(fill=tk.X, pady=5)
+        
+        file_label = ttk.Label(file_frame, text="MBZ File:")
+        file_label.pack(side=tk.LEFT, padx=(0, 10))
+        
+        self.browse_file_var = tk.StringVar()
+        file_entry = ttk.Entry(file_frame, textvariable=self.browse_file_var, width=40)
+        file_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
+        
+        browse_btn = ttk.Button(file_frame, text="Browse",
+                               command=lambda: self.browse_file(self.browse_file_var))
+        browse_btn.pack(side=tk.LEFT, padx=(0, 5))
+        
+        open_btn = ttk.Button(file_frame, text="Open", command=self.open_contents)
+        open_btn.pack(side=tk.LEFT)
+        
+        # Filter
+        filter_frame = ttk.Frame(browse_tab)
+        filter_frame.pack(fill=tk.X, pady=5)
+        
+        filter_label = ttk.Label(filter_frame, text="Filter:")
+        filter_label.pack(side=tk.LEFT, padx=(0, 10))
+        
+        self.browse_filter_var = tk.StringVar()
+        filter_entry = ttk.Entry(filter_frame, textvariable=self.browse_filter_var, width=30)
+        filter_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
+        filter_entry.bind("<Return>", lambda event: self.refresh_contents())
+        
+        filter_btn = ttk.Button(filter_frame, text="Apply", command=self.refresh_contents)
+        filter_btn.pack(side=tk.LEFT, padx=(0, 10))
+        
+        self.browse_count_var = tk.StringVar()
+        count_label = ttk.Label(filter_frame, textvariable=self.browse_count_var)
+        count_label.pack(side=tk.LEFT)
+        
+        # Member table: only the visible rows exist, they are refilled as the view moves
+        panes = ttk.PanedWindow(browse_tab, orient=tk.VERTICAL)
+        panes.pack(fill=tk.BOTH, expand=True, pady=5)
+        
+        table_frame = ttk.Frame(panes)
+        panes.add(table_frame, weight=3)
+        
+        columns = ("type", "size", "mtime")
+        self.contents_tree = ttk.Treeview(table_frame, columns=columns, selectmode="browse")
+        self.contents_tree.heading("#0", text="Name", command=lambda: self.sort_contents("name"))
+        self.contents_tree.heading("type", text="Type", command=lambda: self.sort_contents("type"))
+        self.contents_tree.heading("size", text="Size", command=lambda: self.sort_contents("size"))
+        self.contents_tree.heading("mtime", text="Modified", command=lambda: self.sort_contents("mtime"))
+        self.contents_tree.column("#0", width=300)
+        self.contents_tree.column("type", width=60, stretch=False)
+        self.contents_tree.column("size", width=90, stretch=False, anchor=tk.E)
+        self.contents_tree.column("mtime", width=130, stretch=False)
+        
+        # The scrollbar spans every matching member, not the rows of the table
+        self.contents_scrollbar = ttk.Scrollbar(table_frame, orient=tk.VERTICAL, command=self.scroll_contents)
+        self.contents_scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.contents_tree.pack(fill=tk.BOTH, expand=True)
+        self.contents_tree.bind("<<TreeviewSelect>>", lambda event: self.preview_member())
+        self.contents_tree.bind("<Configure>", lambda event: self.render_contents())
+        self.contents_tree.bind("<MouseWheel>", self.wheel_contents)
+        self.contents_tree.bind("<Button-4>", self.wheel_contents)
+        self.contents_tree.bind("<Button-5>", self.wheel_contents)
+        self.contents_tree.bind("<Up>", lambda event: self.step_contents(-1))
+        self.contents_tree.bind("<Down>", lambda event: self.step_contents(1))
+        self.contents_tree.bind("<Prior>", lambda event: self.scroll_contents("scroll", -1, "pages"))
+        self.contents_tree.bind("<Next>", lambda event: self.scroll_contents("scroll", 1, "pages"))
+        
+        # Preview of the selected member
+        preview_frame = ttk.LabelFrame(panes, text="Preview", padding=5)
+        panes.add(preview_frame, weight=1)
+        
+        self.preview_text = scrolledtext.ScrolledText(preview_frame, height=6, wrap=tk.NONE)
+        self.preview_text.pack(fill=tk.BOTH, expand=True)
+        
+        # Index of the open archive and the rows matching the filter, in display order;
+        # the table shows contents_rows[contents_top:] and contents_window lists those rows
+        self.contents_file = None
+        self.contents_index = None
+        self.contents_rows = []
+        self.contents_top = 0
+        self.contents_window = []
+        self.contents_selected = None
+        self.preview_row = None
+        self.contents_sort = ("name", False)
+
+    def create_search_tab(self, search_tab):
+        """Fill the search tab"""
+        
+        instructions = ttk.Label(search_tab,
+                               text="Search the XML files of one or many MBZ files without extracting them.")
+        instructions.pack(fill=tk.X, pady=(0, 10))
+        
+        # Archives: a file, a folder searched for .mbz files or a glob pattern
+        file_frame = ttk.Frame(search_tab)
+        file_frame.pack(fill=tk.X, pady=5)
+        
+        file_label = ttk.Label(file_frame, text="MBZ Files:")
+        file_label.pack(side=tk.LEFT, padx=(0, 10))
+        
+        self.search_path_var = tk.StringVar()
+        file_entry = ttk.Entry(file_frame, textvariable=self.search_path_var, width=40)
+        file_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
+        
+        browse_btn = ttk.Button(file_frame, text="File",
+                               command=lambda: self.browse_file(self.search_path_var))
+        browse_btn.pack(side=tk.LEFT, padx=(0, 5))
+        
+        folder_btn = ttk.Button(file_frame, text="Folder", command=self.browse_search_dir)
+        folder_btn.pack(side=tk.LEFT)
+        
+        # Query
+        query_frame = ttk.Frame(search_tab)
+        query_frame.pack(fill=tk.X, pady=5)
+        
+        query_label = ttk.Label(query_frame, text="Search for:")
+        query_label.pack(side=tk.LEFT, padx=(0, 10))
+        
+        self.search_query_var = tk.StringVar()
+        query_entry = ttk.Entry(query_frame, textvariable=self.search_query_var, width=30)
+        query_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(0, 5))
+        query_entry.bind("<Return>", lambda event: self.search_archives())
+        
+        # The tab is built when first selected, so this is where mbz_utils gets imported if no
+        # operation has run yet
+        self.search_mode_var = tk.StringVar(value="substring")
+        mode_box = ttk.Combobox(query_frame, textvariable=self.search_mode_var, values=mbz_utils.SEARCH_MODES,
+                                state="readonly", width=10)
+        mode_box.pack(side=tk.LEFT, padx=(0, 5))
+        
+        self.search_ignore_case_var = tk.BooleanVar(value=False)
+        ignore_case_check = ttk.Checkbutton(query_frame, text="Ignore case", variable=self.search_ignore_case_var)
+        ignore_case_check.pack(side=tk.LEFT)
+        
+        search_btn = ttk.Button(search_tab, text="Search", command=self.search_archives)
+        search_btn.pack(pady=10)
+        
+        # Results, added while the archives are read
+        result_frame = ttk.Frame(search_tab)
+        result_frame.pack(fill=tk.BOTH, expand=True)
+        
+        columns = ("archive", "member", "line", "text")
+        self.search_tree = ttk.Treeview(result_frame, columns=columns, show="headings")
+        self.search_tree.heading("archive", text="Archive")
+        self.search_tree.heading("member", text="Member")
+        self.search_tree.heading("line", text="Line")
+        self.search_tree.heading("text", text="Text")
+        self.search_tree.column("archive", width=120)
+        self.search_tree.column("member", width=180)
+        self.search_tree.column("line", width=50, stretch=False, anchor=tk.E)
+        self.search_tree.column("text", width=250)
+        
+        scrollbar = ttk.Scrollbar(result_frame, orient=tk.VERTICAL, command=self.search_tree.yview)
+        self.search_tree.configure(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.search_tree.pack(fill=tk.BOTH, expand=True)
+        
+        self.search_count = 0
+
+    def browse_search_dir(self):
+        """Browse for a folder of MBZ files to search"""
+        dir_path = filedialog.askdirectory(title="Select Folder with MBZ Files")
+        if dir_path:
+            self.search_path_var.set(dir_path)
+
     def browse_mbz_file(self):
         """Browse for an MBZ file"""
         file_path = filedialog.askopenfilename(
@@ -236,11 +553,124 @@ class MBZEditor:
         if file_path:
             string_var.set(file_path)
             
+    def start_job(self, label, operation, on_done, on_item=None):
+        """
+        Run an operation on the background executor
+        
+        Args:
+            label (str): Text shown in the status bar while the job runs
+            operation (callable): Called on a worker thread with a progress
+                callback (and an emit callback when on_item is given), returns
+                the job result
+            on_done (callable): Called on the UI thread as on_done(job, result, error)
+            on_item (callable): Called on the UI thread as on_item(job, item) for
+                every item the operation passes to emit, while it runs
+        """
+        if self.executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self.executor = ThreadPoolExecutor(max_workers=MAX_JOBS)
+        
+        job = Job(self.next_job_id, label, on_done, on_item)
+        self.next_job_id += 1
+        self.jobs[job.job_id] = job
+        
+        def progress(bytes_done, bytes_total, files_done):
+            # Runs on the worker thread: never touch Tk here, only post events
+            if job.cancel_event.is_set():
+                raise mbz_utils.OperationCancelled()
+            now = time.monotonic()
+            if now - job.last_event >= PROGRESS_INTERVAL or bytes_done >= bytes_total:
+                job.last_event = now
+                self.events.put(("progress", job.job_id, (bytes_done, bytes_total, files_done)))
+        
+        def emit(item):
+            # Runs on the worker thread, like progress
+            if job.cancel_event.is_set():
+                raise mbz_utils.OperationCancelled()
+            self.events.put(("item", job.job_id, item))
+        
+        def run():
+            try:
+                result = operation(progress, emit) if on_item is not None else operation(progress)
+                self.events.put(("done", job.job_id, (result, None)))
+            except Exception as e:
+                self.events.put(("done", job.job_id, (None, e)))
+        
+        self.executor.submit(run)
+        self.cancel_btn.config(state=tk.NORMAL)
+        self.update_status()
+    
+    def cancel_jobs(self):
+        """Ask every running job to stop"""
+        for job in self.jobs.values():
+            job.cancel_event.set()
+        self.status_var.set("Cancelling...")
+    
+    def on_close(self):
+        """Stop running jobs and close the window"""
+        self.cancel_jobs()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.root.destroy()
+    
+    def poll_events(self):
+        """Apply the events posted by running jobs, then check again later"""
+        try:
+            while True:
+                kind, job_id, payload = self.events.get_nowait()
+                job = self.jobs.get(job_id)
+                if job is None:
+                    continue
+                
+                if kind == "progress":
+                    job.bytes_done, job.bytes_total, job.files_done = payload
+                elif kind == "item":
+                    job.on_item(job, payload)
+                elif kind == "done":
+                    del self.jobs[job_id]
+                    result, error = payload
+                    job.on_done(job, result, error)
+        except queue.Empty:
+            pass
+        
+        self.update_status()
+        self.root.after(POLL_INTERVAL_MS, self.poll_events)
+    
+    def update_status(self):
+        """Show the combined progress of the running jobs"""
+        if not self.jobs:
+            self.progress["value"] = 0
+            self.cancel_btn.config(state=tk.DISABLED)
+            return
+        
+        done = sum(job.bytes_done for job in self.jobs.values())
+        total = sum(job.bytes_total for job in self.jobs.values())
+        files = sum(job.files_done for job in self.jobs.values())
+        elapsed = time.monotonic() - min(job.started for job in self.jobs.values())
+        
+        if len(self.jobs) == 1:
+            text = next(iter(self.jobs.values())).label
+        else:
+            text = f"{len(self.jobs)} jobs running"
+        
+        if total:
+            fraction = min(done / total, 1.0)
+            self.progress["value"] = fraction * 100
+            text += f" {fraction * 100:.0f}% - {files} files"
+            if elapsed > 0 and done:
+                throughput = done / elapsed
+                text += f" - {format_size(throughput)}/s"
+                text += f" - ETA {format_duration((total - done) / throughput)}"
+        
+        self.status_var.set(text)
+    
     def decompress_mbz(self):
         """Decompress an MBZ file to a folder"""
         mbz_file = self.mbz_file_var.get()
         output_dir = self.output_dir_var.get()
         open_after = self.open_after_var.get()
+        xml_only = self.xml_only_var.get()
+        modules = [module.strip() for module in self.modules_var.get().split(",") if module.strip()]
         
         if not mbz_file:
             messagebox.showerror("Error", "Please select an MBZ file")
@@ -250,24 +680,38 @@ class MBZEditor:
             messagebox.showerror("Error", "Please select an output directory")
             return
         
-        self.status_var.set("Decompressing...")
-        self.progress.start()
-        self.root.update()
+        mbz_file = os.path.abspath(mbz_file)
+        output_dir = os.path.abspath(output_dir)
+        
+        def operation(progress):
+            return mbz_utils.extract_mbz(mbz_file, output_dir, open_after, progress=progress, modules=modules,
+                                         xml_only=xml_only)
+        
+        self.decompress_result.delete(1.0, tk.END)
+        self.start_job(f"Decompressing {os.path.basename(mbz_file)}", operation, self.decompress_done)
+    
+    def decompress_done(self, job, outcome, error):
+        """Show the outcome of a decompress job"""
+        self.decompress_result.delete(1.0, tk.END)
         
         try:
-            result = mbz_utils.extract_mbz(mbz_file, output_dir, open_after)
+            if job.cancel_event.is_set():
+                self.status_var.set("Decompression cancelled")
+                self.decompress_result.insert(tk.END, "Decompression cancelled")
+                return
+            if error is not None:
+                raise error
             
+            result = outcome
             if result.startswith("Error:"):
                 self.status_var.set("Error occurred")
-                self.decompress_result.delete(1.0, tk.END)
                 self.decompress_result.insert(tk.END, result)
             else:
                 self.status_var.set(f"Successfully decompressed to {result}")
-                self.decompress_result.delete(1.0, tk.END)
                 self.decompress_result.insert(tk.END, f"MBZ file successfully decompressed to:\n{result}\n\n")
                 
-                # List XML files
-                xml_files = mbz_utils.list_xml_files(result)
+                # List XML files, as recorded by the extraction (no second walk of the folder)
+                xml_files = result.xml_files
                 if xml_files:
                     self.decompress_result.insert(tk.END, f"Found {len(xml_files)} XML files:\n")
                     for xml_file in xml_files[:10]:  # Show only first 10
@@ -281,14 +725,12 @@ class MBZEditor:
             self.status_var.set("Error occurred")
             self.decompress_result.delete(1.0, tk.END)
             self.decompress_result.insert(tk.END, f"Error: {str(e)}")
-        
-        finally:
-            self.progress.stop()
 
     def compress_to_mbz(self):
         """Compress a folder to an MBZ file"""
         source_dir = self.source_dir_var.get()
         output_file = self.output_file_var.get()
+        reference_file = self.reference_file_var.get()
         
         if not source_dir:
             messagebox.showerror("Error", "Please select a source folder")
@@ -303,14 +745,32 @@ class MBZEditor:
                               "Make sure the folder structure is exactly as extracted, without modifications to the structure.\n\nContinue with compression?"):
             return
         
-        self.status_var.set("Compressing...")
-        self.progress.start()
-        self.root.update()
+        source_dir = os.path.abspath(source_dir)
+        output_file = os.path.abspath(output_file)
+        reference_file = os.path.abspath(reference_file) if reference_file else None
+        
+        def operation(progress):
+            return mbz_utils.create_mbz(source_dir, output_file, reference_mbz=reference_file, progress=progress)
+        
+        def on_done(job, outcome, error):
+            self.compress_done(job, outcome, error, output_file)
+        
+        self.compress_result.delete(1.0, tk.END)
+        self.start_job(f"Compressing {os.path.basename(source_dir)}", operation, on_done)
+    
+    def compress_done(self, job, outcome, error, output_file):
+        """Show the outcome of a compress job"""
+        self.compress_result.delete(1.0, tk.END)
         
         try:
-            success, message = mbz_utils.create_mbz(source_dir, output_file)
+            if job.cancel_event.is_set():
+                self.status_var.set("Compression cancelled")
+                self.compress_result.insert(tk.END, "Compression cancelled")
+                return
+            if error is not None:
+                raise error
             
-            self.compress_result.delete(1.0, tk.END)
+            success, message = outcome
             
             if success:
                 self.status_var.set(f"Successfully compressed to {output_file}")
@@ -318,13 +778,7 @@ class MBZEditor:
                 
                 # Show file size
                 file_size = os.path.getsize(output_file)
-                size_kb = file_size / 1024
-                size_mb = size_kb / 1024
-                
-                if size_mb >= 1:
-                    self.compress_result.insert(tk.END, f"File size: {size_mb:.2f} MB")
-                else:
-                    self.compress_result.insert(tk.END, f"File size: {size_kb:.2f} KB")
+                self.compress_result.insert(tk.END, f"File size: {format_size(file_size)}")
             else:
                 self.status_var.set("Error occurred")
                 self.compress_result.insert(tk.END, message)
@@ -333,9 +787,6 @@ class MBZEditor:
             self.status_var.set("Error occurred")
             self.compress_result.delete(1.0, tk.END)
             self.compress_result.insert(tk.END, f"Error: {str(e)}")
-        
-        finally:
-            self.progress.stop()
 
     def analyze_mbz(self):
         """Analyze an MBZ file"""
@@ -345,14 +796,25 @@ class MBZEditor:
             messagebox.showerror("Error", "Please select an MBZ file")
             return
         
-        self.status_var.set("Analyzing...")
-        self.progress.start()
-        self.root.update()
+        mbz_file = os.path.abspath(mbz_file)
+        
+        def operation(progress):
+            return mbz_utils.analyze_mbz(mbz_file, progress=progress)
+        
+        self.analyze_result.delete(1.0, tk.END)
+        self.start_job(f"Analyzing {os.path.basename(mbz_file)}", operation, self.analyze_done)
+    
+    def analyze_done(self, job, info, error):
+        """Show the outcome of an analyze job"""
+        self.analyze_result.delete(1.0, tk.END)
         
         try:
-            info = mbz_utils.analyze_mbz(mbz_file)
-            
-            self.analyze_result.delete(1.0, tk.END)
+            if job.cancel_event.is_set():
+                self.status_var.set("Analysis cancelled")
+                self.analyze_result.insert(tk.END, "Analysis cancelled")
+                return
+            if error is not None:
+                raise error
             
             if "error" in info:
                 self.status_var.set("Error occurred")
@@ -361,14 +823,7 @@ class MBZEditor:
                 self.status_var.set("Analysis complete")
                 
                 # Format file size
-                size_bytes = info["file_size"]
-                size_kb = size_bytes / 1024
-                size_mb = size_kb / 1024
-                
-                if size_mb >= 1:
-                    size_str = f"{size_mb:.2f} MB"
-                else:
-                    size_str = f"{size_kb:.2f} KB"
+                size_str = format_size(info["file_size"])
                 
                 # Display analysis results
                 self.analyze_result.insert(tk.END, f"File: {info['file_name']}\n")
@@ -376,7 +831,10 @@ class MBZEditor:
                 self.analyze_result.insert(tk.END, f"Valid MBZ: {'Yes' if info['is_valid'] else 'No'}\n")
                 self.analyze_result.insert(tk.END, f"Total files: {info.get('total_files', 'Unknown')}\n")
                 self.analyze_result.insert(tk.END, f"XML files: {info['xml_files']}\n")
-                self.analyze_result.insert(tk.END, f"Top-level items: {info['top_level_items']}\n\n")
+                self.analyze_result.insert(tk.END, f"Top-level items: {info['top_level_items']}\n")
+                if info.get('cached'):
+                    self.analyze_result.insert(tk.END, "(loaded from the index cache)\n")
+                self.analyze_result.insert(tk.END, "\n")
                 
                 # Show some of the contents
                 if info['contents']:
@@ -391,12 +849,377 @@ class MBZEditor:
             self.status_var.set("Error occurred")
             self.analyze_result.delete(1.0, tk.END)
             self.analyze_result.insert(tk.END, f"Error: {str(e)}")
+
+    def validate_mbz(self):
+        """Check that an MBZ file is a complete Moodle backup"""
+        mbz_file = self.analyze_file_var.get()
+        
+        if not mbz_file:
+            messagebox.showerror("Error", "Please select an MBZ file")
+            return
+        
+        mbz_file = os.path.abspath(mbz_file)
+        
+        def operation(progress):
+            return mbz_utils.validate_mbz(mbz_file, progress=progress)
+        
+        self.analyze_result.delete(1.0, tk.END)
+        self.start_job(f"Validating {os.path.basename(mbz_file)}", operation, self.validate_done)
+    
+    def validate_done(self, job, info, error):
+        """Show the outcome of a validate job"""
+        self.analyze_result.delete(1.0, tk.END)
         
-        finally:
-            self.progress.stop()
+        try:
+            if job.cancel_event.is_set():
+                self.status_var.set("Validation cancelled")
+                self.analyze_result.insert(tk.END, "Validation cancelled")
+                return
+            if error is not None:
+                raise error
+            
+            if "error" in info:
+                self.status_var.set("Error occurred")
+                self.analyze_result.insert(tk.END, f"Error: {info['error']}")
+                return
+            
+            if info["valid"]:
+                self.status_var.set("Backup is valid")
+            else:
+                self.status_var.set(f"Backup has {info['errors']} errors")
+            
+            checked = info["checked"]
+            self.analyze_result.insert(tk.END, f"File: {info['file_name']}\n")
+            self.analyze_result.insert(tk.END, f"Valid backup: {'Yes' if info['valid'] else 'No'}\n")
+            self.analyze_result.insert(tk.END, f"Checked {checked['members']} members, {checked['activities']} "
+                                               f"activities, {checked['sections']} sections and "
+                                               f"{checked['files']} files\n")
+            self.analyze_result.insert(tk.END, f"Errors: {info['errors']}, warnings: {info['warnings']}\n\n")
+            
+            for problem in info["problems"]:
+                self.analyze_result.insert(tk.END, f"[{problem['severity']}] {problem['path']}: "
+                                                   f"{problem['message']}\n")
+                
+        except Exception as e:
+            self.status_var.set("Error occurred")
+            self.analyze_result.delete(1.0, tk.END)
+            self.analyze_result.insert(tk.END, f"Error: {str(e)}")
 
+    def open_contents(self):
+        """Load the index of an MBZ file into the contents browser"""
+        mbz_file = self.browse_file_var.get()
+        
+        if not mbz_file:
+            messagebox.showerror("Error", "Please select an MBZ file")
+            return
+        
+        mbz_file = os.path.abspath(mbz_file)
+        
+        def operation(progress):
+            return mbz_utils.get_index(mbz_file, progress=progress)
+        
+        def on_done(job, index, error):
+            self.open_contents_done(job, index, error, mbz_file)
+        
+        self.start_job(f"Indexing {os.path.basename(mbz_file)}", operation, on_done)
+    
+    def open_contents_done(self, job, index, error, mbz_file):
+        """Show the members of a newly indexed MBZ file"""
+        if job.cancel_event.is_set():
+            self.status_var.set("Indexing cancelled")
+            return
+        if error is not None:
+            self.status_var.set("Error occurred")
+            messagebox.showerror("Error", f"Could not read {os.path.basename(mbz_file)}: {str(error)}")
+            return
+        
+        self.contents_file = mbz_file
+        self.contents_index = index
+        self.contents_selected = None
+        self.preview_row = None
+        self.preview_text.delete(1.0, tk.END)
+        self.status_var.set(f"Opened {os.path.basename(mbz_file)}")
+        self.refresh_contents()
+    
+    def refresh_contents(self):
+        """Filter and sort the index again and show the first page"""
+        if self.contents_index is None:
+            return
+        
+        sort_by, descending = self.contents_sort
+        pattern = self.browse_filter_var.get().strip()
+        self.contents_rows = mbz_utils.query_index(self.contents_index, pattern, sort_by, descending)
+        self.contents_top = 0
+        self.render_contents()
+        # Rows can only be measured once drawn: fit the table to them
+        self.root.after_idle(self.render_contents)
+    
+    def sort_contents(self, column):
+        """Sort the contents on a column, reversing the order when it is already sorted on it"""
+        sort_by, descending = self.contents_sort
+        self.contents_sort = (column, not descending if column == sort_by else False)
+        self.refresh_contents()
+    
+    def visible_contents_rows(self):
+        """Return how many rows fit in the contents table, measured on its first row"""
+        items = self.contents_tree.get_children()
+        bbox = self.contents_tree.bbox(items[0]) if items else ""
+        if bbox:
+            _, top, _, height = bbox
+            space = self.contents_tree.winfo_height() - top
+            if space >= height:
+                return space // height
+        return BROWSE_WINDOW_ROWS
+    
+    def render_contents(self):
+        """Fill the table with the rows starting at contents_top, reusing its items"""
+        if self.contents_index is None:
+            return
+        
+        members = self.contents_index["members"]
+        total = len(self.contents_rows)
+        visible = self.visible_contents_rows()
+        self.contents_top = max(0, min(self.contents_top, total - visible))
+        self.contents_window = self.contents_rows[self.contents_top:self.contents_top + visible]
+        
+        # One item per visible row, whatever the number of members
+        items = self.contents_tree.get_children()
+        if len(items) > len(self.contents_window):
+            self.contents_tree.delete(*items[len(self.contents_window):])
+        for slot in range(len(items), len(self.contents_window)):
+            self.contents_tree.insert("", tk.END, iid=str(slot))
+        
+        for slot, row in enumerate(self.contents_window):
+            modified = time.strftime("%Y-%m-%d %H:%M", time.localtime(members["mtime"][row]))
+            size = format_size(members["size"][row]) if members["type"][row] == "file" else ""
+            self.contents_tree.item(str(slot), text=members["name"][row],
+                                    values=(members["type"][row], size, modified))
+        
+        # The selection follows the selected member, not the item
+        if self.contents_selected in self.contents_window:
+            slot = str(self.contents_window.index(self.contents_selected))
+            self.contents_tree.selection_set(slot)
+            self.contents_tree.focus(slot)
+        elif self.contents_tree.selection():
+            self.contents_tree.selection_remove(*self.contents_tree.selection())
+        
+        if total:
+            self.contents_scrollbar.set(self.contents_top / total, (self.contents_top + visible) / total)
+            last = min(self.contents_top + visible, total)
+            self.browse_count_var.set(f"Showing {self.contents_top + 1}-{last} of {total} members")
+        else:
+            self.contents_scrollbar.set(0, 1)
+            self.browse_count_var.set("No members")
+    
+    def scroll_contents(self, action, amount, unit=None):
+        """Move the view of the contents table, called like a Tk yview command"""
+        if action == "moveto":
+            self.contents_top = int(float(amount) * len(self.contents_rows))
+        elif unit == "pages":
+            self.contents_top += int(amount) * max(len(self.contents_window) - 1, 1)
+        else:
+            self.contents_top += int(amount)
+        self.render_contents()
+        return "break"
+    
+    def wheel_contents(self, event):
+        """Scroll the contents table with the mouse wheel"""
+        if event.num == 4 or getattr(event, "delta", 0) > 0:
+            return self.scroll_contents("scroll", -BROWSE_WHEEL_ROWS, "units")
+        return self.scroll_contents("scroll", BROWSE_WHEEL_ROWS, "units")
+    
+    def step_contents(self, step):
+        """Select the previous or next member, scrolling when the selection leaves the table"""
+        if not self.contents_rows:
+            return "break"
+        if self.contents_selected in self.contents_rows:
+            position = self.contents_rows.index(self.contents_selected) + step
+        else:
+            position = self.contents_top
+        position = max(0, min(position, len(self.contents_rows) - 1))
+        
+        if position < self.contents_top:
+            self.contents_top = position
+        elif position >= self.contents_top + len(self.contents_window):
+            self.contents_top = position - len(self.contents_window) + 1
+        self.contents_selected = self.contents_rows[position]
+        self.render_contents()
+        self.preview_member()
+        return "break"
+    
+    def preview_member(self):
+        """Show the beginning of the selected member, decompressing only that member"""
+        selection = self.contents_tree.selection()
+        if not selection or self.contents_index is None:
+            return
+        
+        row = self.contents_window[int(selection[0])]
+        if row == self.contents_selected and self.preview_row == row:
+            # Selected again by render_contents() after a scroll
+            return
+        self.contents_selected = row
+        self.preview_row = row
+        members = self.contents_index["members"]
+        name = members["name"][row]
+        self.preview_text.delete(1.0, tk.END)
+        if members["type"][row] != "file":
+            self.preview_text.insert(tk.END, f"{name} is a {members['type'][row]}")
+            return
+        
+        mbz_file = self.contents_file
+        index = self.contents_index
+        
+        def operation(progress):
+            return mbz_utils.read_member(mbz_file, name, index=index, max_bytes=PREVIEW_MAX_BYTES,
+                                         progress=progress)
+        
+        def on_done(job, data, error):
+            self.preview_done(job, data, error, row)
+        
+        self.start_job(f"Reading {name}", operation, on_done)
+    
+    def preview_done(self, job, data, error, row):
+        """Show the data read for a preview, unless another member was selected meanwhile"""
+        if self.preview_row != row:
+            return
+        
+        self.preview_text.delete(1.0, tk.END)
+        if job.cancel_event.is_set():
+            # Selecting the member again starts a new preview
+            self.preview_row = None
+            self.preview_text.insert(tk.END, "Preview cancelled")
+            self.status_var.set("Preview cancelled")
+            return
+        if error is not None:
+            self.preview_text.insert(tk.END, f"Error: {str(error)}")
+            return
+        
+        size = self.contents_index["members"]["size"][row]
+        if b"\0" in data:
+            self.preview_text.insert(tk.END, f"Binary data, {format_size(size)}")
+            return
+        # A cut preview can end in the middle of a multi-byte character
+        self.preview_text.insert(tk.END, data.decode("utf-8", errors="replace"))
+        if size > len(data):
+            self.preview_text.insert(tk.END, f"\n\n... first {format_size(len(data))} of {format_size(size)}")
+        self.status_var.set("Ready")
 
-if __name__ == "__main__":
+    def search_archives(self):
+        """Search the XML files of the selected MBZ files"""
+        location = self.search_path_var.get()
+        query = self.search_query_var.get()
+        mode = self.search_mode_var.get()
+        ignore_case = self.search_ignore_case_var.get()
+        
+        if not location:
+            messagebox.showerror("Error", "Please select an MBZ file or a folder")
+            return
+        if not query:
+            messagebox.showerror("Error", "Please enter something to search for")
+            return
+        
+        if os.path.isdir(location):
+            paths = sorted(str(path) for path in pathlib.Path(location).rglob("*.mbz"))
+        else:
+            paths = sorted(glob.glob(location))
+        if not paths:
+            messagebox.showerror("Error", "No MBZ files found")
+            return
+        
+        def operation(progress, emit):
+            # progress raises OperationCancelled once the job is cancelled, search_archives()
+            # calls it every second while waiting and emit() checks it before every record
+            results = mbz_utils.search_archives(paths, query, mode, ignore_case=ignore_case, progress=progress)
+            try:
+                found = 0
+                for record in results:
+                    if not record.get("done"):
+                        found += 1
+                    emit(record)
+                    if found >= SEARCH_MAX_RESULTS:
+                        break
+                return found
+            finally:
+                # Stops the worker processes when the search ends early
+                results.close()
+        
+        self.search_tree.delete(*self.search_tree.get_children())
+        self.search_count = 0
+        self.start_job(f"Searching {len(paths)} MBZ files", operation, self.search_done, self.search_result)
+    
+    def search_result(self, job, record):
+        """Add a search result to the table as soon as it is found"""
+        archive = os.path.basename(record["archive"])
+        if record.get("done"):
+            if record["error"] is not None:
+                self.search_tree.insert("", tk.END, values=(archive, "", "", record["error"]))
+            return
+        
+        self.search_count += 1
+        # XPath results are elements, whose own text is empty for containers such as <activity>
+        text = record.get("error") or (" ".join(record["match"].split()) if "tag" in record else record["text"])
+        self.search_tree.insert("", tk.END, values=(archive, record["member"], record.get("line", ""), text))
+    
+    def search_done(self, job, found, error):
+        """Report the end of a search"""
+        if job.cancel_event.is_set():
+            self.status_var.set(f"Search cancelled after {self.search_count} matches")
+        elif error is not None:
+            self.status_var.set("Error occurred")
+            messagebox.showerror("Error", f"Search failed: {str(error)}")
+        elif found >= SEARCH_MAX_RESULTS:
+            self.status_var.set(f"Search stopped after {found} matches")
+        else:
+            self.status_var.set(f"Search complete: {found} matches")
+
+
+def report_startup(timings, output):
+    """
+    Write the startup timings as one JSON line
+    
+    Args:
+        timings (dict): Milliseconds spent in each startup phase
+        output (str): File the line is appended to, or "-" for stderr
+    """
+    record = dict(timings)
+    # Modules that should only be imported by the first operation
+    record["lazy_modules_loaded"] = sorted(name for name in ("mbz_utils", "tarfile", "subprocess", "pathlib")
+                                           if name in sys.modules)
+    line = json.dumps(record) + "\n"
+    if output == "-":
+        sys.stderr.write(line)
+    else:
+        with open(output, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tkinter GUI for Moodle backup (.mbz) files")
+    parser.add_argument("--startup-timing", nargs="?", const="-", metavar="FILE",
+                        help="report the import, window and first paint times as JSON, "
+                             "on stderr or appended to FILE")
+    args = parser.parse_args(argv)
+    
+    imported = time.perf_counter()
     root = tk.Tk()
     app = MBZEditor(root)
-    root.mainloop() 
\ No newline at end of file
+    created = time.perf_counter()
+    
+    if args.startup_timing:
+        def first_paint():
+            root.update_idletasks()
+            painted = time.perf_counter()
+            report_startup({
+                "import_ms": round((imported - IMPORT_STARTED) * 1000, 1),
+                "window_ms": round((created - imported) * 1000, 1),
+                "first_paint_ms": round((painted - IMPORT_STARTED) * 1000, 1),
+            }, args.startup_timing)
+        
+        # Runs once the event loop has drawn the window for the first time
+        root.after_idle(first_paint)
+    
+    root.mainloop()
+
+
+if __name__ == "__main__":
+    main() 
\ No newline at end of file
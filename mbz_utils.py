@@ -1,163 +1,3928 @@
+import io
 import os
+import json
+import hashlib
+import posixpath
+import struct
 import tarfile
 import shutil
 import subprocess
+import threading
+import time
+import zlib
+import gzip
+import contextlib
+import fnmatch
+import re
+import tempfile
+import mmap
+import itertools
+import warnings
+import multiprocessing
+import queue
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from pathlib import Path
+from stat import S_ISLNK, S_ISREG
+from xml.etree import ElementTree
 
+try:
+    import pwd
+    import grp
+except ImportError:
+    # No user database on Windows: tar headers then carry no owner names
+    pwd = grp = None
 
-def analyze_mbz(mbz_file_path):
+
+# Number of member names kept in analyze_mbz()'s "contents" sample
+CONTENTS_SAMPLE_SIZE = 20
+
+# Read buffer used when streaming a gzip-compressed tar archive
+STREAM_BUFSIZE = 1024 * 1024
+
+# Size of the uncompressed blocks compressed independently by ParallelGzipWriter
+GZIP_BLOCK_SIZE = 1024 * 1024
+
+# Upper bound for file data read ahead of the writer threads during extraction
+EXTRACT_MAX_PENDING_BYTES = 64 * 1024 * 1024
+
+# Buffer size used when copying large members straight to disk
+COPY_BUFSIZE = 1024 * 1024
+
+# Files at least this large are memory-mapped by create_mbz, so their data goes
+# from the page cache to the compressor without intermediate copies
+MMAP_MIN_SIZE = 16 * 1024 * 1024
+
+# Files up to PREFETCH_MAX_FILE_SIZE are read ahead of the archive writer by
+# PREFETCH_WORKERS threads, keeping at most PREFETCH_MAX_BYTES in memory
+PREFETCH_MAX_FILE_SIZE = 1024 * 1024
+PREFETCH_MAX_BYTES = 32 * 1024 * 1024
+PREFETCH_WORKERS = 8
+
+# Manifest written into extracted folders, used by create_mbz to repack incrementally
+MANIFEST_NAME = ".mbz_manifest.json"
+
+# Minimum uncompressed distance between two gzip seek checkpoints in an archive index
+CHECKPOINT_SPAN = 4 * 1024 * 1024
+
+# Compressed input read per step when reading single members, kept small so
+# that a small file costs little more than its own size to decompress
+RANDOM_ACCESS_CHUNK = 64 * 1024
+
+# Uncompressed bytes read_member() decompresses between two progress calls
+READ_PROGRESS_STEP = 1024 * 1024
+
+# Maximum number of in-memory decompressor snapshots kept per archive, and
+# number of archives they are kept for (each snapshot holds about 40 KB)
+MAX_WINDOW_SNAPSHOTS = 256
+WINDOW_CACHE_ARCHIVES = 4
+
+# Archive index format, bump when the layout of get_index() or of the cache files changes
+INDEX_VERSION = 2
+INDEX_COLUMNS = ("name", "type", "size", "mtime", "mode", "offset", "offset_data")
+
+# On-disk cache of archive indexes, keyed by path, size and modification time.
+# Set MBZ_INDEX_CACHE=0 (or INDEX_CACHE_ENABLED = False) to disable it
+INDEX_CACHE_ENABLED = os.environ.get("MBZ_INDEX_CACHE", "1") != "0"
+INDEX_CACHE_DIR = os.environ.get("MBZ_INDEX_CACHE_DIR") or os.path.join(
+    os.path.expanduser("~"), ".cache", "mbz_editor", "index")
+INDEX_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# gzip backend used to read and write archives: "isal", "zlib-ng" and "zlib"
+# run in-process, "pigz" runs the external pigz program. "auto" picks the first
+# in-process backend of CODEC_AUTO_ORDER that is installed. Set MBZ_CODEC or
+# call set_codec() to choose; an unavailable or unknown choice falls back to "auto"
+CODEC = os.environ.get("MBZ_CODEC", "auto")
+CODEC_NAMES = ("isal", "zlib-ng", "pigz", "zlib")
+CODEC_AUTO_ORDER = ("isal", "zlib-ng", "zlib")
+
+# Limits of the structural diff of modified XML files in diff_mbz(): larger
+# files are only reported as modified, and each file lists at most that many changes
+XML_DIFF_MAX_BYTES = 32 * 1024 * 1024
+XML_DIFF_MAX_CHANGES = 100
+
+# How extract_mbz() puts files of a shared content-addressed store into the
+# extraction folder: "reflink" and "hardlink" share the stored data (falling
+# back to a copy where the filesystem cannot), "copy" duplicates it and "none"
+# leaves the files out of the folder (create_mbz() reads them from the store).
+# A hard-linked file is the stored object itself: writing into it changes every
+# other extraction linked to it, so "reflink" (copy-on-write) is the default
+STORE_LINK_MODES = ("reflink", "hardlink", "copy", "none")
+
+# Moodle's file pool: files/<first two hex digits>/<SHA-1 of the contents>
+_BLOB_NAME = re.compile(r"(?:^|/)files/([0-9a-f]{2})/(\1[0-9a-f]{38})$")
+
+# Query languages of search_mbz(): plain text, regular expression or ElementTree's XPath subset
+SEARCH_MODES = ("substring", "regex", "xpath")
+
+# Longest line or element text included in a search result
+SEARCH_TEXT_CHARS = 200
+
+# Activity and section folders of a backup: activities/<module>_<id>, sections/section_<id>
+_ACTIVITY_DIR = re.compile(r"(?:^|/)activities/(([a-z0-9]+)_\d+)(?:/|$)")
+_SECTION_DIR = re.compile(r"(?:^|/)sections/section_(\d+)(?:/|$)")
+
+# Files of a backup's course/ folder, kept with its top-level metadata files
+_COURSE_FILE = re.compile(r"(?:^|/)course/[^/]+$")
+
+# Folders of a backup that hold no top-level metadata files
+_BACKUP_FOLDERS = ("activities", "sections", "files")
+
+# SHA-1 of empty contents, which Moodle also gives to directory entries in files.xml
+_EMPTY_SHA1 = hashlib.sha1(b"").hexdigest()
+
+# Linux ioctl cloning a file's extents into another file (FICLONE)
+_FICLONE = 0x40049409
+
+# Timestamp given to every member (and the gzip header) of a reproducible
+# archive, following the reproducible-builds SOURCE_DATE_EPOCH convention
+REPRODUCIBLE_MTIME = int(os.environ.get("SOURCE_DATE_EPOCH", "0"))
+
+
+class OperationCancelled(Exception):
+    """Raised from a progress callback to stop the operation that called it"""
+    
+    def __init__(self, message="Operation cancelled"):
+        super().__init__(message)
+
+
+class Observer:
+    """
+    Base class for instrumentation hooks on mbz_utils operations
+    
+    Subclass it and override the methods you need, then pass an instance as
+    the ``observer`` argument of an operation (or set DEFAULT_OBSERVER to
+    observe every operation). Hooks run on the thread doing the work.
+    """
+    
+    def on_start(self, operation, path):
+        """Called when an operation starts on a file or folder"""
+    
+    def on_member(self, operation, name, size):
+        """Called for every archive member or file the operation handles"""
+    
+    def on_progress(self, operation, bytes_done, bytes_total, files_done):
+        """Called regularly with the progress of the operation"""
+    
+    def on_finish(self, stats):
+        """Called with the OperationStats once the operation is over"""
+
+
+class OperationStats:
+    """
+    Counters and timings of one operation
+    
+    ``phases`` maps a phase name to the seconds spent in it: "decompress",
+    "tar_parse", "file_write", "directory_walk", "file_read", "compress" and
+    "xml_diff".
+    Phases running on several threads (file_write) add up the time of every
+    thread, so they can exceed the wall-clock ``seconds``.
+    """
+    
+    def __init__(self, operation, path):
+        self.operation = operation
+        self.path = path
+        self.files = 0
+        self.compressed_bytes = 0
+        self.uncompressed_bytes = 0
+        self.phases = {}
+        self.seconds = 0.0
+        self.error = None
+    
+    @property
+    def throughput(self):
+        """Uncompressed bytes processed per second"""
+        return self.uncompressed_bytes / self.seconds if self.seconds else 0.0
+    
+    @property
+    def files_per_second(self):
+        return self.files / self.seconds if self.seconds else 0.0
+    
+    def as_dict(self):
+        """Return the stats as a JSON-serializable dictionary"""
+        return {
+            "operation": self.operation,
+            "path": self.path,
+            "files": self.files,
+            "compressed_bytes": self.compressed_bytes,
+            "uncompressed_bytes": self.uncompressed_bytes,
+            "seconds": self.seconds,
+            "throughput": self.throughput,
+            "files_per_second": self.files_per_second,
+            "phases": dict(self.phases),
+            "error": self.error
+        }
+
+
+# Observer used by operations called without one (None disables instrumentation)
+DEFAULT_OBSERVER = None
+
+
+class _Instrument:
+    """Collects the stats of one operation and forwards its events"""
+    
+    def __init__(self, operation, path, observer, progress):
+        self.observer = observer
+        self.progress_callback = progress
+        self.stats = OperationStats(operation, path)
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+        if observer is not None:
+            observer.on_start(operation, path)
+    
+    def add_phase(self, phase, seconds):
+        with self._lock:
+            self.stats.phases[phase] = self.stats.phases.get(phase, 0.0) + seconds
+    
+    def phase_time(self, *phases):
+        with self._lock:
+            return sum(self.stats.phases.get(phase, 0.0) for phase in phases)
+    
+    @contextlib.contextmanager
+    def timed(self, phase, exclude=()):
+        """Time a block as ``phase``, minus the time spent in the ``exclude`` phases meanwhile"""
+        if isinstance(exclude, str):
+            exclude = (exclude,)
+        excluded = self.phase_time(*exclude)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start - (self.phase_time(*exclude) - excluded)
+            self.add_phase(phase, max(elapsed, 0.0))
+    
+    def member(self, name, size):
+        self.stats.files += 1
+        if self.observer is not None:
+            self.observer.on_member(self.stats.operation, name, size)
+    
+    def progress(self, bytes_done, bytes_total):
+        if self.progress_callback is not None:
+            self.progress_callback(bytes_done, bytes_total, self.stats.files)
+        if self.observer is not None:
+            self.observer.on_progress(self.stats.operation, bytes_done, bytes_total, self.stats.files)
+    
+    def finish(self, error=None):
+        self.stats.seconds = time.perf_counter() - self._started
+        self.stats.error = error
+        if self.observer is not None:
+            self.observer.on_finish(self.stats)
+
+
+def _instrument(operation, path, observer, progress):
+    """Return an _Instrument for an operation, or None when nobody listens"""
+    if observer is None:
+        observer = DEFAULT_OBSERVER
+    if observer is None and progress is None:
+        return None
+    return _Instrument(operation, path, observer, progress)
+
+
+def _timed(instrument, phase, exclude=()):
+    """Time a block when instrumented, do nothing otherwise"""
+    if instrument is None:
+        return contextlib.nullcontext()
+    return instrument.timed(phase, exclude)
+
+
+class _ZlibCodec:
+    """gzip backend built on the standard zlib module or a module with the same API"""
+    
+    def __init__(self, name, zlib_module, gzip_file, max_level=9):
+        """
+        Args:
+            name (str): Backend name, as accepted by set_codec()
+            zlib_module: Module with zlib's decompressobj/compressobj/crc32 functions
+            gzip_file: gzip.GzipFile-compatible class, for single-threaded writes
+            max_level (int): Highest compression level the module supports
+        """
+        self.name = name
+        self.zlib = zlib_module
+        self.gzip_file = gzip_file
+        self.max_level = max_level
+    
+    def level(self, compresslevel):
+        """Map a zlib compression level (1-9) to this backend's scale"""
+        if self.max_level == 9:
+            return compresslevel
+        return min(self.max_level, compresslevel * (self.max_level + 1) // 10)
+    
+    def decompressobj(self):
+        return self.zlib.decompressobj(16 + zlib.MAX_WBITS)
+    
+    def open_reader(self, raw, keep_windows=False, instrument=None):
+        return _GzipReader(raw, keep_windows=keep_windows, instrument=instrument, codec=self)
+    
+    def open_writer(self, raw, workers, compresslevel, mtime=None):
+        if workers == 1:
+            # No file name in the header, like the parallel writer
+            return self.gzip_file(filename="", fileobj=raw, mode="wb", compresslevel=self.level(compresslevel),
+                                  mtime=mtime)
+        return ParallelGzipWriter(raw, workers, compresslevel, mtime=mtime, codec=self)
+
+
+class _PigzCodec:
+    """gzip backend running the external pigz program, connected through pipes"""
+    
+    name = "pigz"
+    
+    def __init__(self, executable):
+        self.executable = executable
+    
+    def open_reader(self, raw, keep_windows=False, instrument=None):
+        return _PigzReader(self.executable, raw, instrument)
+    
+    def open_writer(self, raw, workers, compresslevel, mtime=None):
+        # pigz runs with -n, which never stores a name or timestamp
+        return _PigzWriter(self.executable, raw, workers, compresslevel)
+
+
+_STDLIB_CODEC = _ZlibCodec("zlib", zlib, gzip.GzipFile)
+_codec = None
+_codec_lock = threading.Lock()
+
+
+def _load_codec(name):
+    """Return the backend called name, or None if it is not installed"""
+    if name == "zlib":
+        return _STDLIB_CODEC
+    if name == "isal":
+        try:
+            from isal import igzip, isal_zlib
+        except ImportError:
+            return None
+        return _ZlibCodec("isal", isal_zlib, igzip.IGzipFile, max_level=isal_zlib.ISAL_BEST_COMPRESSION)
+    if name == "zlib-ng":
+        try:
+            from zlib_ng import gzip_ng, zlib_ng
+        except ImportError:
+            return None
+        return _ZlibCodec("zlib-ng", zlib_ng, gzip_ng.GzipNGFile)
+    if name == "pigz":
+        executable = shutil.which("pigz")
+        return _PigzCodec(executable) if executable else None
+    raise ValueError(f"Unknown codec: {name} (expected one of {', '.join(CODEC_NAMES)} or auto)")
+
+
+def available_codecs():
+    """
+    List the gzip backends installed on this machine
+    
+    Returns:
+        list: Backend names, fastest in-process ones first
+    """
+    return [name for name in CODEC_NAMES if _load_codec(name) is not None]
+
+
+def get_codec():
+    """
+    Return the gzip backend selected by CODEC
+    
+    Returns:
+        The backend object; its ``name`` attribute tells which one it is
+    """
+    global _codec
+    with _codec_lock:
+        if _codec is None:
+            codec = None
+            if CODEC in CODEC_NAMES:
+                codec = _load_codec(CODEC)
+            elif CODEC != "auto":
+                warnings.warn(f"Unknown codec {CODEC} (expected one of {', '.join(CODEC_NAMES)} or auto), "
+                              f"using auto")
+            for name in CODEC_AUTO_ORDER:
+                if codec is not None:
+                    break
+                codec = _load_codec(name)
+            _codec = codec
+        return _codec
+
+
+def set_codec(name):
+    """
+    Choose the gzip backend used by every operation
+    
+    Args:
+        name (str): "auto" or one of CODEC_NAMES
+        
+    Returns:
+        str: Name of the backend now in use
+        
+    Raises:
+        ValueError: If the name is unknown or the backend is not installed
+    """
+    global CODEC, _codec
+    if name != "auto" and _load_codec(name) is None:
+        raise ValueError(f"Codec {name} is not installed")
+    with _codec_lock:
+        CODEC = name
+        _codec = None
+    return get_codec().name
+
+
+def _inflater():
+    """Return the in-process backend to use for random access (pigz cannot seek)"""
+    codec = get_codec()
+    return codec if isinstance(codec, _ZlibCodec) else _STDLIB_CODEC
+
+
+def _iter_members(tar, instrument=None):
+    """
+    Iterate over the members of a tar archive opened for reading, one at a time
+    
+    Unlike ``tar.getmembers()`` (or a plain ``for member in tar``), this does not
+    keep every TarInfo object around, so memory stays bounded no matter how many
+    entries the archive has.
+    
+    Args:
+        tar (tarfile.TarFile): Archive opened in a reading mode
+        instrument (_Instrument): Records the header parsing time as "tar_parse"
+        
+    Yields:
+        tarfile.TarInfo: Each member of the archive, in archive order
+    """
+    while True:
+        with _timed(instrument, "tar_parse", exclude="decompress"):
+            member = tar.next()
+        if member is None:
+            break
+        # Drop tarfile's member cache, we only ever look at the current entry
+        tar.members = []
+        yield member
+
+
+def _member_type(member):
+    """Return a short type label for a tar member"""
+    if member.isfile():
+        return "file"
+    if member.isdir():
+        return "directory"
+    if member.issym():
+        return "symlink"
+    if member.islnk():
+        return "hardlink"
+    return "other"
+
+
+def _size_type(name):
+    """Return the label used to group member sizes (the lower-cased file extension)"""
+    extension = os.path.splitext(name)[1].lower()
+    return extension if extension else "(none)"
+
+
+class _GzipReader:
+    """
+    Read-only file object that decompresses a gzip file, one chunk at a time
+    
+    Besides decompressing, the reader keeps track of how much compressed
+    input it has consumed and records seek checkpoints: pairs of
+    (compressed offset, uncompressed offset) at gzip member boundaries, at
+    most one every ``span`` uncompressed bytes. Decompression can restart
+    from any checkpoint without reading what comes before it. A file written
+    by ParallelGzipWriter has a member boundary every block; a file written
+    by a single-stream compressor only has the checkpoint at offset 0.
+    
+    With keep_windows, the reader also snapshots the decompressor itself
+    (its state and 32 KB window) every ``span`` bytes inside a member. Those
+    snapshots allow restarting in the middle of a single-stream archive, but
+    only live in memory: zlib offers no way to save them to disk.
+    """
+    
+    def __init__(self, fileobj, span=None, keep_windows=False, decompressor=None, chunk_size=STREAM_BUFSIZE,
+                 instrument=None, codec=None):
+        """
+        Args:
+            fileobj: Binary file object positioned at the start of a gzip member,
+                or at the point where ``decompressor`` stopped reading
+            span (int): Minimum uncompressed distance between two checkpoints
+                (None uses CHECKPOINT_SPAN)
+            keep_windows (bool): Record in-memory decompressor snapshots in ``windows``
+            decompressor: zlib decompressor to resume from instead of starting a new member
+            chunk_size (int): Amount of compressed input read, and of output produced, per step
+            instrument (_Instrument): Records the time spent decompressing as "decompress"
+            codec (_ZlibCodec): Backend starting each gzip member (None uses the
+                selected in-process backend)
+        """
+        self.fileobj = fileobj
+        self.codec = codec if codec is not None else _inflater()
+        self.span = CHECKPOINT_SPAN if span is None else span
+        self.checkpoints = [(0, 0)]
+        self.windows = [] if keep_windows else None
+        self.compressed_pos = 0
+        self.chunk_size = chunk_size
+        self.instrument = instrument
+        
+        self._start = fileobj.tell() if hasattr(fileobj, "tell") else 0
+        self._window_span = self.span
+        self._produced = 0
+        self._input = b""
+        self._output = bytearray()
+        self._decompressor = decompressor
+        self._eof = False
+    
+    @property
+    def uncompressed_pos(self):
+        """Number of uncompressed bytes produced so far"""
+        return self._produced
+    
+    def readable(self):
+        return True
+    
+    def read(self, size=-1):
+        while not self._eof and (size is None or size < 0 or len(self._output) < size):
+            if self.instrument is None:
+                self._fill()
+            else:
+                start = time.perf_counter()
+                self._fill()
+                self.instrument.add_phase("decompress", time.perf_counter() - start)
+        
+        if size is None or size < 0 or size >= len(self._output):
+            data = bytes(self._output)
+            self._output = bytearray()
+        else:
+            data = bytes(self._output[:size])
+            del self._output[:size]
+        return data
+    
+    def skip(self, size):
+        """Decompress and discard ``size`` bytes, without keeping them in memory"""
+        while size > 0:
+            chunk = self.read(min(size, STREAM_BUFSIZE))
+            if not chunk:
+                raise EOFError("Compressed file ended before the requested offset")
+            size -= len(chunk)
+    
+    def _fill(self):
+        if not self._input:
+            self._input = self.fileobj.read(self.chunk_size)
+            self.compressed_pos += len(self._input)
+            if not self._input:
+                if self._decompressor is not None:
+                    raise EOFError("Compressed file ended before the end-of-stream marker was reached")
+                self._eof = True
+                return
+        
+        if self._decompressor is None:
+            # Between two members: skip zero padding and start the next one
+            self._input = self._input.lstrip(b"\x00")
+            if not self._input:
+                return
+            if self._produced - self.checkpoints[-1][1] >= self.span:
+                start = self._start + self.compressed_pos - len(self._input)
+                self.checkpoints.append((start, self._produced))
+            self._decompressor = self.codec.decompressobj()
+        
+        data = self._decompressor.decompress(self._input, self.chunk_size)
+        self._produced += len(data)
+        self._output += data
+        
+        if self._decompressor.eof:
+            self._input = self._decompressor.unused_data
+            self._decompressor = None
+        else:
+            self._input = self._decompressor.unconsumed_tail
+            # Not every backend can copy its decompressor (isal cannot)
+            if self.windows is not None and hasattr(self._decompressor, "copy"):
+                self._snapshot_window()
+    
+    def close(self):
+        self._input = b""
+        self._output = bytearray()
+    
+    def _snapshot_window(self):
+        last = self.windows[-1][1] if self.windows else 0
+        if self._produced - last < self._window_span:
+            return
+        
+        start = self._start + self.compressed_pos - len(self._input)
+        self.windows.append((start, self._produced, self._decompressor.copy()))
+        if len(self.windows) > MAX_WINDOW_SNAPSHOTS:
+            # Thin out instead of growing without bound on huge archives
+            self.windows = self.windows[1::2]
+            self._window_span *= 2
+
+
+class _PigzReader:
+    """
+    Read-only file object reading the output of a ``pigz -d`` process
+    
+    pigz reads the archive straight from the file descriptor, which it shares
+    with this process, so the compressed position is the descriptor's offset.
+    pigz cannot resume in the middle of a file, so no checkpoint is recorded
+    besides the start of the archive.
+    """
+    
+    def __init__(self, executable, fileobj, instrument=None):
+        self.fileobj = fileobj
+        self.instrument = instrument
+        self.checkpoints = [(0, 0)]
+        self.windows = None
+        self._start = os.lseek(fileobj.fileno(), 0, os.SEEK_CUR)
+        self._produced = 0
+        self._process = subprocess.Popen([executable, "-d", "-c"], stdin=fileobj, stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE, bufsize=STREAM_BUFSIZE)
+    
+    @property
+    def compressed_pos(self):
+        """Number of compressed bytes pigz has read so far"""
+        return os.lseek(self.fileobj.fileno(), 0, os.SEEK_CUR) - self._start
+    
+    @property
+    def uncompressed_pos(self):
+        return self._produced
+    
+    def readable(self):
+        return True
+    
+    def read(self, size=-1):
+        with _timed(self.instrument, "decompress"):
+            data = self._process.stdout.read(-1 if size is None else size)
+        self._produced += len(data)
+        
+        if size is None or size < 0 or len(data) < size:
+            # End of output: make sure pigz got there without an error
+            if self._process.wait() != 0:
+                message = self._process.stderr.read().decode(errors="replace").strip()
+                raise OSError(f"pigz failed: {message or self._process.returncode}")
+        return data
+    
+    def close(self):
+        if self._process.poll() is None:
+            # tarfile stops at the end-of-archive marker, pigz may still be writing padding
+            self._process.kill()
+        self._process.wait()
+        self._process.stdout.close()
+        self._process.stderr.close()
+
+
+class _PigzWriter:
+    """Write-only file object compressing its input in a ``pigz`` process"""
+    
+    def __init__(self, executable, fileobj, workers=None, compresslevel=9):
+        """
+        Args:
+            executable (str): Path to pigz
+            fileobj: Binary file the compressed stream is written to
+            workers (int): Number of compression threads (None lets pigz use every CPU)
+            compresslevel (int): gzip compression level (1-9)
+        """
+        command = [executable, "-c", "-n", f"-{compresslevel}"]
+        if workers:
+            command += ["-p", str(workers)]
+        fileobj.flush()
+        self.closed = False
+        self._written = 0
+        self._process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=fileobj, stderr=subprocess.PIPE)
+    
+    def writable(self):
+        return True
+    
+    def tell(self):
+        """Return the number of uncompressed bytes written so far"""
+        return self._written
+    
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed file")
+        self._process.stdin.write(data)
+        self._written += len(data)
+        return len(data)
+    
+    def flush(self):
+        pass
+    
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        
+        try:
+            self._process.stdin.close()
+        finally:
+            message = self._process.stderr.read().decode(errors="replace").strip()
+            self._process.stderr.close()
+            if self._process.wait() != 0:
+                raise OSError(f"pigz failed: {message or self._process.returncode}")
+
+
+@contextlib.contextmanager
+def _open_archive_stream(mbz_file_path, keep_windows=False, instrument=None, codec=None):
+    """
+    Open an MBZ file for a single sequential pass over its members
+    
+    Args:
+        mbz_file_path (str): Path to the MBZ file
+        keep_windows (bool): Record in-memory decompressor snapshots
+        instrument (_Instrument): Receives the decompression time and byte counts
+        codec: Backend to read with (None uses the selected one)
+        
+    Yields:
+        tuple: (tarfile.TarFile opened in stream mode, reader of the selected codec feeding it)
+    """
+    with open(mbz_file_path, "rb") as raw:
+        codec = codec if codec is not None else get_codec()
+        reader = codec.open_reader(raw, keep_windows=keep_windows, instrument=instrument)
+        with contextlib.closing(reader):
+            with tarfile.open(fileobj=reader, mode="r|", bufsize=STREAM_BUFSIZE) as tar:
+                yield tar, reader
+        if instrument is not None:
+            instrument.stats.compressed_bytes += reader.compressed_pos
+            instrument.stats.uncompressed_bytes += reader.uncompressed_pos
+
+
+def _scan_archive(mbz_file_path, max_members=None, build_index=False, instrument=None, visit=None, rows=None):
+    """
+    Read an MBZ file once, computing its statistics and optionally its index
+    
+    Args:
+        mbz_file_path (str): Path to the MBZ file
+        max_members (int): Stop after this many entries (None reads everything)
+        build_index (bool): Also collect the member table and seek checkpoints
+        instrument (_Instrument): Receives member events, progress and timings
+        visit (callable): Called as visit(tar, member) for every member, while
+            its data can still be read with tar.extractfile()
+        rows (file): With build_index, text file the member table is written to
+            as it is read, one JSON row per member, instead of being kept in
+            memory; the index then has no "members"
+        
+    Returns:
+        tuple: (summary dict, index dict or None)
+    """
+    contents = []
+    top_level = set()
+    xml_count = 0
+    total = 0
+    total_size = 0
+    type_counts = {}
+    size_by_type = {}
+    truncated = False
+    columns = {column: [] for column in INDEX_COLUMNS} if build_index and rows is None else None
+    archive_size = os.path.getsize(mbz_file_path)
+    
+    # An index needs seek checkpoints, which only the in-process backends record
+    codec = _inflater() if build_index else None
+    with _open_archive_stream(mbz_file_path, build_index, instrument, codec) as (tar, reader):
+        for member in _iter_members(tar, instrument):
+            if instrument is not None:
+                instrument.progress(reader.compressed_pos, archive_size)
+            if max_members is not None and total >= max_members:
+                truncated = True
+                break
+            
+            total += 1
+            if instrument is not None:
+                instrument.member(member.name, member.size)
+            if len(contents) < CONTENTS_SAMPLE_SIZE:
+                contents.append(member.name)
+            
+            # Count top-level items and XML files
+            if '/' not in member.name:
+                top_level.add(member.name)
+            elif member.name.endswith('.xml'):
+                xml_count += 1
+            
+            member_type = _member_type(member)
+            type_counts[member_type] = type_counts.get(member_type, 0) + 1
+            if member.isfile():
+                total_size += member.size
+                size_type = _size_type(member.name)
+                size_by_type[size_type] = size_by_type.get(size_type, 0) + member.size
+            
+            if rows is not None:
+                rows.write(json.dumps([member.name, member_type, member.size, int(member.mtime), member.mode,
+                                       member.offset, member.offset_data], separators=(",", ":")) + "\n")
+            elif columns is not None:
+                columns["name"].append(member.name)
+                columns["type"].append(member_type)
+                columns["size"].append(member.size)
+                columns["mtime"].append(int(member.mtime))
+                columns["mode"].append(member.mode)
+                columns["offset"].append(member.offset)
+                columns["offset_data"].append(member.offset_data)
+            
+            if visit is not None:
+                visit(tar, member)
+        
+        if instrument is not None:
+            instrument.progress(archive_size, archive_size)
+        checkpoints = reader.checkpoints
+        if build_index and not truncated:
+            _remember_windows(mbz_file_path, reader.windows or [])
+    
+    summary = {
+        "is_valid": True,
+        "contents": contents,
+        "top_level_items": len(top_level),
+        "xml_files": xml_count,
+        "total_files": total,
+        "total_size": total_size,
+        "type_counts": type_counts,
+        "size_by_type": size_by_type,
+        "truncated": truncated
+    }
+    
+    index = None
+    if build_index:
+        index = {
+            "version": INDEX_VERSION,
+            "summary": summary,
+            "checkpoints": [list(checkpoint) for checkpoint in checkpoints],
+            "members": columns
+        }
+    
+    return summary, index
+
+
+# In-memory decompressor snapshots of recently indexed archives, by cache key
+_window_snapshots = OrderedDict()
+_window_lock = threading.Lock()
+
+
+def _remember_windows(mbz_file_path, windows):
+    """Keep the decompressor snapshots of an archive, dropping the oldest archives"""
+    with _window_lock:
+        _window_snapshots[_index_cache_key(mbz_file_path)] = windows
+        _window_snapshots.move_to_end(_index_cache_key(mbz_file_path))
+        while len(_window_snapshots) > WINDOW_CACHE_ARCHIVES:
+            _window_snapshots.popitem(last=False)
+
+
+def _recall_windows(mbz_file_path):
+    """Return the decompressor snapshots of an archive (empty if it was not indexed here)"""
+    with _window_lock:
+        return _window_snapshots.get(_index_cache_key(mbz_file_path), [])
+
+
+def _index_cache_enabled(use_cache):
+    """Resolve a per-call use_cache argument against the global setting"""
+    return INDEX_CACHE_ENABLED if use_cache is None else use_cache
+
+
+def _index_cache_key(mbz_file_path):
+    """Return the cache key of an archive: a hash of its path, size and modification time"""
+    stat = os.stat(mbz_file_path)
+    identity = f"{os.path.abspath(mbz_file_path)}|{stat.st_size}|{stat.st_mtime_ns}"
+    return hashlib.sha1(identity.encode("utf-8")).hexdigest()
+
+
+def _index_cache_paths(key):
+    """Return the (metadata, member table) sidecar paths for a cache key"""
+    return (os.path.join(INDEX_CACHE_DIR, key + ".meta.json"),
+            os.path.join(INDEX_CACHE_DIR, key + ".members.jsonl"))
+
+
+def _write_json_atomic(path, data):
+    """Write a JSON file through a temporary file, so readers never see half of it"""
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(temp_path, path)
+
+
+def _load_cached_summary(mbz_file_path):
+    """Return the cached index metadata (summary and checkpoints) of an archive, or None"""
+    meta_path, _ = _index_cache_paths(_index_cache_key(mbz_file_path))
+    try:
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        # Mark the entry as recently used for the LRU eviction
+        os.utime(meta_path)
+    except (OSError, ValueError):
+        return None
+    
+    return meta if meta.get("version") == INDEX_VERSION else None
+
+
+def _write_index_rows(path, columns):
+    """Write a member table as one JSON row per line, through a temporary file"""
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        for row in zip(*(columns[column] for column in INDEX_COLUMNS)):
+            f.write(json.dumps(row, separators=(",", ":")) + "\n")
+    os.replace(temp_path, path)
+
+
+@contextlib.contextmanager
+def _index_rows_file():
+    """
+    Open a temporary file in the cache folder for _scan_archive() to write the member table to
+    
+    Yields:
+        tuple: (text file, its path), or (None, None) if the cache folder is not
+            writable. The file is deleted on exit unless _save_cached_index() took it
+    """
+    path = os.path.join(INDEX_CACHE_DIR, f"rows.{os.getpid()}.{threading.get_ident()}.tmp")
+    rows = None
+    try:
+        os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+        rows = open(path, "w", encoding="utf-8")
+    except OSError:
+        pass
+    if rows is None:
+        yield None, None
+        return
+    
+    try:
+        with rows:
+            yield rows, path
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _save_cached_index(mbz_file_path, index, rows_path=None):
+    """
+    Store an archive index in the cache, then evict old entries
+    
+    Args:
+        mbz_file_path (str): Path to the MBZ file
+        index (dict): Archive index from _scan_archive()
+        rows_path (str): Closed file from _index_rows_file() already holding the
+            member table, moved into the cache instead of writing index["members"]
+    """
+    meta_path, members_path = _index_cache_paths(_index_cache_key(mbz_file_path))
+    meta = {key: value for key, value in index.items() if key != "members"}
+    meta["path"] = os.path.abspath(mbz_file_path)
+    
+    try:
+        os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+        # Member table first: a metadata file always has its members next to it
+        if rows_path is not None:
+            os.replace(rows_path, members_path)
+        else:
+            _write_index_rows(members_path, index["members"])
+        _write_json_atomic(meta_path, meta)
+        _prune_index_cache()
+    except OSError:
+        # The cache is only an accelerator, never fail an operation because of it
+        pass
+
+
+def _prune_index_cache():
+    """Delete the least recently used cache entries until the cache fits INDEX_CACHE_MAX_BYTES"""
+    entries = []
+    total = 0
+    for entry in os.scandir(INDEX_CACHE_DIR):
+        if not entry.name.endswith(".meta.json"):
+            continue
+        key = entry.name[:-len(".meta.json")]
+        _, members_path = _index_cache_paths(key)
+        try:
+            stat = entry.stat()
+            size = stat.st_size + os.path.getsize(members_path)
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, size, key))
+        total += size
+    
+    for last_used, size, key in sorted(entries):
+        if total <= INDEX_CACHE_MAX_BYTES:
+            break
+        _remove_index_cache_entry(key)
+        total -= size
+
+
+def _remove_index_cache_entry(key):
+    """Delete the sidecar files of a cache key"""
+    for path in _index_cache_paths(key):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _scan_archive_to_cache(mbz_file_path, instrument=None, visit=None):
+    """
+    Read an MBZ file once like _scan_archive(), storing its index in the cache
+    
+    The member table is written to the cache file as members are read, so
+    memory does not grow with their number. Without a writable cache folder
+    only the summary is computed.
+    
+    Returns:
+        dict: Summary of the archive
+    """
+    with _index_rows_file() as (rows, rows_path):
+        summary, index = _scan_archive(mbz_file_path, build_index=rows is not None, instrument=instrument,
+                                       visit=visit, rows=rows)
+        if index is not None:
+            rows.close()
+            _save_cached_index(mbz_file_path, index, rows_path)
+    return summary
+
+
+def _has_seek_points(mbz_file_path, index):
+    """Tell whether single members of an indexed archive can be read without decompressing from the start"""
+    return len(index["checkpoints"]) > 1 or bool(_recall_windows(mbz_file_path))
+
+
+def _load_cached_index(mbz_file_path):
+    """Return the complete cached index of an archive (summary, checkpoints and members), or None"""
+    meta = _load_cached_summary(mbz_file_path)
+    if meta is None:
+        return None
+    
+    _, members_path = _index_cache_paths(_index_cache_key(mbz_file_path))
+    columns = {column: [] for column in INDEX_COLUMNS}
+    appends = [columns[column].append for column in INDEX_COLUMNS]
+    try:
+        with open(members_path, encoding="utf-8") as f:
+            for line in f:
+                for append, value in zip(appends, json.loads(line)):
+                    append(value)
+    except (OSError, ValueError):
+        return None
+    meta["members"] = columns
+    return meta
+
+
+def get_index(mbz_file_path, use_cache=None, progress=None, observer=None):
+    """
+    Return the member index of an MBZ file, from the cache when possible
+    
+    The index holds the analysis summary, the gzip seek checkpoints and a
+    member table with one column per field (name, type, size, mtime, mode,
+    header offset and data offset in the uncompressed tar stream).
+    
+    Args:
+        mbz_file_path (str): Path to the MBZ file
+        use_cache (bool): Read and write the on-disk index cache
+            (None follows INDEX_CACHE_ENABLED)
+        progress (callable): Called as progress(bytes_done, bytes_total, files_done)
+            while the archive is read; it may raise OperationCancelled to stop
+        observer (Observer): Receives member events, phase timings and final stats
+        
+    Returns:
+        dict: Archive index
+    """
+    if _index_cache_enabled(use_cache):
+        index = _load_cached_index(mbz_file_path)
+        if index is not None:
+            return index
+    
+    instrument = _instrument("index", mbz_file_path, observer, progress)
+    try:
+        _, index = _scan_archive(mbz_file_path, build_index=True, instrument=instrument)
+    except Exception as e:
+        if instrument is not None:
+            instrument.finish(str(e))
+        raise
+    if instrument is not None:
+        instrument.finish()
+    
+    if _index_cache_enabled(use_cache):
+        _save_cached_index(mbz_file_path, index)
+    return index
+
+
+def query_index(index, pattern=None, sort_by="name", descending=False):
+    """
+    Filter and sort the members of an archive index without reading the archive
+    
+    Only row numbers are returned, so a caller can page through a very large
+    archive and look up the columns of the rows it actually shows.
+    
+    Args:
+        index (dict): Archive index from get_index()
+        pattern (str): Glob pattern (when it holds *, ? or [) matched against the
+            whole member name, or a case-insensitive substring (None keeps everything)
+        sort_by (str): Column to sort on ("name", "type", "size" or "mtime");
+            ties are ordered by name
+        descending (bool): Reverse the sort order
+        
+    Returns:
+        list: Row numbers into index["members"]
+    """
+    members = index["members"]
+    names = members["name"]
+    
+    if not pattern:
+        rows = list(range(len(names)))
+    elif any(char in pattern for char in "*?["):
+        rows = [row for row, name in enumerate(names) if fnmatch.fnmatchcase(name, pattern)]
+    else:
+        wanted = pattern.lower()
+        rows = [row for row, name in enumerate(names) if wanted in name.lower()]
+    
+    if sort_by not in ("name", "type", "size", "mtime"):
+        raise ValueError(f"Cannot sort on {sort_by}")
+    
+    # Two stable sorts: by name first, then by the requested column
+    rows.sort(key=names.__getitem__, reverse=descending)
+    if sort_by != "name":
+        rows.sort(key=members[sort_by].__getitem__, reverse=descending)
+    return rows
+
+
+def invalidate_index_cache(mbz_file_path=None):
+    """
+    Remove cached indexes
+    
+    Args:
+        mbz_file_path (str): Only remove the entries of this archive, whatever
+            its size or modification time was when indexed (None clears the cache)
+        
+    Returns:
+        int: Number of entries removed
+    """
+    if not os.path.isdir(INDEX_CACHE_DIR):
+        return 0
+    
+    target = os.path.abspath(mbz_file_path) if mbz_file_path else None
+    removed = 0
+    for entry in os.scandir(INDEX_CACHE_DIR):
+        if not entry.name.endswith(".meta.json"):
+            continue
+        key = entry.name[:-len(".meta.json")]
+        if target is not None:
+            try:
+                with open(entry.path, encoding="utf-8") as f:
+                    if json.load(f).get("path") != target:
+                        continue
+            except (OSError, ValueError):
+                pass
+        _remove_index_cache_entry(key)
+        removed += 1
+    
+    return removed
+
+
+def analyze_mbz(mbz_file_path, max_members=None, use_cache=None, progress=None, observer=None):
+    """
+    Analyze an MBZ file and return information about its structure
+    
+    The archive is read in a single streaming pass. A full analysis also
+    writes the archive index to the on-disk cache, so analyzing the same
+    unchanged file again does not read the archive at all. The member table
+    goes to the cache file as members are read, never into memory.
+    
+    Args:
+        mbz_file_path (str): Path to the MBZ file
+        max_members (int): Stop after this many entries for a quick preview
+            (None analyzes the whole archive)
+        use_cache (bool): Use the on-disk index cache (None follows INDEX_CACHE_ENABLED)
+        progress (callable): Called as progress(bytes_done, bytes_total, files_done)
+            while the archive is read; it may raise OperationCancelled to stop
+        observer (Observer): Receives member events, phase timings and final stats
+        
+    Returns:
+        dict: Dictionary with information about the MBZ file
+    """
+    info = {
+        "file_size": os.path.getsize(mbz_file_path),
+        "file_name": os.path.basename(mbz_file_path),
+        "is_valid": False,
+        "contents": [],
+        "top_level_items": 0,
+        "xml_files": 0
+    }
+    
+    instrument = _instrument("analyze", mbz_file_path, observer, progress)
+    
+    try:
+        meta = None
+        if max_members is None and _index_cache_enabled(use_cache):
+            meta = _load_cached_summary(mbz_file_path)
+        
+        if meta is not None:
+            info.update(meta["summary"])
+            info["cached"] = True
+        elif max_members is None and _index_cache_enabled(use_cache):
+            info.update(_scan_archive_to_cache(mbz_file_path, instrument))
+            info["cached"] = False
+        else:
+            summary, _ = _scan_archive(mbz_file_path, max_members, instrument=instrument)
+            info.update(summary)
+            info["cached"] = False
+            
+    except Exception as e:
+        info["error"] = str(e)
+    
+    if instrument is not None:
+        instrument.finish(info.get("error"))
+        
+    return info
+
+
+class _ByteBudget:
+    """
+    Counting semaphore measured in bytes
+    
+    Used for back-pressure between a reading thread and writer threads: the
+    reader acquires the size of each buffer before handing it over and the
+    writer releases it once the data is on disk.
+    """
+    
+    def __init__(self, limit):
+        self.limit = limit
+        self._used = 0
+        self._condition = threading.Condition()
+    
+    def acquire(self, amount):
+        with self._condition:
+            # An item bigger than the whole budget is let through on its own
+            while self._used and self._used + amount > self.limit:
+                self._condition.wait()
+            self._used += amount
+    
+    def release(self, amount):
+        with self._condition:
+            self._used -= amount
+            self._condition.notify_all()
+
+
+def _member_path(extract_dir, name):
+    """
+    Return where an archive member should be written
+    
+    Args:
+        extract_dir (str): Extraction directory
+        name (str): Member name from the archive
+        
+    Returns:
+        str: Target path inside extract_dir, or None for the archive root ("./")
+        
+    Raises:
+        ValueError: If the name is absolute or escapes the extraction directory
+    """
+    normalized = name.replace("\\", "/")
+    if normalized.startswith("/") or os.path.splitdrive(normalized)[0]:
+        raise ValueError(f"Unsafe path in archive: {name}")
+    
+    parts = [part for part in normalized.split("/") if part not in ("", ".")]
+    if ".." in parts:
+        raise ValueError(f"Unsafe path in archive: {name}")
+    if not parts:
+        return None
+    
+    return os.path.join(extract_dir, *parts)
+
+
+def _normalize_name(name):
+    """Return a member name without "./" prefixes, duplicate or trailing slashes"""
+    return "/".join(part for part in name.replace("\\", "/").split("/") if part not in ("", "."))
+
+
+def _file_sha1(path):
+    """Return the SHA-1 hex digest of a file's contents"""
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(COPY_BUFSIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _make_dirs(path, created_dirs):
+    """Create a directory (and its parents) unless it was already created"""
+    if path not in created_dirs:
+        os.makedirs(path, exist_ok=True)
+        created_dirs.add(path)
+
+
+def _apply_metadata(path, member):
+    """Copy permissions and modification time from a tar member to a path"""
+    try:
+        os.chmod(path, member.mode & 0o777)
+        os.utime(path, (member.mtime, member.mtime))
+    except OSError:
+        # Metadata is non-critical, some filesystems do not support it
+        pass
+
+
+def _manifest_entry(member, digest):
+    """Return the manifest record for an extracted file member"""
+    return {"size": member.size, "mtime": int(member.mtime), "sha1": digest}
+
+
+def _write_member_data(path, data, member, budget, manifest, instrument):
+    """Write a member's data on a writer thread and release its share of the budget"""
+    try:
+        with _timed(instrument, "file_write"):
+            with open(path, "wb") as f:
+                f.write(data)
+            _apply_metadata(path, member)
+        manifest[_normalize_name(member.name)] = _manifest_entry(member, hashlib.sha1(data).hexdigest())
+    finally:
+        budget.release(len(data))
+
+
+def _copy_member_data(path, source, member, manifest, instrument):
+    """Copy a large member to disk in chunks, hashing it on the way"""
+    digest = hashlib.sha1()
+    with _timed(instrument, "file_write", exclude="decompress"):
+        with open(path, "wb") as f:
+            for chunk in iter(lambda: source.read(COPY_BUFSIZE), b""):
+                digest.update(chunk)
+                f.write(chunk)
+        _apply_metadata(path, member)
+    manifest[_normalize_name(member.name)] = _manifest_entry(member, digest.hexdigest())
+
+
+def _create_link(extract_dir, path, member):
+    """Create a symbolic or hard link member, refusing targets outside extract_dir"""
+    if os.path.isabs(member.linkname):
+        raise ValueError(f"Unsafe link in archive: {member.name} -> {member.linkname}")
+    
+    if member.issym():
+        target_name = posixpath.normpath(posixpath.join(posixpath.dirname(member.name), member.linkname))
+    else:
+        target_name = member.linkname
+    target = _member_path(extract_dir, target_name)
+    if target is None:
+        raise ValueError(f"Unsafe link in archive: {member.name} -> {member.linkname}")
+    
+    if os.path.lexists(path):
+        os.remove(path)
+    
+    if member.issym():
+        os.symlink(member.linkname, path)
+    else:
+        try:
+            os.link(target, path)
+        except OSError:
+            shutil.copy2(target, path)
+
+
+def _reflink(source, target):
+    """Clone source into target without copying its data; False where unsupported"""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+    
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+            return True
+        except OSError:
+            return False
+
+
+class _BlobStore:
+    """
+    Content-addressed store shared by the extractions of many backups
+    
+    Layout of the store folder:
+    
+    - objects/<2 hex digits>/<SHA-1>: one file per distinct content
+    - refs/<hash of a folder path>.json: the objects an extracted folder uses,
+      which gc_store() counts to know which objects are still needed
+    """
+    
+    def __init__(self, root, link_mode="reflink"):
+        if link_mode not in STORE_LINK_MODES:
+            raise ValueError(f"Unknown link mode: {link_mode} (expected one of {', '.join(STORE_LINK_MODES)})")
+        self.root = os.path.abspath(root)
+        self.link_mode = link_mode
+        self.digests = set()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(self.root, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(self.root, "refs"), exist_ok=True)
+    
+    @staticmethod
+    def blob_digest(name):
+        """Return the SHA-1 a file pool member is named after, or None for other members"""
+        match = _BLOB_NAME.search(_normalize_name(name))
+        return match.group(2) if match else None
+    
+    def object_path(self, digest):
+        return os.path.join(self.root, "objects", digest[:2], digest)
+    
+    def has(self, digest, size):
+        try:
+            return os.stat(self.object_path(digest)).st_size == size
+        except OSError:
+            return False
+    
+    def add(self, digest, path, member, chunks):
+        """
+        Store a member's data and make its extracted path show it
+        
+        The data is hashed on the way: a member whose contents do not match
+        its name stays out of the store and is written to path as usual.
+        
+        Args:
+            digest (str): SHA-1 the member is named after
+            path (str): Where the member is extracted
+            member (tarfile.TarInfo): Archive member
+            chunks (iterable): The member's data
+            
+        Returns:
+            dict: Manifest record of the member
+        """
+        object_path = self.object_path(digest)
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        temp_path = f"{object_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        
+        actual = hashlib.sha1()
+        with open(temp_path, "wb") as f:
+            for chunk in chunks:
+                actual.update(chunk)
+                f.write(chunk)
+        
+        if actual.hexdigest() != digest:
+            shutil.move(temp_path, path)
+            _apply_metadata(path, member)
+            return _manifest_entry(member, actual.hexdigest())
+        
+        os.utime(temp_path, (member.mtime, member.mtime))
+        # Another extraction may have stored the same object meanwhile, either copy will do
+        os.replace(temp_path, object_path)
+        return self.link(digest, path, member)
+    
+    def link(self, digest, path, member):
+        """
+        Make an extracted path show a stored object, following link_mode
+        
+        Returns:
+            dict: Manifest record of the member
+        """
+        with self._lock:
+            self.digests.add(digest)
+        
+        object_path = self.object_path(digest)
+        entry = _manifest_entry(member, digest)
+        entry["mode"] = member.mode & 0o777
+        entry["stored"] = True
+        
+        # Never write through an older link to the store
+        if os.path.lexists(path):
+            os.remove(path)
+        
+        if self.link_mode == "none":
+            return entry
+        if self.link_mode == "hardlink":
+            try:
+                os.link(object_path, path)
+                # The file is the object: its metadata must not be changed, and
+                # the manifest takes the object's time so repacks see it unchanged
+                entry["mtime"] = int(os.stat(object_path).st_mtime)
+                return entry
+            except OSError:
+                # Store on another filesystem, or one without hard links
+                pass
+        elif self.link_mode == "reflink" and _reflink(object_path, path):
+            _apply_metadata(path, member)
+            return entry
+        
+        shutil.copyfile(object_path, path)
+        _apply_metadata(path, member)
+        return entry
+    
+    def write_ref(self, folder, mbz_file_path):
+        """Record the objects an extracted folder uses"""
+        folder = os.path.abspath(folder)
+        ref_path = os.path.join(self.root, "refs", hashlib.sha1(folder.encode("utf-8")).hexdigest() + ".json")
+        _write_json_atomic(ref_path, {
+            "folder": folder,
+            "source": os.path.abspath(mbz_file_path),
+            "link_mode": self.link_mode,
+            "objects": sorted(self.digests)
+        })
+
+
+def _store_member_data(store, digest, path, data, member, budget, manifest, instrument):
+    """Store a member's data on a writer thread and release its share of the budget"""
+    try:
+        with _timed(instrument, "file_write"):
+            manifest[_normalize_name(member.name)] = store.add(digest, path, member, [data])
+    finally:
+        budget.release(len(data))
+
+
+def _unlink_stored(extract_dir):
+    """
+    Remove the files a previous extraction linked from a store
+    
+    Writing over them would change the shared objects for every other
+    extraction using them.
+    """
+    try:
+        with open(os.path.join(extract_dir, MANIFEST_NAME), encoding="utf-8") as f:
+            members = json.load(f).get("members", {})
+    except (OSError, ValueError):
+        return
+    
+    for name, entry in members.items():
+        if entry.get("stored"):
+            path = _member_path(extract_dir, name)
+            if path is not None and os.path.lexists(path):
+                os.remove(path)
+
+
+def _glob_matches(name, pattern):
+    """Check whether a glob pattern matches a member name or one of the folders above it"""
+    while name:
+        if fnmatch.fnmatchcase(name, pattern):
+            return True
+        name = posixpath.dirname(name)
+    return False
+
+
+class _MemberSelector:
+    """
+    Decide which members a partial extraction keeps
+    
+    The positive selectors (include globs, module types and section ids) are
+    combined with "or"; without any, every member is selected. Exclude globs
+    and xml_only then drop members. Globs and the Moodle selectors match a
+    member or any folder above it, so "activities/quiz_*" selects whole
+    activity folders. Module and section selections also keep the files at the
+    top of the backup (moodle_backup.xml, files.xml, ...) and in course/, which
+    restores and most tools need.
+    
+    Selecting by section needs the section of every activity, read from
+    moodle_backup.xml. Until it is known (activity_sections is None), members
+    of activity folders are undecided: take() keeps them aside and late()
+    lists those selected once learn_sections() was given the manifest.
+    
+    complete tells when nothing more will be selected, so the extraction can
+    stop reading: once every member an index listed (see expect()) was seen,
+    or, without an index, once every file named by include patterns without
+    wildcards was seen (see watch_literals()).
+    """
+    
+    def __init__(self, include=None, exclude=None, modules=None, sections=None, xml_only=False,
+                 activity_sections=None, names=None):
+        """
+        Args:
+            include (list): Glob patterns of members to extract
+            exclude (list): Glob patterns of members to leave out
+            modules (list): Activity types to extract, e.g. ["quiz", "forum"]
+            sections (list): Section ids whose section folder and activities are extracted
+            xml_only (bool): Only extract XML files (and the folders outside files/)
+            activity_sections (dict): Section id of each activity folder name, from
+                moodle_backup.xml (None with sections: learned while extracting)
+            names (list): Exact member names to extract instead of the selectors
+                above; complete once all of them were seen
+        """
+        self.include = [_normalize_name(pattern) for pattern in include or ()]
+        self.exclude = [_normalize_name(pattern) for pattern in exclude or ()]
+        self.modules = set(modules or ())
+        self.sections = {str(section) for section in sections or ()}
+        self.xml_only = xml_only
+        self.activity_sections = activity_sections if activity_sections is not None or self.sections else {}
+        self.names = {_normalize_name(name) for name in names} if names is not None else None
+        self.expected = set(self.names) if names is not None else None
+        self.found = set()
+        self.literals = None
+        self.undecided = []
+        self._index = None
+    
+    @staticmethod
+    def _is_metadata(name):
+        """Check whether a file sits at the top of the backup (possibly under one prefix folder) or in course/"""
+        parent = posixpath.dirname(name)
+        if not parent or ("/" not in parent and parent not in _BACKUP_FOLDERS):
+            return True
+        return _COURSE_FILE.search(name) is not None
+    
+    def _positive(self, name, member_type):
+        if self.names is not None:
+            return name in self.names
+        if not (self.include or self.modules or self.sections):
+            return True
+        if any(_glob_matches(name, pattern) for pattern in self.include):
+            return True
+        
+        activity = _ACTIVITY_DIR.search(name)
+        if activity is not None:
+            if activity.group(2) in self.modules:
+                return True
+            if self.sections and self.activity_sections is None:
+                return None
+            return self.activity_sections.get(activity.group(1)) in self.sections
+        
+        section = _SECTION_DIR.search(name)
+        if section is not None:
+            return section.group(1) in self.sections
+        
+        return bool(self.modules or self.sections) and member_type == "file" and self._is_metadata(name)
+    
+    def selects(self, name, member_type):
+        """Check whether a member is extracted: True, False, or None while its section is unknown"""
+        name = _normalize_name(name)
+        positive = self._positive(name, member_type)
+        if positive is False:
+            return False
+        if any(_glob_matches(name, pattern) for pattern in self.exclude):
+            return False
+        if self.xml_only:
+            if member_type == "directory":
+                if re.search(r"(?:^|/)files(?:/|$)", name) is not None:
+                    return False
+            elif member_type != "file" or not name.lower().endswith(".xml"):
+                return False
+        return positive
+    
+    @property
+    def needs_sections(self):
+        """Whether moodle_backup.xml still has to be read to decide on activity members"""
+        return self.activity_sections is None
+    
+    def learn_sections(self, activity_sections):
+        """Decide on activity members from the sections read in moodle_backup.xml"""
+        self.activity_sections = activity_sections
+        if self._index is not None:
+            self.expect(self._index)
+            # Those already went by, late() returns them
+            self.expected.difference_update(name for name, _ in self.undecided)
+    
+    def late(self):
+        """Return the names of the undecided members that learn_sections() selected"""
+        if self.activity_sections is None:
+            return []
+        return [name for name, member_type in self.undecided if self.selects(name, member_type)]
+    
+    def expect(self, index):
+        """Record the members an index says will be extracted, enabling complete"""
+        if self.needs_sections:
+            # Computed by learn_sections()
+            self._index = index
+            return
+        members = index["members"]
+        self.expected = {_normalize_name(name) for row, name in enumerate(members["name"])
+                         if self.selects(name, members["type"][row])}
+    
+    def watch_literals(self):
+        """Without an index, enable complete when every include pattern is a plain member name"""
+        if self.include and not (self.modules or self.sections) and \
+                not any(char in pattern for pattern in self.include for char in "*?["):
+            self.literals = set(self.include)
+    
+    def take(self, name, member_type):
+        """Like selects(), also counting the member towards complete"""
+        name = _normalize_name(name)
+        if self.literals:
+            if name in self.literals and member_type == "file":
+                self.literals.discard(name)
+            elif (member_type == "directory" and name in self.literals) or \
+                    any(_glob_matches(posixpath.dirname(name), literal) for literal in self.literals):
+                # A folder: any later member could still be in it
+                self.literals = None
+        
+        selected = self.selects(name, member_type)
+        if selected is None:
+            self.undecided.append((name, member_type))
+            return False
+        if not selected:
+            return False
+        if self.expected is not None:
+            self.found.add(name)
+        return True
+    
+    @property
+    def complete(self):
+        if self.expected is not None:
+            return self.found >= self.expected
+        return self.literals is not None and not self.literals
+
+
+def _parse_activity_sections(fileobj):
+    """
+    Read which section each activity belongs to from moodle_backup.xml
+    
+    Returns:
+        dict: Section id (str) keyed by activity folder name, e.g. "quiz_12"
+    """
+    sections = {}
+    for _, element in ElementTree.iterparse(fileobj):
+        # Settings also have <activity> elements, without a directory
+        if element.tag == "activity" and element.find("directory") is not None:
+            folder = posixpath.basename(_normalize_name(element.findtext("directory", "")))
+            sections[folder] = element.findtext("sectionid", "").strip()
+            element.clear()
+    return sections
+
+
+def _activity_sections(mbz_file_path, index):
+    """Read the sections of the activities of an indexed archive, decompressing only moodle_backup.xml"""
+    members = index["members"]
+    for row, name in enumerate(members["name"]):
+        if members["type"][row] == "file" and _BackupValidator.manifest_kind(name) == "backup":
+            return _parse_activity_sections(io.BytesIO(read_member(mbz_file_path, name, index=index)))
+    return {}
+
+
+def _extract_archive(mbz_file_path, extract_dir, workers=None, max_pending_bytes=EXTRACT_MAX_PENDING_BYTES,
+                     instrument=None, store=None, selector=None):
+    """
+    Extract a gzip-compressed tar archive with a pool of writer threads
+    
+    The calling thread decompresses the archive in one sequential pass and
+    hands each file's bytes to the writer pool. At most max_pending_bytes of
+    file data wait for the writers at any time; files larger than a quarter
+    of that are copied straight to disk by the reading thread instead.
+    Directory permissions and times are applied once every file is written.
+    
+    Args:
+        mbz_file_path (str): Path to the MBZ file
+        extract_dir (str): Directory to extract into (must exist)
+        workers (int): Number of writer threads (None picks a default for I/O-bound work)
+        max_pending_bytes (int): Memory bound for data queued for the writers
+        instrument (_Instrument): Receives member events, progress and timings
+        store (_BlobStore): Store receiving the members of the files/ pool
+        selector (_MemberSelector): Members to extract (None extracts everything).
+            The data of the others is decompressed but never written, and
+            reading stops once the selector is complete. moodle_backup.xml is
+            parsed on the way if the selector needs its sections
+        
+    Returns:
+        dict: Manifest of the extracted files, mapping member names to their
+            size, modification time and SHA-1 digest
+        list: Records of the extracted members in archive order (see ExtractResult)
+    """
+    manifest = {}
+    entries = []
+    budget = _ByteBudget(max_pending_bytes)
+    stream_threshold = max(max_pending_bytes // 4, 1)
+    created_dirs = {extract_dir}
+    directories = []
+    links = []
+    pending = deque()
+    archive_size = os.path.getsize(mbz_file_path)
+    
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            with _open_archive_stream(mbz_file_path, instrument=instrument) as (tar, reader):
+                for member in _iter_members(tar, instrument):
+                    if instrument is not None:
+                        instrument.progress(reader.compressed_pos, archive_size)
+                    
+                    member_type = _member_type(member)
+                    data = None
+                    if selector is not None and selector.needs_sections and member.isfile() and \
+                            _BackupValidator.manifest_kind(member.name) == "backup":
+                        # Small, and read once for both the selection and the extraction
+                        data = tar.extractfile(member).read()
+                        selector.learn_sections(_parse_activity_sections(io.BytesIO(data)))
+                    if selector is not None:
+                        if selector.complete:
+                            # Everything requested is out, the rest of the archive is not needed
+                            break
+                        if not selector.take(member.name, member_type):
+                            # The data is skipped when the next header is read
+                            continue
+                    
+                    path = _member_path(extract_dir, member.name)
+                    if path is None:
+                        continue
+                    
+                    if member_type != "other":
+                        # Devices, FIFOs and the like have no place in a backup
+                        entries.append({
+                            "name": _normalize_name(member.name),
+                            "path": path,
+                            "size": member.size,
+                            "type": member_type,
+                            # Hard links land on disk as regular files, as iter_xml_files() sees them
+                            "xml": member_type in ("file", "hardlink") and member.name.endswith(".xml")
+                        })
+                    
+                    if member.isdir():
+                        _make_dirs(path, created_dirs)
+                        directories.append((path, member))
+                        continue
+                    if member.issym() or member.islnk():
+                        _make_dirs(os.path.dirname(path), created_dirs)
+                        links.append((path, member))
+                        continue
+                    if not member.isfile():
+                        continue
+                    
+                    _make_dirs(os.path.dirname(path), created_dirs)
+                    if instrument is not None:
+                        instrument.member(member.name, member.size)
+                    
+                    digest = store.blob_digest(member.name) if store is not None else None
+                    if digest is not None and store.has(digest, member.size):
+                        # Already stored by an earlier extraction: nothing to hash or write
+                        manifest[_normalize_name(member.name)] = store.link(digest, path, member)
+                        continue
+                    
+                    source = tar.extractfile(member) if data is None else io.BytesIO(data)
+                    if digest is not None:
+                        if member.size > stream_threshold:
+                            chunks = iter(lambda: source.read(COPY_BUFSIZE), b"")
+                            manifest[_normalize_name(member.name)] = store.add(digest, path, member, chunks)
+                            continue
+                        data = source.read()
+                        budget.acquire(len(data))
+                        pending.append(executor.submit(_store_member_data, store, digest, path, data, member,
+                                                       budget, manifest, instrument))
+                        continue
+                    
+                    if member.size > stream_threshold:
+                        _copy_member_data(path, source, member, manifest, instrument)
+                        continue
+                    
+                    data = source.read()
+                    budget.acquire(len(data))
+                    pending.append(executor.submit(_write_member_data, path, data, member, budget, manifest,
+                                                   instrument))
+                    
+                    # Surface writer errors early and keep the queue short
+                    while pending and pending[0].done():
+                        pending.popleft().result()
+            
+            while pending:
+                pending.popleft().result()
+            if instrument is not None:
+                instrument.progress(archive_size, archive_size)
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+    
+    for path, member in links:
+        _create_link(extract_dir, path, member)
+    
+    # Deepest directories first, so a read-only parent does not block its children
+    for path, member in sorted(directories, key=lambda item: item[0].count(os.sep), reverse=True):
+        _apply_metadata(path, member)
+    
+    return manifest, entries
+
+
+def _write_manifest(extract_dir, mbz_file_path, members, store=None):
+    """
+    Save the manifest of an extraction next to the extracted files
+    
+    Args:
+        extract_dir (str): Extraction directory
+        mbz_file_path (str): Archive the files were extracted from
+        members (dict): Manifest returned by _extract_archive()
+        store (_BlobStore): Store the files/ pool was extracted into
+    """
+    stat = os.stat(mbz_file_path)
+    manifest = {
+        "version": 1,
+        "source": {
+            "path": os.path.abspath(mbz_file_path),
+            "size": stat.st_size,
+            "mtime": int(stat.st_mtime)
+        },
+        "members": members
+    }
+    if store is not None:
+        manifest["store"] = store.root
+    with open(os.path.join(extract_dir, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+
+
+def _load_manifest(source_dir, reference_mbz):
+    """
+    Load the manifest of an extracted folder if it was made from reference_mbz
+    
+    Args:
+        source_dir (str): Extracted folder
+        reference_mbz (str): Archive the folder is expected to come from
+        
+    Returns:
+        dict: Member records keyed by name, or None if there is no usable manifest
+    """
+    try:
+        with open(os.path.join(source_dir, MANIFEST_NAME), encoding="utf-8") as f:
+            manifest = json.load(f)
+        stat = os.stat(reference_mbz)
+    except (OSError, ValueError):
+        return None
+    
+    source = manifest.get("source", {})
+    if source.get("size") != stat.st_size or source.get("mtime") != int(stat.st_mtime):
+        # The reference archive changed since extraction, its data cannot be trusted
+        return None
+    
+    return manifest.get("members")
+
+
+class ExtractResult(str):
+    """
+    Path of an extracted folder, with the records of what was extracted
+    
+    It is the extraction directory as a plain string, so existing callers keep
+    working, and it also carries what the extractor saw while writing the files,
+    so callers do not have to walk the new folder again:
+    
+    - ``members``: one dict per extracted member, in archive order, with its
+      normalized "name", "path" on disk, "size", "type" ("file", "directory",
+      "symlink" or "hardlink") and an "xml" flag
+    - ``manifest``: size, modification time and SHA-1 digest of every file,
+      keyed by member name (the contents of .mbz_manifest.json)
+    """
+    
+    def __new__(cls, path, members=(), manifest=None):
+        result = super().__new__(cls, path)
+        result.members = list(members)
+        result.manifest = manifest if manifest is not None else {}
+        return result
+    
+    @property
+    def xml_files(self):
+        """Paths of the extracted XML files, in archive order"""
+        return [entry["path"] for entry in self.members if entry["xml"]]
+
+
+def extract_mbz(mbz_file_path, output_dir, open_after=False, workers=None,
+                max_pending_bytes=EXTRACT_MAX_PENDING_BYTES, write_manifest=True, progress=None,
+                observer=None, store=None, link_mode="reflink", include=None, exclude=None, modules=None,
+                sections=None, xml_only=False, stop_early=True, use_cache=None):
+    """
+    Extract an MBZ file to a directory
+    
+    include, exclude, modules, sections and xml_only extract part of the
+    backup. Unselected members are skipped without being written. With
+    stop_early, reading stops after the last selected member: when the
+    archive is in the index cache the members to extract are known in
+    advance, and otherwise reading stops once every file named by include
+    patterns without wildcards was found. For sections, moodle_backup.xml is
+    parsed during the same pass; activity members that came before it in the
+    archive are extracted by a second pass that stops after the last of them.
+    
+    Args:
+        mbz_file_path (str): Path to the MBZ file
+        output_dir (str): Path to the output directory
+        open_after (bool): Whether to open the folder after extraction
+        workers (int): Number of threads writing files to disk
+        max_pending_bytes (int): Maximum amount of decompressed data waiting to be written
+        write_manifest (bool): Save a manifest of the extracted files, which lets
+            create_mbz repack the folder incrementally
+        progress (callable): Called as progress(bytes_done, bytes_total, files_done)
+            while the archive is read; it may raise OperationCancelled to stop
+        observer (Observer): Receives member events, phase timings and final stats
+        store (str): Folder of a content-addressed store shared between
+            extractions. Files of the backup's files/ pool are written there
+            once and put into the extraction folder following link_mode
+        link_mode (str): One of STORE_LINK_MODES, used with store. With "hardlink",
+            editing an extracted pool file in place also changes the stored object
+        include (list): Glob patterns of the members to extract, matched against
+            the member name or any folder above it (e.g. "activities/quiz_*")
+        exclude (list): Glob patterns of members to leave out
+        modules (list): Activity types to extract, e.g. ["quiz"]
+        sections (list): Section ids whose section folder and activities are extracted
+        xml_only (bool): Only extract XML files, skipping the files/ pool
+        stop_early (bool): Stop reading the archive once every selected member
+            is extracted (needs the archive in the index cache, or include
+            patterns without wildcards)
+        use_cache (bool): Use the on-disk index cache for stop_early and sections
+            (None follows INDEX_CACHE_ENABLED)
+        
+    Returns:
+        ExtractResult: Path to the extracted directory (a str carrying the
+            extracted members), or an error message string
+    """
+    instrument = _instrument("extract", mbz_file_path, observer, progress)
+    
+    try:
+        # Create a folder with the same name as the mbz file (without extension)
+        base_name = os.path.basename(mbz_file_path)
+        file_name_without_ext = os.path.splitext(base_name)[0]
+        extract_dir = os.path.join(output_dir, file_name_without_ext)
+        
+        # Create the directory if it doesn't exist
+        os.makedirs(extract_dir, exist_ok=True)
+        _unlink_stored(extract_dir)
+        
+        blob_store = _BlobStore(store, link_mode) if store else None
+        
+        selector = None
+        if include or exclude or modules or sections or xml_only:
+            index = _load_cached_index(mbz_file_path) if _index_cache_enabled(use_cache) else None
+            activity_sections = None
+            if sections and index is not None and _has_seek_points(mbz_file_path, index):
+                activity_sections = _activity_sections(mbz_file_path, index)
+            selector = _MemberSelector(include, exclude, modules, sections, xml_only, activity_sections)
+            if stop_early:
+                if index is not None:
+                    selector.expect(index)
+                else:
+                    selector.watch_literals()
+        
+        # Decompress on this thread, write files on a thread pool
+        manifest, members = _extract_archive(mbz_file_path, extract_dir, workers, max_pending_bytes, instrument,
+                                             blob_store, selector)
+        late = selector.late() if selector is not None else []
+        if late:
+            # Activity members that went by before moodle_backup.xml told their section
+            late_manifest, late_members = _extract_archive(mbz_file_path, extract_dir, workers, max_pending_bytes,
+                                                           instrument, blob_store, _MemberSelector(names=late))
+            manifest.update(late_manifest)
+            members = late_members + members
+        if blob_store is not None:
+            blob_store.write_ref(extract_dir, mbz_file_path)
+        if write_manifest or blob_store is not None:
+            # Without its manifest, a folder extracted with link_mode "none" could not be compressed
+            _write_manifest(extract_dir, mbz_file_path, manifest, blob_store)
+        
+        # Open the folder if requested
+        if open_after:
+            try:
+                # Cross-platform way to open a folder
+                if os.name == 'nt':  # Windows
+                    os.startfile(extract_dir)
+                elif os.name == 'posix':  # macOS, Linux
+                    if os.uname().sysname == 'Darwin':  # macOS
+                        subprocess.call(['open', extract_dir])
+                    else:  # Linux
+                        subprocess.call(['xdg-open', extract_dir])
+            except Exception:
+                # If opening the folder fails, just continue (non-critical)
+                pass
+        
+        if instrument is not None:
+            instrument.finish()
+        return ExtractResult(extract_dir, members, manifest)
+    
+    except Exception as e:
+        if instrument is not None:
+            instrument.finish(str(e))
+        return f"Error: {str(e)}"
+
+
+def _read_ref(ref_path):
+    """Load a store ref, or None if it is unreadable or its folder is gone"""
+    try:
+        with open(ref_path, encoding="utf-8") as f:
+            ref = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return ref if os.path.isdir(ref.get("folder", "")) else None
+
+
+def _store_objects(store):
+    """Yield (digest, path, size) for every object in a store"""
+    objects_dir = os.path.join(store, "objects")
+    for prefix in sorted(os.listdir(objects_dir)) if os.path.isdir(objects_dir) else []:
+        with os.scandir(os.path.join(objects_dir, prefix)) as it:
+            for entry in it:
+                if entry.is_file() and not entry.name.endswith(".tmp"):
+                    yield entry.name, entry.path, entry.stat().st_size
+
+
+def gc_store(store, dry_run=False):
+    """
+    Remove the objects of a store that no extracted folder uses any more
+    
+    Each extraction records the objects it uses in a ref. Refs whose folder
+    was deleted are dropped, then every object no remaining ref lists is
+    removed. An object is kept as long as at least one ref counts it.
+    
+    Args:
+        store (str): Folder of the store
+        dry_run (bool): Only report what would be removed
+        
+    Returns:
+        dict: Numbers of refs kept and removed, objects kept and removed, and
+            bytes freed, or an "error" key
+    """
+    try:
+        refs_dir = os.path.join(store, "refs")
+        counts = {}
+        result = {"refs": 0, "removed_refs": 0, "objects": 0, "removed_objects": 0, "freed_bytes": 0}
+        
+        for name in os.listdir(refs_dir) if os.path.isdir(refs_dir) else []:
+            if not name.endswith(".json"):
+                continue
+            ref = _read_ref(os.path.join(refs_dir, name))
+            if ref is None:
+                result["removed_refs"] += 1
+                if not dry_run:
+                    os.remove(os.path.join(refs_dir, name))
+                continue
+            result["refs"] += 1
+            for digest in ref.get("objects", []):
+                counts[digest] = counts.get(digest, 0) + 1
+        
+        for digest, path, size in _store_objects(store):
+            if counts.get(digest):
+                result["objects"] += 1
+                continue
+            result["removed_objects"] += 1
+            result["freed_bytes"] += size
+            if not dry_run:
+                os.remove(path)
+        
+        return result
+    
+    except Exception as e:
+        return {"error": f"Error: {str(e)}"}
+
+
+def store_stats(store):
+    """
+    Report how much disk space a store saves
+    
+    Args:
+        store (str): Folder of the store
+        
+    Returns:
+        dict: "objects" and "stored_bytes" (what the store holds), "refs"
+            (extracted folders using it), "referenced_bytes" (what those
+            folders would hold without sharing, links counted as copies),
+            "saved_bytes" and "dedup_ratio" (among folders not extracted as
+            copies), and the "unreferenced_objects" and "unreferenced_bytes"
+            gc_store() would free; or an "error" key
+    """
+    try:
+        refs_dir = os.path.join(store, "refs")
+        refs = []
+        for name in os.listdir(refs_dir) if os.path.isdir(refs_dir) else []:
+            ref = _read_ref(os.path.join(refs_dir, name)) if name.endswith(".json") else None
+            if ref is not None:
+                refs.append(ref)
+        
+        sizes = {digest: size for digest, _, size in _store_objects(store)}
+        referenced = set()
+        shared = set()
+        referenced_bytes = 0
+        shared_bytes = 0
+        for ref in refs:
+            objects = ref.get("objects", [])
+            used = sum(sizes.get(digest, 0) for digest in objects)
+            referenced.update(objects)
+            referenced_bytes += used
+            if ref.get("link_mode") != "copy":
+                shared.update(objects)
+                shared_bytes += used
+        
+        stored_bytes = sum(sizes.values())
+        unreferenced = [digest for digest in sizes if digest not in referenced]
+        unreferenced_bytes = sum(sizes[digest] for digest in unreferenced)
+        shared_stored = sum(sizes.get(digest, 0) for digest in shared)
+        return {
+            "objects": len(sizes),
+            "stored_bytes": stored_bytes,
+            "refs": len(refs),
+            "referenced_bytes": referenced_bytes,
+            "saved_bytes": max(shared_bytes - shared_stored, 0),
+            "dedup_ratio": shared_bytes / shared_stored if shared_stored else 0.0,
+            "unreferenced_objects": len(unreferenced),
+            "unreferenced_bytes": unreferenced_bytes
+        }
+    
+    except Exception as e:
+        return {"error": f"Error: {str(e)}"}
+
+
+def _checkpoint_before(mbz_file_path, index, offset):
+    """
+    Find the closest point before an uncompressed offset where decompression can start
+    
+    Args:
+        mbz_file_path (str): Path to the MBZ file
+        index (dict): Archive index from get_index()
+        offset (int): Uncompressed offset the caller wants to reach
+        
+    Returns:
+        tuple: (compressed offset, uncompressed offset, decompressor snapshot or None)
+    """
+    best = (0, 0, None)
+    for compressed, uncompressed in index["checkpoints"]:
+        if best[1] < uncompressed <= offset:
+            best = (compressed, uncompressed, None)
+    for compressed, uncompressed, snapshot in _recall_windows(mbz_file_path):
+        if best[1] < uncompressed <= offset:
+            best = (compressed, uncompressed, snapshot)
+    return best
+
+
+def _open_at(raw, checkpoint):
+    """Start decompressing an opened MBZ file at a checkpoint from _checkpoint_before()"""
+    compressed, _, snapshot = checkpoint
+    raw.seek(compressed)
+    # Copy the snapshot, so the cached one can be reused by later reads
+    decompressor = snapshot.copy() if snapshot is not None else None
+    return _GzipReader(raw, decompressor=decompressor, chunk_size=RANDOM_ACCESS_CHUNK)
+
+
+def _find_member(index, name):
+    """Return the row of a member in an index, raising KeyError if it is missing"""
+    names = index["members"]["name"]
+    try:
+        return names.index(name)
+    except ValueError:
+        pass
+    
+    wanted = _normalize_name(name)
+    for row, member_name in enumerate(names):
+        if _normalize_name(member_name) == wanted:
+            return row
+    raise KeyError(f"{name} not found in archive")
+
+
+def _index_tarinfo(index, row):
+    """Build a TarInfo from a row of an archive index"""
+    members = index["members"]
+    tarinfo = tarfile.TarInfo(members["name"][row])
+    tarinfo.size = members["size"][row]
+    tarinfo.mtime = members["mtime"][row]
+    tarinfo.mode = members["mode"][row]
+    return tarinfo
+
+
+def read_member(mbz_file_path, name, index=None, use_cache=None, max_bytes=None, progress=None):
+    """
+    Read a single file from an MBZ file without extracting the rest
+    
+    Decompression starts at the seek checkpoint closest before the member and
+    stops right after it, so reading e.g. moodle_backup.xml only costs the
+    distance from that checkpoint.
+    
+    Args:
+        mbz_file_path (str): Path to the MBZ file
+        name (str): Member name, e.g. "activities/quiz_123/quiz.xml"
+        index (dict): Archive index from get_index() (loaded or built if None)
+        use_cache (bool): Use the on-disk index cache (None follows INDEX_CACHE_ENABLED)
+        max_bytes (int): Only read the beginning of the member, e.g. for a preview
+            (None reads all of it)
+        progress (callable): Called as progress(bytes_done, bytes_total, files_done)
+            with the uncompressed bytes decompressed from the checkpoint (and while
+            the index is built); it may raise OperationCancelled to stop
+        
+    Returns:
+        bytes: Contents of the member
+        
+    Raises:
+        KeyError: If the archive has no regular file with that name
+    """
+    if index is None:
+        index = get_index(mbz_file_path, use_cache, progress=progress)
+    
+    row = _find_member(index, name)
+    if index["members"]["type"][row] != "file":
+        raise KeyError(f"{name} is not a regular file")
+    
+    offset = index["members"]["offset_data"][row]
+    size = index["members"]["size"][row]
+    if max_bytes is not None:
+        size = min(size, max_bytes)
+    
+    checkpoint = _checkpoint_before(mbz_file_path, index, offset)
+    distance = offset - checkpoint[1]
+    with open(mbz_file_path, "rb") as raw:
+        reader = _open_at(raw, checkpoint)
+        if progress is None:
+            reader.skip(distance)
+            data = reader.read(size)
+        else:
+            # In steps, so a long way from the checkpoint can be cancelled
+            done = 0
+            while done < distance:
+                step = min(READ_PROGRESS_STEP, distance - done)
+                reader.skip(step)
+                done += step
+                progress(done, distance + size, 0)
+            chunks = []
+            while done < distance + size:
+                chunk = reader.read(min(READ_PROGRESS_STEP, distance + size - done))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                done += len(chunk)
+                progress(done, distance + size, 0)
+            data = b"".join(chunks)
+    
+    if len(data) != size:
+        raise EOFError(f"Unexpected end of archive while reading {name}")
+    return data
+
+
+def extract_members(mbz_file_path, names, output_dir, index=None, use_cache=None):
+    """
+    Extract some files from an MBZ file without extracting the rest
+    
+    Members are read in archive order. Between two members, decompression
+    jumps to a later checkpoint when one is available instead of reading
+    everything in between.
+    
+    Args:
+        mbz_file_path (str): Path to the MBZ file
+        names (list): Member names; a directory name selects everything below it
+        output_dir (str): Directory the members are written to, keeping their paths
+        index (dict): Archive index from get_index() (loaded or built if None)
+        use_cache (bool): Use the on-disk index cache (None follows INDEX_CACHE_ENABLED)
+        
+    Returns:
+        list: Paths of the extracted files
+        
+    Raises:
+        KeyError: If a name matches nothing in the archive
+    """
+    if index is None:
+        index = get_index(mbz_file_path, use_cache)
+    members = index["members"]
+    
+    rows = set()
+    for name in names:
+        prefix = _normalize_name(name) + "/"
+        below = [row for row, member_name in enumerate(members["name"])
+                 if _normalize_name(member_name).startswith(prefix) and members["type"][row] == "file"]
+        rows.update(below if below else [_find_member(index, name)])
+    rows = sorted((row for row in rows if members["type"][row] == "file"),
+                  key=lambda row: members["offset_data"][row])
+    
+    os.makedirs(output_dir, exist_ok=True)
+    created_dirs = {output_dir}
+    extracted = []
+    
+    with open(mbz_file_path, "rb") as raw:
+        reader, position = None, 0
+        for row in rows:
+            offset = members["offset_data"][row]
+            size = members["size"][row]
+            
+            # Jump ahead when a checkpoint lies between here and the next member
+            checkpoint = _checkpoint_before(mbz_file_path, index, offset)
+            if reader is None or checkpoint[1] > position:
+                reader = _open_at(raw, checkpoint)
+                position = checkpoint[1]
+            
+            reader.skip(offset - position)
+            path = _member_path(output_dir, members["name"][row])
+            _make_dirs(os.path.dirname(path), created_dirs)
+            
+            with open(path, "wb") as f:
+                remaining = size
+                while remaining:
+                    chunk = reader.read(min(remaining, COPY_BUFSIZE))
+                    if not chunk:
+                        raise EOFError(f"Unexpected end of archive while reading {members['name'][row]}")
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            _apply_metadata(path, _index_tarinfo(index, row))
+            
+            position = offset + size
+            extracted.append(path)
+    
+    return extracted
+
+
+def _gzip_member(data, compresslevel, mtime, codec=_STDLIB_CODEC):
+    """
+    Compress a block of data into a complete, standalone gzip member
+    
+    Args:
+        data (bytes): Uncompressed block
+        compresslevel (int): zlib compression level
+        mtime (int): Timestamp stored in the gzip header
+        codec (_ZlibCodec): Backend doing the compression
+        
+    Returns:
+        bytes: gzip header, raw deflate stream and trailer
+    """
+    if compresslevel == 9:
+        extra_flags = 2
+    elif compresslevel == 1:
+        extra_flags = 4
+    else:
+        extra_flags = 0
+    
+    # ID1, ID2, CM (deflate), FLG (none), MTIME, XFL, OS (unknown)
+    header = struct.pack("<BBBBIBB", 0x1f, 0x8b, 8, 0, mtime, extra_flags, 255)
+    compressor = codec.zlib.compressobj(codec.level(compresslevel), zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+    trailer = struct.pack("<II", codec.zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+    return header + body + trailer
+
+
+class ParallelGzipWriter:
+    """
+    Write-only file object that gzip-compresses its input on several threads
+    
+    The incoming byte stream is cut into fixed-size blocks, each block is
+    deflated independently on a thread pool (zlib releases the GIL while it
+    works) and the results are written in order as consecutive gzip members.
+    A multi-member gzip file is a valid gzip file, so any gzip reader (Python's
+    tarfile, GNU tar, Moodle's restore) decompresses it as one stream.
+    """
+    
+    def __init__(self, fileobj, workers=None, compresslevel=9, block_size=GZIP_BLOCK_SIZE, mtime=None,
+                 codec=None):
+        """
+        Args:
+            fileobj: Binary file object the compressed stream is written to
+            workers (int): Number of compression threads (None uses every CPU)
+            compresslevel (int): zlib compression level (1-9)
+            block_size (int): Size of the uncompressed blocks compressed independently
+            mtime (int): Timestamp for the gzip headers (None uses the current time)
+            codec (_ZlibCodec): Backend doing the compression (None uses the
+                selected in-process backend)
+        """
+        self.fileobj = fileobj
+        self.codec = codec if codec is not None else _inflater()
+        self.workers = workers or os.cpu_count() or 1
+        self.compresslevel = compresslevel
+        self.block_size = block_size
+        self.mtime = int(time.time()) if mtime is None else int(mtime)
+        self.closed = False
+        
+        self._buffer = bytearray()
+        self._written = 0
+        self._pending = deque()
+        # Keep a couple of blocks queued per worker so no thread sits idle,
+        # without letting compressed output pile up in memory
+        self._max_pending = self.workers * 2
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+    
+    def writable(self):
+        return True
+    
+    def tell(self):
+        """Return the number of uncompressed bytes written so far"""
+        return self._written
+    
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed file")
+        
+        self._buffer += data
+        self._written += len(data)
+        
+        while len(self._buffer) >= self.block_size:
+            block = bytes(self._buffer[:self.block_size])
+            del self._buffer[:self.block_size]
+            self._submit(block)
+        
+        return len(data)
+    
+    def flush(self):
+        self.fileobj.flush()
+    
+    def close(self):
+        if self.closed:
+            return
+        
+        try:
+            # An empty stream still needs one member to be a valid gzip file
+            if self._buffer or not self._written:
+                self._submit(bytes(self._buffer))
+                self._buffer = bytearray()
+            
+            while self._pending:
+                self.fileobj.write(self._pending.popleft().result())
+            self.fileobj.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+            self.closed = True
+    
+    def _submit(self, block):
+        future = self._executor.submit(_gzip_member, block, self.compresslevel, self.mtime, self.codec)
+        self._pending.append(future)
+        
+        # Write finished blocks in order, waiting when too many are in flight
+        while self._pending and (len(self._pending) > self._max_pending or self._pending[0].done()):
+            self.fileobj.write(self._pending.popleft().result())
+
+
+class _TimedWriter:
+    """File-like wrapper timing the writes into a compressor as the "compress" phase"""
+    
+    def __init__(self, fileobj, instrument):
+        self.fileobj = fileobj
+        self.instrument = instrument
+    
+    def write(self, data):
+        with self.instrument.timed("compress"):
+            return self.fileobj.write(data)
+    
+    def tell(self):
+        return self.fileobj.tell()
+
+
+@contextlib.contextmanager
+def _open_mbz_for_writing(output_file, workers, compresslevel, instrument=None, mtime=None):
+    """
+    Open a gzip-compressed tar archive for writing
+    
+    Args:
+        output_file (str): Path to the output archive
+        workers (int): Number of compression threads (1 compresses on the calling thread)
+        compresslevel (int): gzip compression level
+        instrument (_Instrument): Receives the time spent compressing
+        mtime (int): Timestamp for the gzip header (None uses the current time)
+        
+    Yields:
+        tarfile.TarFile: Archive opened for writing
+    """
+    with open(output_file, "wb") as raw:
+        gz = get_codec().open_writer(raw, workers, compresslevel, mtime)
+        
+        with contextlib.closing(gz):
+            target = gz if instrument is None else _TimedWriter(gz, instrument)
+            with tarfile.open(fileobj=target, mode="w") as tar:
+                yield tar
+            # Flushing the last blocks is compression work too
+            with _timed(instrument, "compress"):
+                gz.close()
+
+
+def _reproducible_tarinfo(tarinfo):
+    """Strip the owner and timestamp of a member and reduce its mode to 644 or 755"""
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ""
+    tarinfo.mtime = REPRODUCIBLE_MTIME
+    tarinfo.mode = 0o755 if tarinfo.mode & 0o111 else 0o644
+    return tarinfo
+
+
+def _walk_source(source_dir):
+    """
+    List the files of a folder to compress, with the stat results of the scan
+    
+    Symlinks to files are kept as links and symlinked folders are skipped, as
+    os.walk does. Sockets, FIFOs and devices are left out.
+    
+    Args:
+        source_dir (str): Folder to compress
+        
+    Returns:
+        dict: (path, os.stat_result) keyed by member name relative to source_dir
+    """
+    files = {}
+    stack = [("", source_dir)]
+    while stack:
+        prefix, folder = stack.pop()
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                name = prefix + entry.name
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        stack.append((name + "/", entry.path))
+                    continue
+                if name == MANIFEST_NAME:
+                    continue
+                # Cached by scandir for the entry (no extra system call on Windows)
+                stat = entry.stat(follow_symlinks=False)
+                if S_ISREG(stat.st_mode) or S_ISLNK(stat.st_mode):
+                    files[name] = (entry.path, stat)
+    return files
+
+
+def _read_file(path, size):
+    """Read up to size bytes of a file"""
+    with open(path, "rb") as f:
+        return f.read(size)
+
+
+class _MappedReader:
+    """Read-only file object returning slices of a memory map instead of copies"""
+    
+    def __init__(self, mapped):
+        self._view = memoryview(mapped)
+        self._position = 0
+    
+    def read(self, size):
+        chunk = self._view[self._position:self._position + size]
+        self._position += len(chunk)
+        return chunk
+    
+    def close(self):
+        self._view.release()
+
+
+class _SourcePacker:
+    """
+    Add the files of a folder to a tar archive
+    
+    Headers are built from the stat results of the directory scan and member
+    names are given explicitly, so the working directory is never changed.
+    Small files are read on a thread pool ahead of the writer; large files are
+    memory-mapped and copied in COPY_BUFSIZE slices.
+    """
+    
+    def __init__(self, tar, base_dir, files, reproducible=False, instrument=None):
+        """
+        Args:
+            tar (tarfile.TarFile): Archive being written
+            base_dir (str): Top folder of the members in the archive
+            files (dict): (path, os.stat_result) keyed by member name, from _walk_source()
+            reproducible (bool): Normalize the metadata with _reproducible_tarinfo()
+            instrument (_Instrument): Receives the time spent reading files
+        """
+        self.tar = tar
+        self.base_dir = base_dir
+        self.files = files
+        self.reproducible = reproducible
+        self.instrument = instrument
+        self._owners = {}
+        self._executor = None
+        # (name, future or None) of the files read ahead by add_all()
+        self._pending = deque()
+        # tarfile copies file data 16 KB at a time by default
+        tar.copybufsize = COPY_BUFSIZE
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._executor is not None:
+            # Reads not started yet are useless after an error; shutdown(cancel_futures=True)
+            # would do this but needs Python 3.9
+            for _, future in self._pending:
+                if future is not None:
+                    future.cancel()
+            self._executor.shutdown()
+    
+    def _owner_names(self, uid, gid):
+        """Return the user and group names of a file owner, looked up once per owner"""
+        if (uid, gid) not in self._owners:
+            uname = gname = ""
+            if pwd is not None:
+                try:
+                    uname = pwd.getpwuid(uid).pw_name
+                except KeyError:
+                    pass
+                try:
+                    gname = grp.getgrgid(gid).gr_name
+                except KeyError:
+                    pass
+            self._owners[(uid, gid)] = (uname, gname)
+        return self._owners[(uid, gid)]
+    
+    def tarinfo(self, name):
+        """Build the tar header of a file from its stat result"""
+        path, stat = self.files[name]
+        tarinfo = tarfile.TarInfo(posixpath.join(self.base_dir, name))
+        tarinfo.mode = stat.st_mode & 0o7777
+        tarinfo.uid = stat.st_uid
+        tarinfo.gid = stat.st_gid
+        tarinfo.uname, tarinfo.gname = self._owner_names(stat.st_uid, stat.st_gid)
+        tarinfo.mtime = stat.st_mtime
+        if S_ISLNK(stat.st_mode):
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.linkname = os.readlink(path)
+        else:
+            tarinfo.size = stat.st_size
+        if self.reproducible:
+            _reproducible_tarinfo(tarinfo)
+        return tarinfo
+    
+    def add(self, name, data=None):
+        """
+        Add a file to the archive
+        
+        Args:
+            name (str): Member name, a key of files
+            data (bytes): Contents already read by the prefetch pool
+        """
+        path = self.files[name][0]
+        tarinfo = self.tarinfo(name)
+        if not tarinfo.isreg():
+            self.tar.addfile(tarinfo)
+        elif data is not None:
+            # A file that shrank since the scan fails with "unexpected end of data"
+            self.tar.addfile(tarinfo, io.BytesIO(data))
+        elif tarinfo.size >= MMAP_MIN_SIZE:
+            with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                reader = _MappedReader(mapped)
+                try:
+                    self.tar.addfile(tarinfo, reader)
+                finally:
+                    reader.close()
+        else:
+            with open(path, "rb") as f:
+                self.tar.addfile(tarinfo, f)
+    
+    def add_all(self, names, on_added):
+        """
+        Add files to the archive in the given order, reading small ones ahead
+        
+        Args:
+            names (iterable): Member names, keys of files
+            on_added (callable): Called with the name of every file added
+        """
+        names = iter(names)
+        pending = self._pending
+        ahead = 0
+        exhausted = False
+        
+        while True:
+            while not exhausted and ahead < PREFETCH_MAX_BYTES:
+                name = next(names, None)
+                if name is None:
+                    exhausted = True
+                    break
+                path, stat = self.files[name]
+                if S_ISREG(stat.st_mode) and 0 < stat.st_size <= PREFETCH_MAX_FILE_SIZE:
+                    if self._executor is None:
+                        self._executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS)
+                    pending.append((name, self._executor.submit(_read_file, path, stat.st_size)))
+                    ahead += stat.st_size
+                else:
+                    pending.append((name, None))
+            
+            if not pending:
+                break
+            name, future = pending.popleft()
+            with _timed(self.instrument, "file_read", exclude="compress"):
+                if future is None:
+                    self.add(name)
+                else:
+                    self.add(name, future.result())
+                    ahead -= self.files[name][1].st_size
+            on_added(name)
+
+
+def _stored_members(source_dir, files, store=None):
+    """
+    Find the files of an extracted folder that only exist in a store
+    
+    Args:
+        source_dir (str): Extracted folder
+        files (dict): Files found in the folder, keyed by member name
+        store (str): Store folder (None uses the one recorded in the manifest)
+        
+    Returns:
+        dict: (object path, manifest record) keyed by member name
+    """
+    try:
+        with open(os.path.join(source_dir, MANIFEST_NAME), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    
+    store = store or manifest.get("store")
+    stored = {}
+    for name, entry in manifest.get("members", {}).items():
+        if not entry.get("stored") or name in files:
+            continue
+        if not store:
+            raise ValueError(f"{name} is kept in a store, but the store folder is unknown")
+        object_path = os.path.join(store, "objects", entry["sha1"][:2], entry["sha1"])
+        if not os.path.isfile(object_path):
+            raise FileNotFoundError(f"{name} is missing from the store {store}")
+        stored[name] = (object_path, entry)
+    return stored
+
+
+def _is_unchanged(file_path, entry, stat=None):
+    """
+    Check whether a file still matches its manifest record
+    
+    Size and modification time are compared first; the contents are only
+    hashed when the size matches but the time does not (e.g. a file that was
+    opened and saved without changes). A stat result from the directory scan
+    saves a system call.
+    """
+    if stat is None:
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return False
+    
+    if stat.st_size != entry["size"]:
+        return False
+    if int(stat.st_mtime) == entry["mtime"]:
+        return True
+    return _file_sha1(file_path) == entry["sha1"]
+
+
+def _add_with_reference(tar, reference_mbz, manifest, packer, on_added, instrument=None):
+    """
+    Add files to an archive, taking unchanged ones from the reference archive
+    
+    The reference archive is read in one streaming pass. Files that still
+    match the manifest are copied from it, so they are never opened on disk;
+    changed files are read from disk and files missing from the reference
+    are appended at the end.
+    
+    Args:
+        tar (tarfile.TarFile): Archive being written
+        reference_mbz (str): Archive the folder was extracted from
+        manifest (dict): Member records from the extraction manifest
+        packer (_SourcePacker): Adds the files of the folder
+        on_added (callable): Called with the name of every file added
+        instrument (_Instrument): Receives the time spent reading and compressing
+    """
+    # Insertion-ordered set of the names still to add
+    remaining = dict.fromkeys(packer.files)
+    
+    # tarfile's own stream mode stops after the first gzip member, so the
+    # output of ParallelGzipWriter is read through _GzipReader instead
+    with _open_archive_stream(reference_mbz, instrument=instrument) as (reference, _):
+        for member in _iter_members(reference, instrument):
+            if not member.isfile():
+                continue
+            
+            name = _normalize_name(member.name)
+            if name not in remaining:
+                # Deleted from the folder since extraction
+                continue
+            del remaining[name]
+            
+            file_path, stat = packer.files[name]
+            entry = manifest.get(name)
+            with _timed(instrument, "file_read", exclude=("compress", "decompress")):
+                if (entry is not None and S_ISREG(stat.st_mode) and entry["size"] == member.size
+                        and _is_unchanged(file_path, entry, stat)):
+                    tar.addfile(packer.tarinfo(name), reference.extractfile(member))
+                else:
+                    packer.add(name)
+            on_added(name)
+    
+    packer.add_all(remaining, on_added)
+
+
+def create_mbz(source_dir, output_file, workers=None, compresslevel=9, reference_mbz=None, progress=None,
+               observer=None, store=None, reproducible=False):
+    """
+    Create an MBZ file from a directory
+    
+    With reproducible=True the same folder contents always give the same
+    bytes: members are added sorted by name, their owner, timestamp and
+    mode are normalized and the gzip header carries a fixed timestamp. The
+    output still depends on the compression level, the backend and whether
+    workers is 1 (a single gzip stream) or more (one gzip member per block).
+    
+    Args:
+        source_dir (str): Path to the source directory
+        output_file (str): Path to the output MBZ file
+        workers (int): Number of compression threads (None uses every CPU,
+            1 uses the classic single-threaded tarfile/gzip path)
+        compresslevel (int): gzip compression level, from 1 (fastest) to 9 (smallest)
+        reference_mbz (str): Original MBZ file the folder was extracted from.
+            Files left unchanged since extraction are streamed from it instead
+            of being read from disk
+        progress (callable): Called as progress(bytes_done, bytes_total, files_done)
+            after each file; it may raise OperationCancelled to stop
+        observer (Observer): Receives file events, phase timings and final stats
+        store (str): Store holding the files left out of a folder extracted with
+            link_mode "none" (None uses the store recorded at extraction)
+        reproducible (bool): Write byte-for-byte reproducible output (reference_mbz
+            is then ignored, as its member order would leak into the output)
+        
+    Returns:
+        bool: True if successful, False otherwise
+        str: Error message if unsuccessful
+    """
+    instrument = _instrument("create", source_dir, observer, progress)
+    
+    try:
+        # Normalize paths to absolute paths
+        source_dir = os.path.abspath(source_dir)
+        output_file = os.path.abspath(output_file)
+        
+        manifest = None
+        if reference_mbz and not reproducible:
+            reference_mbz = os.path.abspath(reference_mbz)
+            manifest = _load_manifest(source_dir, reference_mbz)
+        
+        # Members are named <folder name>/<path in the folder>, as Moodle expects
+        base_dir = os.path.basename(source_dir)
+        with _timed(instrument, "directory_walk"):
+            files = _walk_source(source_dir)
+        stored = _stored_members(source_dir, files, store)
+        
+        sizes = {name: stat.st_size if S_ISREG(stat.st_mode) else 0 for name, (_, stat) in files.items()}
+        total_size = sum(sizes.values()) + sum(entry["size"] for _, entry in stored.values())
+        done = [0]
+        
+        def on_added(name):
+            if instrument is not None:
+                done[0] += sizes[name]
+                instrument.member(files[name][0], sizes[name])
+                instrument.progress(done[0], total_size)
+        
+        # Create tar.gz file with proper structure for Moodle
+        mtime = REPRODUCIBLE_MTIME if reproducible else None
+        with _open_mbz_for_writing(output_file, workers, compresslevel, instrument, mtime) as tar, \
+                _SourcePacker(tar, base_dir, files, reproducible, instrument) as packer:
+            
+            def add_stored(name):
+                # Files extracted with link_mode "none" are read from the store
+                object_path, entry = stored[name]
+                tarinfo = tarfile.TarInfo(posixpath.join(base_dir, name))
+                tarinfo.size = entry["size"]
+                tarinfo.mtime = entry["mtime"]
+                tarinfo.mode = entry.get("mode", 0o644)
+                if reproducible:
+                    _reproducible_tarinfo(tarinfo)
+                with _timed(instrument, "file_read", exclude="compress"):
+                    with open(object_path, "rb") as f:
+                        tar.addfile(tarinfo, f)
+                if instrument is not None:
+                    done[0] += entry["size"]
+                    instrument.member(object_path, entry["size"])
+                    instrument.progress(done[0], total_size)
+            
+            if reproducible:
+                # Stored files are merged into the order, so the output does not
+                # depend on the link mode the folder was extracted with
+                names = sorted(set(files) | set(stored))
+                for is_stored, run in itertools.groupby(names, key=stored.__contains__):
+                    if is_stored:
+                        for name in run:
+                            add_stored(name)
+                    else:
+                        packer.add_all(run, on_added)
+            else:
+                if manifest is not None:
+                    _add_with_reference(tar, reference_mbz, manifest, packer, on_added, instrument)
+                else:
+                    packer.add_all(files, on_added)
+                
+                for name in stored:
+                    add_stored(name)
+        
+        if instrument is not None:
+            # Report what was written, not what was read from a reference archive
+            instrument.stats.uncompressed_bytes = total_size
+            instrument.stats.compressed_bytes = os.path.getsize(output_file)
+            instrument.finish()
+        return True, "Success"
+    
+    except Exception as e:
+        if instrument is not None:
+            instrument.finish(str(e))
+        return False, f"Error: {str(e)}"
+
+
+def _apply_transforms(name, data, transforms, xml_transforms):
     """
-    Analyze an MBZ file and return information about its structure
+    Run the transforms matching a member name over its data
     
     Args:
-        mbz_file_path (str): Path to the MBZ file
+        name (str): Normalized member name
+        data (bytes): Member contents
+        transforms (dict): Glob pattern -> callable(bytes) returning bytes
+        xml_transforms (dict): Glob pattern -> callable(Element) editing the
+            parsed document in place or returning a new root element
         
     Returns:
-        dict: Dictionary with information about the MBZ file
+        bytes: New contents, or None if a transform dropped the member
     """
-    info = {
-        "file_size": os.path.getsize(mbz_file_path),
-        "file_name": os.path.basename(mbz_file_path),
-        "is_valid": False,
-        "contents": [],
-        "top_level_items": 0,
-        "xml_files": 0
-    }
+    for pattern, transform in transforms.items():
+        if fnmatch.fnmatchcase(name, pattern):
+            data = transform(data)
+            if data is None:
+                return None
+    
+    callbacks = [callback for pattern, callback in xml_transforms.items() if fnmatch.fnmatchcase(name, pattern)]
+    if callbacks:
+        root = ElementTree.fromstring(data)
+        for callback in callbacks:
+            result = callback(root)
+            if result is not None:
+                root = result
+        buffer = io.BytesIO()
+        ElementTree.ElementTree(root).write(buffer, encoding="UTF-8", xml_declaration=True)
+        data = buffer.getvalue()
+    
+    return data
+
+
+def transform_mbz(mbz_file_path, output_file, transforms=None, xml_transforms=None,
+                  workers=None, compresslevel=9, progress=None, observer=None):
+    """
+    Rewrite an MBZ file in one streaming pass, editing some members on the way
+    
+    Members matching a pattern are read into memory (one at a time), passed
+    through the transforms and written with their new size. Every other
+    member is copied through untouched. Nothing is extracted to disk.
+    
+    Args:
+        mbz_file_path (str): Path to the source MBZ file
+        output_file (str): Path to the new MBZ file (must differ from the source)
+        transforms (dict): Glob pattern (e.g. "activities/*/module.xml") ->
+            callable(bytes) returning the new bytes, or None to drop the member
+        xml_transforms (dict): Glob pattern -> callable(Element) receiving the
+            parsed root element; it edits it in place or returns a new root
+        workers (int): Number of compression threads (None uses every CPU)
+        compresslevel (int): gzip compression level, from 1 (fastest) to 9 (smallest)
+        progress (callable): Called as progress(bytes_done, bytes_total, files_done)
+            while the source is read; it may raise OperationCancelled to stop
+        observer (Observer): Receives member events, phase timings and final stats
+        
+    Returns:
+        bool: True if successful, False otherwise
+        str: Error message if unsuccessful
+    """
+    transforms = transforms or {}
+    xml_transforms = xml_transforms or {}
+    instrument = _instrument("transform", mbz_file_path, observer, progress)
     
     try:
-        with tarfile.open(mbz_file_path, "r:gz") as tar:
-            members = tar.getmembers()
-            info["is_valid"] = True
-            info["contents"] = [m.name for m in members[:20]]  # List first 20 items
-            
-            # Count top-level items and XML files
-            top_level = set()
-            xml_count = 0
-            
-            for member in members:
-                if '/' not in member.name:
-                    top_level.add(member.name)
-                elif member.name.endswith('.xml'):
-                    xml_count += 1
-            
-            info["top_level_items"] = len(top_level)
-            info["xml_files"] = xml_count
-            info["total_files"] = len(members)
-            
-    except Exception as e:
-        info["error"] = str(e)
+        if os.path.exists(output_file) and os.path.samefile(mbz_file_path, output_file):
+            raise ValueError("The output file must be different from the source file")
         
-    return info
+        archive_size = os.path.getsize(mbz_file_path)
+        with _open_archive_stream(mbz_file_path, instrument=instrument) as (source, reader):
+            with _open_mbz_for_writing(output_file, workers, compresslevel, instrument) as tar:
+                for member in _iter_members(source, instrument):
+                    if instrument is not None:
+                        instrument.member(member.name, member.size)
+                        instrument.progress(reader.compressed_pos, archive_size)
+                    if not member.isfile():
+                        tar.addfile(member)
+                        continue
+                    
+                    name = _normalize_name(member.name)
+                    matched = any(fnmatch.fnmatchcase(name, pattern)
+                                  for pattern in list(transforms) + list(xml_transforms))
+                    if not matched:
+                        tar.addfile(member, source.extractfile(member))
+                        continue
+                    
+                    data = _apply_transforms(name, source.extractfile(member).read(), transforms, xml_transforms)
+                    if data is None:
+                        continue
+                    
+                    member.size = len(data)
+                    member.pax_headers.pop("size", None)
+                    tar.addfile(member, io.BytesIO(data))
+        
+        if instrument is not None:
+            instrument.finish()
+        return True, "Success"
+    
+    except Exception as e:
+        if instrument is not None:
+            instrument.finish(str(e))
+        return False, f"Error: {str(e)}"
+
+
+class _ArchiveInstrument:
+    """Instrument of one archive in an operation reading several archives at once"""
+    
+    def __init__(self, parent, positions, slot, total):
+        self._parent = parent
+        self._positions = positions
+        self._slot = slot
+        self._total = total
+    
+    def __getattr__(self, name):
+        return getattr(self._parent, name)
+    
+    def progress(self, bytes_done, bytes_total):
+        # Progress is reported over all the archives together
+        self._positions[self._slot] = bytes_done
+        self._parent.progress(sum(self._positions), self._total)
+
+
+def _hash_data(data, budget):
+    """Hash a member's data on a hashing thread and release its share of the budget"""
+    try:
+        return hashlib.sha1(data).hexdigest()
+    finally:
+        budget.release(len(data))
 
 
-def extract_mbz(mbz_file_path, output_dir, open_after=False):
+def _hash_archive(mbz_file_path, executor, budget, instrument=None):
     """
-    Extract an MBZ file to a directory
+    Read an MBZ file once, hashing its members and building its index
+    
+    Small members are hashed on the executor while decompression goes on;
+    members bigger than a quarter of the budget are hashed in chunks on the
+    calling thread, so memory use stays bounded whatever their size.
     
     Args:
         mbz_file_path (str): Path to the MBZ file
-        output_dir (str): Path to the output directory
-        open_after (bool): Whether to open the folder after extraction
+        executor (ThreadPoolExecutor): Hashing pool
+        budget (_ByteBudget): Bound for the data waiting to be hashed
+        instrument (_Instrument): Receives member events, progress and timings
         
     Returns:
-        str: Path to the extracted directory or error message
+        dict: (type, size, SHA-1 digest or link target) keyed by normalized member name
+        dict: Archive index, as returned by get_index()
     """
-    try:
-        # Create a folder with the same name as the mbz file (without extension)
-        base_name = os.path.basename(mbz_file_path)
-        file_name_without_ext = os.path.splitext(base_name)[0]
-        extract_dir = os.path.join(output_dir, file_name_without_ext)
-        
-        # Create the directory if it doesn't exist
-        os.makedirs(extract_dir, exist_ok=True)
+    entries = {}
+    stream_threshold = max(budget.limit // 4, 1)
+    
+    def visit(tar, member):
+        value = None
+        if member.isfile():
+            source = tar.extractfile(member)
+            if member.size > stream_threshold:
+                digest = hashlib.sha1()
+                for chunk in iter(lambda: source.read(COPY_BUFSIZE), b""):
+                    digest.update(chunk)
+                value = digest.hexdigest()
+            else:
+                data = source.read()
+                budget.acquire(len(data))
+                value = executor.submit(_hash_data, data, budget)
+        elif member.issym() or member.islnk():
+            value = member.linkname
+        entries[_normalize_name(member.name)] = (_member_type(member), member.size, value)
+    
+    _, index = _scan_archive(mbz_file_path, build_index=True, instrument=instrument, visit=visit)
+    
+    for name, (member_type, size, value) in entries.items():
+        if hasattr(value, "result"):
+            entries[name] = (member_type, size, value.result())
+    return entries, index
+
+
+def _xml_children(element):
+    """
+    Key the children of an XML element for matching against another version
+    
+    Children are matched by tag and "id" attribute (Moodle gives most
+    repeated elements an id), then by position among the children sharing both.
+    
+    Returns:
+        dict: XPath-like step -> child element, in document order
+    """
+    children = {}
+    counts = {}
+    for child in element:
+        base = (child.tag, child.get("id"))
+        occurrence = counts.get(base, 0)
+        counts[base] = occurrence + 1
         
-        # Extract using tarfile module
-        with tarfile.open(mbz_file_path, "r:gz") as tar:
-            tar.extractall(path=extract_dir)
+        step = child.tag if base[1] is None else f'{child.tag}[@id="{base[1]}"]'
+        if occurrence:
+            step += f"[{occurrence + 1}]"
+        children[step] = child
+    return children
+
+
+def _xml_diff(old, new, path, changes, limit=XML_DIFF_MAX_CHANGES):
+    """
+    Compare two XML elements recursively, appending the differences to changes
+    
+    Args:
+        old (Element): Element from the first archive
+        new (Element): Element from the second archive
+        path (str): XPath-like location of the elements
+        changes (list): Receives {"path", "change", "old", "new"} dicts, where
+            change is "tag", "attribute", "text", "added" or "removed"
+        limit (int): Stop once changes holds that many entries
+    """
+    if len(changes) >= limit:
+        return
+    if old.tag != new.tag:
+        changes.append({"path": path, "change": "tag", "old": old.tag, "new": new.tag})
+        return
+    
+    for key in sorted(set(old.attrib) | set(new.attrib)):
+        if old.get(key) != new.get(key):
+            changes.append({"path": f"{path}/@{key}", "change": "attribute", "old": old.get(key), "new": new.get(key)})
+    
+    old_text = (old.text or "").strip()
+    new_text = (new.text or "").strip()
+    if old_text != new_text:
+        changes.append({"path": path, "change": "text", "old": old_text, "new": new_text})
+    
+    old_children = _xml_children(old)
+    new_children = _xml_children(new)
+    for step, child in old_children.items():
+        if step in new_children:
+            _xml_diff(child, new_children[step], f"{path}/{step}", changes, limit)
+        else:
+            changes.append({"path": f"{path}/{step}", "change": "removed", "old": child.tag, "new": None})
+    for step, child in new_children.items():
+        if step not in old_children:
+            changes.append({"path": f"{path}/{step}", "change": "added", "old": None, "new": child.tag})
+    
+    del changes[limit:]
+
+
+def _diff_xml_files(mbz_a, index_a, mbz_b, index_b, names):
+    """
+    Compute the structural diff of XML members changed between two archives
+    
+    Only these members are decompressed again, in one pass per archive,
+    into a temporary folder, so no more than one document pair is parsed
+    in memory at a time.
+    
+    Returns:
+        dict: Normalized member name -> (list of changes, or an error message)
+    """
+    results = {}
+    if not names:
+        return results
+    
+    with tempfile.TemporaryDirectory(prefix="mbz_diff_") as temp_dir:
+        dir_a = os.path.join(temp_dir, "a")
+        dir_b = os.path.join(temp_dir, "b")
+        extract_members(mbz_a, names, dir_a, index=index_a)
+        extract_members(mbz_b, names, dir_b, index=index_b)
         
-        # Open the folder if requested
-        if open_after:
+        for name in names:
             try:
-                # Cross-platform way to open a folder
-                if os.name == 'nt':  # Windows
-                    os.startfile(extract_dir)
-                elif os.name == 'posix':  # macOS, Linux
-                    if os.uname().sysname == 'Darwin':  # macOS
-                        subprocess.call(['open', extract_dir])
-                    else:  # Linux
-                        subprocess.call(['xdg-open', extract_dir])
-            except Exception:
-                # If opening the folder fails, just continue (non-critical)
-                pass
+                old = ElementTree.parse(_member_path(dir_a, name)).getroot()
+                new = ElementTree.parse(_member_path(dir_b, name)).getroot()
+            except (ElementTree.ParseError, OSError) as e:
+                results[name] = f"Error: {str(e)}"
+                continue
             
-        return extract_dir
+            # One change over the limit tells the caller the list was cut
+            changes = []
+            _xml_diff(old, new, f"/{old.tag}", changes, XML_DIFF_MAX_CHANGES + 1)
+            results[name] = changes
+    
+    return results
+
+
+def diff_mbz(mbz_a, mbz_b, workers=None, xml_diff=True, max_pending_bytes=EXTRACT_MAX_PENDING_BYTES,
+             use_cache=None, progress=None, observer=None):
+    """
+    Compare two MBZ files member by member, without extracting them
+    
+    Both archives are read at the same time, in one streaming pass each,
+    and member contents are hashed on a thread pool as they are decompressed.
+    Only the names, sizes and digests are kept, so memory grows with the
+    number of members rather than with the size of the archives. Modified XML
+    files are then read again from both archives for a structural diff.
+    
+    Args:
+        mbz_a (str): Path to the first (older) MBZ file
+        mbz_b (str): Path to the second (newer) MBZ file
+        workers (int): Number of hashing threads (None uses every CPU)
+        xml_diff (bool): Include the structural diff of modified XML files
+        max_pending_bytes (int): Memory bound for data waiting to be hashed
+        use_cache (bool): Save the indexes built on the way in the on-disk index
+            cache (None follows INDEX_CACHE_ENABLED)
+        progress (callable): Called as progress(bytes_done, bytes_total, files_done)
+            over both archives; it may raise OperationCancelled to stop
+        observer (Observer): Receives member events, phase timings and final stats
+        
+    Returns:
+        dict: "added" and "removed" member names, "modified" records (name,
+            type, size_a, size_b and, for XML files, "xml_changes" and
+            "xml_changes_truncated"), the number of "unchanged" members and
+            "identical" (bool), or an "error" key if the comparison failed
+    """
+    instrument = _instrument("diff", mbz_a, observer, progress)
+    
+    try:
+        paths = (mbz_a, mbz_b)
+        parts = [instrument] * 2
+        if instrument is not None:
+            positions = [0, 0]
+            total = sum(os.path.getsize(path) for path in paths)
+            parts = [_ArchiveInstrument(instrument, positions, slot, total) for slot in range(2)]
+        
+        budget = _ByteBudget(max_pending_bytes)
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as hashers:
+            # One reading thread per archive, so both decompress at the same time
+            with ThreadPoolExecutor(max_workers=2) as readers:
+                scans = [readers.submit(_hash_archive, path, hashers, budget, part)
+                         for path, part in zip(paths, parts)]
+                (entries_a, index_a), (entries_b, index_b) = [scan.result() for scan in scans]
+        
+        if _index_cache_enabled(use_cache):
+            _save_cached_index(mbz_a, index_a)
+            _save_cached_index(mbz_b, index_b)
+        
+        result = {
+            "a": mbz_a,
+            "b": mbz_b,
+            "added": sorted(name for name in entries_b if name not in entries_a),
+            "removed": sorted(name for name in entries_a if name not in entries_b),
+            "modified": [],
+            "unchanged": 0
+        }
+        
+        for name in sorted(entries_a):
+            if name not in entries_b:
+                continue
+            type_a, size_a, value_a = entries_a[name]
+            type_b, size_b, value_b = entries_b[name]
+            if type_a == type_b and value_a == value_b:
+                result["unchanged"] += 1
+                continue
+            result["modified"].append({"name": name, "type": type_b, "size_a": size_a, "size_b": size_b})
+        
+        if xml_diff:
+            names = [record["name"] for record in result["modified"]
+                     if record["name"].endswith(".xml") and record["type"] == "file"
+                     and entries_a[record["name"]][0] == "file"
+                     and max(record["size_a"], record["size_b"]) <= XML_DIFF_MAX_BYTES]
+            with _timed(instrument, "xml_diff"):
+                xml_results = _diff_xml_files(mbz_a, index_a, mbz_b, index_b, names)
+            for record in result["modified"]:
+                changes = xml_results.get(record["name"])
+                if isinstance(changes, str):
+                    record["xml_error"] = changes
+                elif changes is not None:
+                    record["xml_changes"] = changes[:XML_DIFF_MAX_CHANGES]
+                    record["xml_changes_truncated"] = len(changes) > XML_DIFF_MAX_CHANGES
+        
+        result["identical"] = not (result["added"] or result["removed"] or result["modified"])
+        
+        if instrument is not None:
+            instrument.finish()
+        return result
     
     except Exception as e:
-        return f"Error: {str(e)}"
+        if instrument is not None:
+            instrument.finish(str(e))
+        return {"a": mbz_a, "b": mbz_b, "error": f"Error: {str(e)}"}
 
 
-def create_mbz(source_dir, output_file):
+class _BackupValidator:
     """
-    Create an MBZ file from a directory
+    Check that a Moodle backup contains what its manifests describe
+    
+    Members are fed one at a time with add_member() and the two manifests,
+    moodle_backup.xml and files.xml, are parsed incrementally with parse().
+    Only member names, the sizes of the file pool and the expectations read
+    from the manifests are kept, so memory follows the member count. Nothing
+    is compared before report(), so members may come in any order.
+    """
+    
+    def __init__(self):
+        self.names = set()
+        self.directories = set()
+        self.blobs = {}
+        self.problems = []
+        self.backup_root = None
+        self.files_root = None
+        self.activities = []
+        self.sections = []
+        self.course_directory = None
+        self.file_entries = {}
+    
+    def problem(self, severity, path, message):
+        self.problems.append({"severity": severity, "path": path, "message": message})
+    
+    def add_member(self, name, member_type, size):
+        name = _normalize_name(name)
+        if name in self.names:
+            self.problem("warning", name, "Duplicate member")
+        self.names.add(name)
+        if member_type == "directory":
+            self.directories.add(name)
+        
+        parent = posixpath.dirname(name)
+        while parent and parent not in self.directories:
+            self.directories.add(parent)
+            parent = posixpath.dirname(parent)
+        
+        if member_type == "file" and _BLOB_NAME.search(name):
+            self.blobs[name] = size
+    
+    @staticmethod
+    def manifest_kind(name):
+        """Return "backup" or "files" for the manifests (at most one folder deep), None otherwise"""
+        name = _normalize_name(name)
+        if name.count("/") > 1:
+            return None
+        return {"moodle_backup.xml": "backup", "files.xml": "files"}.get(posixpath.basename(name))
+    
+    def parse(self, kind, fileobj, name):
+        """Parse a manifest from a file object, recording a problem if it is not well-formed XML"""
+        name = _normalize_name(name)
+        root = posixpath.dirname(name)
+        root = root + "/" if root else ""
+        try:
+            if kind == "backup":
+                self.backup_root = root
+                self._parse_backup(fileobj)
+            else:
+                self.files_root = root
+                self._parse_files(fileobj)
+        except ElementTree.ParseError as e:
+            self.problem("error", name, f"Invalid XML: {str(e)}")
+    
+    def _parse_backup(self, fileobj):
+        for _, element in ElementTree.iterparse(fileobj):
+            # Settings also have <activity> and <section> elements, without a directory
+            if element.tag not in ("activity", "section", "course") or element.find("directory") is None:
+                continue
+            record = {
+                "directory": _normalize_name(element.findtext("directory", "")),
+                "title": element.findtext("title", ""),
+                "modulename": element.findtext("modulename", "")
+            }
+            if element.tag == "activity":
+                self.activities.append(record)
+            elif element.tag == "section":
+                self.sections.append(record)
+            else:
+                self.course_directory = record["directory"]
+            element.clear()
+    
+    def _parse_files(self, fileobj):
+        root = None
+        for event, element in ElementTree.iterparse(fileobj, events=("start", "end")):
+            if root is None:
+                root = element
+                continue
+            if event != "end" or element.tag != "file":
+                continue
+            
+            content_hash = (element.findtext("contenthash") or "").strip()
+            filename = element.findtext("filename", "")
+            # Directories have no data, and empty files may have no blob either
+            if content_hash and filename != "." and content_hash != _EMPTY_SHA1:
+                try:
+                    size = int(element.findtext("filesize", "-1"))
+                except ValueError:
+                    size = -1
+                description = (f"{element.findtext('component', '')}/{element.findtext('filearea', '')}"
+                               f"{element.findtext('filepath', '/')}{filename}")
+                self.file_entries.setdefault(content_hash, (size, description))
+            # Drop the parsed <file> elements, so memory does not grow with files.xml
+            root.clear()
+    
+    def report(self):
+        """Compare the members with the manifests and return the problems found"""
+        problems = list(self.problems)
+        
+        def add(severity, path, message):
+            problems.append({"severity": severity, "path": path, "message": message})
+        
+        if self.backup_root is None:
+            add("error", "moodle_backup.xml", "Missing moodle_backup.xml")
+        root = self.backup_root or ""
+        
+        expected = [("activity", record, ["module.xml", record["modulename"] + ".xml"] if record["modulename"]
+                     else ["module.xml"]) for record in self.activities]
+        expected += [("section", record, ["section.xml"]) for record in self.sections]
+        if self.course_directory:
+            expected.append(("course", {"directory": self.course_directory, "title": ""}, ["course.xml"]))
+        
+        for kind, record, required in expected:
+            directory = root + record["directory"]
+            label = f"{kind} {record['title']!r}" if record["title"] else kind
+            if directory not in self.directories:
+                add("error", directory, f"Missing directory of {label} listed in moodle_backup.xml")
+                continue
+            for file_name in required:
+                if f"{directory}/{file_name}" not in self.names:
+                    add("error", f"{directory}/{file_name}", f"Missing file of {label}")
+        
+        if self.files_root is None:
+            add("error", root + "files.xml", "Missing files.xml")
+        else:
+            for content_hash, (size, description) in self.file_entries.items():
+                blob = f"{self.files_root}files/{content_hash[:2]}/{content_hash}"
+                if blob not in self.blobs:
+                    add("error", blob, f"Missing data of {description} listed in files.xml")
+                elif size >= 0 and self.blobs[blob] != size:
+                    add("error", blob, f"Size {self.blobs[blob]} of {description} differs from files.xml ({size})")
+            
+            for blob in self.blobs:
+                content_hash = posixpath.basename(blob)
+                if content_hash not in self.file_entries and content_hash != _EMPTY_SHA1:
+                    add("warning", blob, "File not listed in files.xml")
+        
+        return problems
+
+
+def validate_mbz(mbz_file_path, use_cache=None, progress=None, observer=None):
+    """
+    Check that an MBZ file is a complete Moodle backup
+    
+    The checks are: moodle_backup.xml is present and well-formed, every
+    activity, section and course directory it lists is present with its main
+    XML files, files.xml is present, every file it lists has its data in
+    files/ with the right size, and files/ holds nothing files.xml does not list.
+    
+    With an index in the cache (e.g. after analyze_mbz) that has seek points,
+    as archives written by this tool do, only the two manifests are
+    decompressed. Otherwise the archive is read in one streaming pass, parsing
+    the manifests on the way and caching the index if it was not already.
+    Reading the manifests of a single gzip stream through the index would
+    decompress from the start for each of them.
     
     Args:
-        source_dir (str): Path to the source directory
-        output_file (str): Path to the output MBZ file
+        mbz_file_path (str): Path to the MBZ file
+        use_cache (bool): Use the on-disk index cache (None follows INDEX_CACHE_ENABLED)
+        progress (callable): Called as progress(bytes_done, bytes_total, files_done)
+            while the archive is read; it may raise OperationCancelled to stop
+        observer (Observer): Receives member events, phase timings and final stats
         
     Returns:
-        bool: True if successful, False otherwise
-        str: Error message if unsuccessful
+        dict: "valid" (no errors), "problems" (dicts with "severity" — "error"
+            or "warning" —, "path" and "message"), "errors" and "warnings"
+            counts, "checked" counts and "cached", or an "error" key if the
+            archive could not be read
     """
+    info = {
+        "file_name": os.path.basename(mbz_file_path),
+        "valid": False,
+        "problems": []
+    }
+    
+    instrument = _instrument("validate", mbz_file_path, observer, progress)
+    
     try:
-        # Normalize paths to absolute paths
-        source_dir = os.path.abspath(source_dir)
-        output_file = os.path.abspath(output_file)
+        validator = _BackupValidator()
+        index = _load_cached_index(mbz_file_path) if _index_cache_enabled(use_cache) else None
+        cached = index is not None and _has_seek_points(mbz_file_path, index)
         
-        # Create tar.gz file with proper structure for Moodle
-        with tarfile.open(output_file, "w:gz") as tar:
-            # Store the current directory
-            original_dir = os.getcwd()
+        if cached:
+            members = index["members"]
+            for row, name in enumerate(members["name"]):
+                validator.add_member(name, members["type"][row], members["size"][row])
+            for row, name in enumerate(members["name"]):
+                kind = validator.manifest_kind(name)
+                if kind and members["type"][row] == "file":
+                    validator.parse(kind, io.BytesIO(read_member(mbz_file_path, name, index=index)), name)
+        else:
+            def visit(tar, member):
+                validator.add_member(member.name, _member_type(member), member.size)
+                kind = validator.manifest_kind(member.name)
+                if kind and member.isfile():
+                    # Parsed straight from the tar stream, never held in memory whole
+                    validator.parse(kind, tar.extractfile(member), member.name)
             
-            try:
-                # Change to the parent directory of the source directory
-                parent_dir = os.path.dirname(source_dir)
-                os.chdir(parent_dir)
-                
-                # Get the base directory name (without path)
-                base_dir = os.path.basename(source_dir)
-                
-                # Add all files from the folder, maintaining paths relative to the parent directory
-                for root, dirs, files in os.walk(base_dir):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        # This ensures the paths in the archive are relative to the parent
-                        # directory and maintain the exact same structure as the original
-                        tar.add(file_path)
-            finally:
-                # Always return to the original directory
-                os.chdir(original_dir)
+            if index is None and _index_cache_enabled(use_cache):
+                _scan_archive_to_cache(mbz_file_path, instrument, visit)
+            else:
+                _scan_archive(mbz_file_path, instrument=instrument, visit=visit)
         
-        return True, "Success"
+        problems = validator.report()
+        info.update({
+            "valid": not any(problem["severity"] == "error" for problem in problems),
+            "problems": problems,
+            "errors": sum(1 for problem in problems if problem["severity"] == "error"),
+            "warnings": sum(1 for problem in problems if problem["severity"] == "warning"),
+            "checked": {
+                "members": len(validator.names),
+                "activities": len(validator.activities),
+                "sections": len(validator.sections),
+                "files": len(validator.file_entries),
+                "blobs": len(validator.blobs)
+            },
+            "cached": cached
+        })
     
     except Exception as e:
-        return False, f"Error: {str(e)}"
+        info["error"] = str(e)
+    
+    if instrument is not None:
+        instrument.finish(info.get("error"))
+    
+    return info
+
+
+# Parts of an ElementTree path that depend on the whole document: positional
+# predicates ("[2]", "[last()]"), the parent step ("..") and a path that selects
+# the root itself ("." or ".[tag]")
+_XPATH_QUOTED = re.compile(r"'[^']*'|\"[^\"]*\"")
+_XPATH_POSITION = re.compile(r"\[\s*(\d|last\s*\()")
+_XPATH_ROOT = re.compile(r"\s*\.\s*(\[.*\])?\s*")
+
+
+def _check_search_query(query, mode):
+    """
+    Reject an unknown mode or a query that cannot be searched, before reading anything
+    
+    Raises:
+        ValueError: With the reason, for the mode or the query
+    """
+    if mode not in SEARCH_MODES:
+        raise ValueError(f"Unknown search mode: {mode} (expected one of {', '.join(SEARCH_MODES)})")
+    if mode == "regex":
+        try:
+            re.compile(query)
+        except re.error as e:
+            raise ValueError(f"Invalid regular expression {query!r}: {str(e)}")
+    elif mode == "xpath":
+        try:
+            ElementTree.Element("root").findall(query)
+        except (SyntaxError, TypeError, KeyError) as e:
+            raise ValueError(f"Invalid XPath query {query!r}: {str(e) or type(e).__name__}")
+        
+        # _search_xpath() evaluates the path once per top-level element
+        path = _XPATH_QUOTED.sub("''", query)
+        if _XPATH_POSITION.search(path) or ".." in path or _XPATH_ROOT.fullmatch(path):
+            raise ValueError(f"Unsupported XPath query {query!r}: positional predicates, '..' and paths "
+                             f"selecting the root element are not supported")
+
+
+def _line_matcher(query, mode, ignore_case):
+    """Return a function giving the first match of a substring or regex query in a line, or None"""
+    if mode == "regex":
+        pattern = re.compile(query, re.IGNORECASE if ignore_case else 0)
+        
+        def find(line):
+            match = pattern.search(line)
+            return match.group(0) if match else None
+        return find
+    
+    needle = query.lower() if ignore_case else query
+    
+    def find(line):
+        position = (line.lower() if ignore_case else line).find(needle)
+        return line[position:position + len(needle)] if position >= 0 else None
+    return find
+
+
+def _search_lines(fileobj, find):
+    """Yield (line number, line, match) for the lines of a member in which find() finds something"""
+    # Members of a streamed archive are not seekable, which io.TextIOWrapper requires
+    for number, data in enumerate(iter(fileobj.readline, b""), 1):
+        line = data.decode("utf-8", errors="replace")
+        match = find(line)
+        if match is not None:
+            yield number, line.strip(), match
+
+
+def _search_xpath(fileobj, query):
+    """
+    Yield the elements of a member matching an ElementTree path, parsing incrementally
+    
+    The query runs against a copy of the document root holding one of its
+    children at a time, and each child is dropped once searched, so memory is
+    bounded by the largest child of the root rather than by the document.
+    That only helps files with many top-level elements, such as the
+    <question_category> list of questions.xml: activity files hold everything
+    in a single module element (<quiz>, <forum>...) under their <activity>
+    root, which is built in full before it is searched.
+    
+    Paths relative to the root (".//url", "question_category[name='Old']")
+    find the same elements as on the whole document as long as they do not
+    depend on the other children: positional predicates, ".." and paths
+    selecting the root itself are rejected by _check_search_query().
+    """
+    root = None
+    depth = 0
+    for event, element in ElementTree.iterparse(fileobj, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = element
+            depth += 1
+            continue
+        
+        depth -= 1
+        if depth == 1:
+            wrapper = ElementTree.Element(root.tag, root.attrib)
+            wrapper.append(element)
+            yield from wrapper.findall(query)
+            root.remove(element)
+
+
+def search_mbz(mbz_file_path, query, mode="substring", path_filter="*.xml", ignore_case=False, max_matches=None,
+               progress=None, observer=None):
+    """
+    Search the XML files of an MBZ file without extracting it
+    
+    The archive is decompressed in one streaming pass. Members matching
+    path_filter are searched as they go by. Substring and regex queries read a
+    line at a time, so memory does not grow with the member size. XPath
+    queries build one top-level element of a member at a time (see
+    _search_xpath()), so memory is bounded by the largest of them, which is
+    the whole member for activity files. Results are yielded as soon as they
+    are found.
+    
+    Args:
+        mbz_file_path (str): Path to the MBZ file
+        query (str): Text, regular expression or ElementTree path (see SEARCH_MODES)
+        mode (str): "substring", "regex" or "xpath"
+        path_filter (str): Glob pattern of the member names to search (None searches every file)
+        ignore_case (bool): Case-insensitive substring and regex matching
+        max_matches (int): Stop after this many results (None finds them all)
+        progress (callable): Called as progress(bytes_done, bytes_total, files_done)
+            while the archive is read; it may raise OperationCancelled to stop
+        observer (Observer): Receives an event per member searched and the final stats
+        
+    Yields:
+        dict: "member" name, then "line", "text" and "match" for substring and
+            regex queries, or "tag", "text" and "match" (the element's XML) for
+            XPath queries. A member that is not valid XML gives an "error" instead
+        
+    Raises:
+        ValueError: If the mode is unknown or the query is invalid or unsupported
+    """
+    _check_search_query(query, mode)
+    if mode != "xpath":
+        find = _line_matcher(query, mode, ignore_case)
+    
+    instrument = _instrument("search", mbz_file_path, observer, progress)
+    archive_size = os.path.getsize(mbz_file_path)
+    found = 0
+    error = None
+    
+    try:
+        with _open_archive_stream(mbz_file_path, instrument=instrument) as (tar, reader):
+            for member in _iter_members(tar, instrument):
+                if instrument is not None:
+                    instrument.progress(reader.compressed_pos, archive_size)
+                name = _normalize_name(member.name)
+                if not member.isfile() or (path_filter and not fnmatch.fnmatchcase(name, path_filter)):
+                    continue
+                if instrument is not None:
+                    instrument.member(name, member.size)
+                
+                fileobj = tar.extractfile(member)
+                if mode == "xpath":
+                    try:
+                        for element in _search_xpath(fileobj, query):
+                            found += 1
+                            # The whitespace or text after the element is not part of it
+                            element.tail = None
+                            yield {
+                                "member": name,
+                                "tag": element.tag,
+                                "text": (element.text or "").strip()[:SEARCH_TEXT_CHARS],
+                                "match": ElementTree.tostring(element, encoding="unicode")[:SEARCH_TEXT_CHARS]
+                            }
+                            if max_matches is not None and found >= max_matches:
+                                return
+                    except ElementTree.ParseError as e:
+                        yield {"member": name, "error": f"Invalid XML: {str(e)}"}
+                else:
+                    for number, line, match in _search_lines(fileobj, find):
+                        found += 1
+                        yield {"member": name, "line": number, "text": line[:SEARCH_TEXT_CHARS], "match": match}
+                        if max_matches is not None and found >= max_matches:
+                            return
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        if instrument is not None:
+            instrument.finish(error)
+
+
+# Queue of the search worker processes, set by _init_search_worker
+_search_queue = None
+_search_stop = None
+
+
+def _init_search_worker(results, stop, codec):
+    """Give a search worker process its queue, the event asking it to stop and the parent's codec"""
+    global _search_queue, _search_stop
+    _search_queue = results
+    _search_stop = stop
+    # Processes started with "spawn" do not inherit set_codec()
+    set_codec(codec)
+
+
+def _search_worker(mbz_file_path, query, mode, path_filter, ignore_case, max_matches):
+    """Search one archive in a worker process, posting every result to the queue as it is found"""
+    def progress(bytes_done, bytes_total, files_done):
+        if _search_stop.is_set():
+            raise OperationCancelled()
+    
+    found = 0
+    error = None
+    try:
+        for record in search_mbz(mbz_file_path, query, mode, path_filter, ignore_case, max_matches, progress):
+            found += 1
+            _search_queue.put(("match", mbz_file_path, record))
+    except OperationCancelled:
+        error = "Cancelled"
+    except Exception as e:
+        error = f"Error: {str(e)}"
+    _search_queue.put(("done", mbz_file_path, {"matches": found, "error": error}))
+
+
+def _next_search_result(results, futures, waiting=None):
+    """
+    Wait for the next message of the search workers, failing if the pool died instead
+    
+    waiting() is called every second while no message arrives, so a caller can
+    stop a search that finds nothing for a long time.
+    """
+    while True:
+        try:
+            return results.get(timeout=1)
+        except queue.Empty:
+            if waiting is not None:
+                waiting()
+            # Workers catch their own errors, so a failed future means a crashed process
+            for future in futures:
+                if future.done() and not future.cancelled() and future.exception() is not None:
+                    raise future.exception()
+
+
+def search_archives(mbz_file_paths, query, mode="substring", path_filter="*.xml", ignore_case=False,
+                    max_matches=None, workers=None, progress=None):
+    """
+    Search many MBZ files at once, on a pool of worker processes
+    
+    Each archive is searched by search_mbz() in its own process. Results travel
+    back through a multiprocessing queue and are yielded in the order they are
+    found, so the first matches show up while the other archives are still
+    being read. Closing the generator early stops the workers.
+    
+    Args:
+        mbz_file_paths (list): Paths of the MBZ files
+        query (str): Text, regular expression or ElementTree path (see SEARCH_MODES)
+        mode (str): "substring", "regex" or "xpath"
+        path_filter (str): Glob pattern of the member names to search (None searches every file)
+        ignore_case (bool): Case-insensitive substring and regex matching
+        max_matches (int): Results per archive after which its search stops (None finds them all)
+        workers (int): Number of worker processes (None uses every CPU)
+        progress (callable): Called as progress(bytes_done, bytes_total, archives_done)
+            each time an archive is finished, and every second while no result
+            arrives; it may raise OperationCancelled to stop
+        
+    Yields:
+        dict: A search_mbz() result with an "archive" key, or once per archive
+            {"archive", "done": True, "matches", "error"} when its search ends
+        
+    Raises:
+        ValueError: If the mode is unknown or the query is invalid, before any
+            worker is started
+    """
+    _check_search_query(query, mode)
+    
+    paths = list(mbz_file_paths)
+    sizes = {path: os.path.getsize(path) if os.path.isfile(path) else 0 for path in paths}
+    total_size = sum(sizes.values())
+    bytes_done = 0
+    
+    results = multiprocessing.Queue()
+    stop = multiprocessing.Event()
+    executor = ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1, initializer=_init_search_worker,
+                                   initargs=(results, stop, get_codec().name))
+    futures = [executor.submit(_search_worker, path, query, mode, path_filter, ignore_case, max_matches)
+               for path in paths]
+    remaining = len(futures)
+    
+    def waiting():
+        if progress is not None:
+            progress(bytes_done, total_size, len(paths) - remaining)
+    
+    try:
+        while remaining:
+            kind, path, record = _next_search_result(results, futures, waiting)
+            if kind == "match":
+                record["archive"] = path
+                yield record
+                continue
+            
+            remaining -= 1
+            bytes_done += sizes[path]
+            yield {"archive": path, "done": True, "matches": record["matches"], "error": record["error"]}
+            if progress is not None:
+                progress(bytes_done, total_size, len(paths) - remaining)
+    finally:
+        if remaining:
+            # Stopped early: cancel what has not started and wait for the running searches to give up
+            stop.set()
+            remaining -= sum(1 for future in futures if future.cancel())
+            while remaining:
+                kind, _, _ = _next_search_result(results, futures)
+                if kind == "done":
+                    remaining -= 1
+        executor.shutdown()
+
+
+def iter_xml_files(extracted_dir, observer=None):
+    """
+    Iterate over the XML files in the extracted directory
+    
+    Folders are scanned one at a time with os.scandir, so the first results
+    arrive before the whole tree has been read and a caller that stops early
+    (e.g. to show the first few files) never reads the rest. Only regular
+    files count: symlinks are skipped, as in ExtractResult.xml_files, which
+    gives the same files after an extraction without touching the disk.
+    
+    Args:
+        extracted_dir (str): Path to the extracted directory
+        observer (Observer): Receives an event per XML file and the final stats
+        
+    Yields:
+        str: Path of each XML file
+    """
+    instrument = _instrument("list_xml_files", extracted_dir, observer, None)
+    folders = [extracted_dir]
+    
+    try:
+        while folders:
+            folder = folders.pop()
+            with _timed(instrument, "directory_walk"):
+                try:
+                    with os.scandir(folder) as it:
+                        entries = list(it)
+                except OSError:
+                    continue
+            
+            subfolders = []
+            for entry in entries:
+                if entry.is_dir():
+                    # Like os.walk, links to folders are not followed
+                    if not entry.is_symlink():
+                        subfolders.append(entry.path)
+                elif entry.name.endswith('.xml') and entry.is_file(follow_symlinks=False):
+                    if instrument is not None:
+                        instrument.member(entry.path, None)
+                    yield entry.path
+            
+            # Visit subfolders in the order they were listed
+            folders.extend(reversed(subfolders))
+    finally:
+        if instrument is not None:
+            instrument.finish()
 
 
-def list_xml_files(extracted_dir):
+def list_xml_files(extracted_dir, observer=None):
     """
     List all XML files in the extracted directory
     
     Args:
         extracted_dir (str): Path to the extracted directory
+        observer (Observer): Receives an event per XML file and the final stats
         
     Returns:
-        list: List of XML files
+        list: Paths of the XML files, in the order iter_xml_files() yields them
     """
-    xml_files = []
-    
-    for root, dirs, files in os.walk(extracted_dir):
-        for file in files:
-            if file.endswith('.xml'):
-                xml_files.append(os.path.join(root, file))
-                
-    return xml_files 
\ No newline at end of file
+    return list(iter_xml_files(extracted_dir, observer))
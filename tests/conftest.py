@@ -0,0 +1,33 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark
+import mbz_utils
+
+
+@pytest.fixture(autouse=True)
+def index_cache(tmp_path, monkeypatch):
+    """Keep the index cache of every test in its own folder"""
+    cache_dir = tmp_path / "index_cache"
+    monkeypatch.setattr(mbz_utils, "INDEX_CACHE_DIR", str(cache_dir))
+    return cache_dir
+
+
+@pytest.fixture(scope="session")
+def course_dir(tmp_path_factory):
+    """A small synthetic course backup folder"""
+    root = tmp_path_factory.mktemp("course") / "course"
+    benchmark.generate_course(str(root), sections=3, activities=8, xml_kb=4, blobs=6, blob_kb=8, seed=1)
+    return root
+
+
+@pytest.fixture(scope="session")
+def course_mbz(course_dir, tmp_path_factory):
+    """The synthetic course packed with create_mbz"""
+    mbz = tmp_path_factory.mktemp("mbz") / "course.mbz"
+    mbz_utils.create_mbz(str(course_dir), str(mbz))
+    return mbz
@@ -0,0 +1,13 @@
+import mbz_cli
+
+
+def test_validate_records_stats(course_mbz):
+    record = mbz_cli.run_task("validate", str(course_mbz), {"stats": True})
+    assert record["ok"], record
+    assert [stats["operation"] for stats in record["stats"]] == ["validate"]
+
+
+def test_stats_are_left_out_unless_asked(course_mbz):
+    record = mbz_cli.run_task("analyze", str(course_mbz), {})
+    assert record["ok"], record
+    assert "stats" not in record
@@ -0,0 +1,82 @@
+import os
+import pathlib
+import tarfile
+
+import pytest
+
+import mbz_utils
+
+
+def archive_files(mbz):
+    """Member names in archive order, and the contents of the files"""
+    with tarfile.open(mbz, "r:gz") as tar:
+        members = tar.getmembers()
+        return [member.name for member in members], \
+            {member.name: tar.extractfile(member).read() for member in members if member.isfile()}
+
+
+def member_name(folder, path):
+    return path.relative_to(folder).as_posix()
+
+
+def test_reference_repack_matches_full_repack(course_mbz, tmp_path, monkeypatch):
+    folder = pathlib.Path(mbz_utils.extract_mbz(str(course_mbz), str(tmp_path / "out"), False))
+    edited, same_size, touched, deleted = sorted(folder.rglob("*.xml"))[:4]
+    added = folder / "course" / "added.xml"
+    later = os.stat(edited).st_mtime + 100
+    
+    edited.write_bytes(edited.read_bytes() + b"<!-- edited -->")
+    # Same size and a new mtime: only the digest shows the change
+    data = same_size.read_bytes()
+    same_size.write_bytes(data[:-2] + (b"??" if data.endswith(b"!!") else b"!!"))
+    os.utime(same_size, (later, later))
+    # Saved without changes: hashed, then still taken from the reference
+    os.utime(touched, (later, later))
+    deleted.unlink()
+    added.write_text("<added/>")
+    
+    read_from_disk = set()
+    add = mbz_utils._SourcePacker.add
+    
+    def recording_add(self, name, data=None):
+        read_from_disk.add(name)
+        return add(self, name, data)
+    monkeypatch.setattr(mbz_utils._SourcePacker, "add", recording_add)
+    
+    referenced, full = tmp_path / "referenced.mbz", tmp_path / "full.mbz"
+    assert mbz_utils.create_mbz(str(folder), str(referenced), reference_mbz=str(course_mbz)) == (True, "Success")
+    assert read_from_disk == {member_name(folder, path) for path in (edited, same_size, added)}
+    
+    assert mbz_utils.create_mbz(str(folder), str(full)) == (True, "Success")
+    referenced_names, referenced_files = archive_files(referenced)
+    full_names, full_files = archive_files(full)
+    assert sorted(referenced_names) == sorted(full_names)
+    assert referenced_files == full_files
+    
+    prefix = folder.name + "/"
+    assert prefix + member_name(folder, deleted) not in referenced_files
+    assert referenced_files[prefix + member_name(folder, same_size)] == same_size.read_bytes()
+    assert referenced_files[prefix + member_name(folder, added)] == b"<added/>"
+
+
+@pytest.mark.parametrize("codec", mbz_utils.available_codecs())
+@pytest.mark.parametrize("workers", [1, 4])
+def test_reproducible_output_is_byte_identical(course_mbz, tmp_path, monkeypatch, codec, workers):
+    monkeypatch.setattr(mbz_utils, "CODEC", mbz_utils.CODEC)
+    monkeypatch.setattr(mbz_utils, "_codec", None)
+    mbz_utils.set_codec(codec)
+    store = str(tmp_path / "store")
+    
+    copied = mbz_utils.extract_mbz(str(course_mbz), str(tmp_path / "copied"), False, store=store, link_mode="copy")
+    # The files/ pool of this one is only in the store
+    stored = mbz_utils.extract_mbz(str(course_mbz), str(tmp_path / "stored"), False, store=store, link_mode="none")
+    assert len(list(pathlib.Path(stored).rglob("*"))) < len(list(pathlib.Path(copied).rglob("*")))
+    for path in pathlib.Path(stored).rglob("*"):
+        if path.is_file():
+            path.chmod(0o600)
+            os.utime(path, (1234567890, 1234567890))
+    
+    first, second = tmp_path / "first.mbz", tmp_path / "second.mbz"
+    assert mbz_utils.create_mbz(copied, str(first), workers=workers, reproducible=True) == (True, "Success")
+    assert mbz_utils.create_mbz(stored, str(second), workers=workers, reproducible=True) == (True, "Success")
+    assert first.read_bytes() == second.read_bytes()
@@ -0,0 +1,83 @@
+import shutil
+
+import pytest
+
+import mbz_utils
+
+
+def write_items(path, items):
+    body = "".join(f'<item id="{key}"><name>{name}</name></item>' for key, name in items)
+    path.write_text(f"<items>{body}</items>")
+
+
+@pytest.fixture
+def archives(course_dir, tmp_path):
+    """Two versions of the course: (path a, path b)"""
+    paths = []
+    for version in ("a", "b"):
+        folder = tmp_path / version / "course"
+        shutil.copytree(course_dir, folder)
+        paths.append((folder, tmp_path / f"{version}.mbz"))
+    
+    (folder_a, mbz_a), (folder_b, mbz_b) = paths
+    write_items(folder_a / "items.xml", [(1, "one"), (2, "two"), (3, "three")])
+    # Reordered: matched by id, not by position
+    write_items(folder_b / "items.xml", [(2, "TWO"), (1, "one"), (4, "four")])
+    (folder_a / "values.xml").write_text("<values>" + "".join(f"<v>{i}</v>" for i in range(150)) + "</values>")
+    (folder_b / "values.xml").write_text("<values>" + "".join(f"<v>{-i}</v>" for i in range(1, 151)) + "</values>")
+    (folder_b / "course" / "course.xml").unlink()
+    (folder_b / "added.txt").write_text("new")
+    (folder_b / "files.xml").write_bytes((folder_a / "files.xml").read_bytes() + b"garbage")
+    
+    for folder, mbz in paths:
+        mbz_utils.create_mbz(str(folder), str(mbz))
+    return str(mbz_a), str(mbz_b)
+
+
+def test_diff_reports_members(archives):
+    result = mbz_utils.diff_mbz(*archives)
+    assert "error" not in result
+    assert result["added"] == ["course/added.txt"]
+    assert result["removed"] == ["course/course/course.xml"]
+    assert [record["name"] for record in result["modified"]] == \
+        ["course/files.xml", "course/items.xml", "course/values.xml"]
+    assert not result["identical"]
+    assert result["unchanged"] > 0
+
+
+def test_diff_matches_xml_children_by_id(archives):
+    modified = {record["name"]: record for record in mbz_utils.diff_mbz(*archives)["modified"]}
+    assert modified["course/items.xml"]["xml_changes"] == [
+        {"path": '/items/item[@id="2"]/name', "change": "text", "old": "two", "new": "TWO"},
+        {"path": '/items/item[@id="3"]', "change": "removed", "old": "item", "new": None},
+        {"path": '/items/item[@id="4"]', "change": "added", "old": None, "new": "item"}
+    ]
+    assert not modified["course/items.xml"]["xml_changes_truncated"]
+    # Not well-formed any more
+    assert "xml_changes" not in modified["course/files.xml"]
+    assert modified["course/files.xml"]["xml_error"].startswith("Error:")
+
+
+def test_diff_caps_xml_changes(archives):
+    record = next(record for record in mbz_utils.diff_mbz(*archives)["modified"]
+                  if record["name"] == "course/values.xml")
+    assert len(record["xml_changes"]) == mbz_utils.XML_DIFF_MAX_CHANGES
+    assert record["xml_changes_truncated"]
+    assert record["xml_changes"][0] == {"path": "/values/v", "change": "text", "old": "0", "new": "-1"}
+
+
+def test_diff_identical(course_mbz, tmp_path):
+    copy = tmp_path / "copy.mbz"
+    shutil.copyfile(course_mbz, copy)
+    result = mbz_utils.diff_mbz(str(course_mbz), str(copy))
+    assert result["identical"]
+    assert (result["added"], result["removed"], result["modified"]) == ([], [], [])
+    assert result["unchanged"] == mbz_utils.analyze_mbz(str(course_mbz))["total_files"]
+
+
+def test_diff_invalid_archive(course_mbz, tmp_path):
+    broken = tmp_path / "broken.mbz"
+    broken.write_bytes(b"not a gzip file")
+    result = mbz_utils.diff_mbz(str(course_mbz), str(broken))
+    assert result["error"].startswith("Error:")
+    assert "identical" not in result
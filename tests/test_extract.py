@@ -0,0 +1,178 @@
+import os
+import tarfile
+
+import pytest
+
+import mbz_utils
+
+
+def pack(course_dir, path, manifest_first):
+    """Tar the course folder with moodle_backup.xml first or last, as a single gzip stream"""
+    names = []
+    for root, dirs, files in os.walk(course_dir):
+        dirs.sort()
+        for name in sorted(files):
+            names.append(os.path.relpath(os.path.join(root, name), course_dir).replace(os.sep, "/"))
+    names.sort(key=lambda name: (name != "moodle_backup.xml") == manifest_first)
+    with tarfile.open(path, "w:gz") as tar:
+        for name in names:
+            tar.add(os.path.join(course_dir, name), arcname="course/" + name)
+    return path
+
+
+def extracted(result):
+    """Paths of the files extracted from a course/ prefixed archive, relative to that prefix"""
+    folder = os.path.join(result, "course")
+    return {os.path.relpath(os.path.join(root, name), folder).replace(os.sep, "/")
+            for root, _, files in os.walk(folder) for name in files if name != mbz_utils.MANIFEST_NAME}
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    """Count the archive passes and the members each of them read"""
+    counts = []
+    iter_members = mbz_utils._iter_members
+    
+    def counting(tar, instrument=None):
+        counts.append(0)
+        for member in iter_members(tar, instrument):
+            counts[-1] += 1
+            yield member
+    monkeypatch.setattr(mbz_utils, "_iter_members", counting)
+    return counts
+
+
+@pytest.mark.parametrize("name, expected", [
+    ("moodle_backup.xml", True),
+    ("course/moodle_backup.xml", True),
+    ("course/course/course.xml", True),
+    ("course/course.xml", True),
+    ("course/activities/quiz_1/quiz.xml", False),
+    ("activities/quiz_1/quiz.xml", False),
+    ("files/ab/ab12", False),
+    ("course/sections/section_1/section.xml", False),
+])
+def test_is_metadata(name, expected):
+    assert mbz_utils._MemberSelector._is_metadata(name) is expected
+
+
+@pytest.mark.parametrize("name, pattern, expected", [
+    ("activities/quiz_1/quiz.xml", "activities/quiz_*", True),
+    ("activities/quiz_1/quiz.xml", "activities/quiz_1", True),
+    ("activities/quiz_10/quiz.xml", "activities/quiz_1", False),
+    ("activities/quiz_1", "activities/quiz_1", True),
+    ("course/files.xml", "files.xml", False),
+    ("course/files.xml", "*/files.xml", True),
+])
+def test_glob_matches(name, pattern, expected):
+    assert mbz_utils._glob_matches(name, pattern) is expected
+
+
+@pytest.mark.parametrize("name, member_type, expected", [
+    ("course/activities/quiz_1", "directory", True),
+    ("course/files", "directory", False),
+    ("course/files/ab", "directory", False),
+    ("course/files/ab/ab12", "file", False),
+    ("course/activities/quiz_1/quiz.xml", "file", True),
+    ("course/activities/quiz_1/QUIZ.XML", "file", True),
+    ("course/activities/quiz_1/readme.txt", "file", False),
+    ("course/link.xml", "symlink", False),
+])
+def test_xml_only(name, member_type, expected):
+    assert mbz_utils._MemberSelector(xml_only=True).selects(name, member_type) is expected
+
+
+def test_selector_sections_undecided_until_learned():
+    selector = mbz_utils._MemberSelector(sections=[1])
+    assert selector.needs_sections
+    assert selector.take("course/moodle_backup.xml", "file")
+    assert not selector.take("course/activities/quiz_1/quiz.xml", "file")
+    assert not selector.take("course/activities/forum_2/forum.xml", "file")
+    assert selector.take("course/sections/section_1/section.xml", "file")
+    selector.learn_sections({"quiz_1": "1", "forum_2": "2"})
+    assert selector.late() == ["course/activities/quiz_1/quiz.xml"]
+    assert selector.take("course/activities/page_4/page.xml", "file") is False
+
+
+def test_selector_literals():
+    selector = mbz_utils._MemberSelector(include=["a/moodle_backup.xml", "a/files.xml"])
+    selector.watch_literals()
+    selector.take("a/files.xml", "file")
+    assert not selector.complete
+    selector.take("a/moodle_backup.xml", "file")
+    assert selector.complete
+    
+    folder = mbz_utils._MemberSelector(include=["a/course"])
+    folder.watch_literals()
+    folder.take("a/course/course.xml", "file")
+    assert not folder.complete
+    
+    wildcard = mbz_utils._MemberSelector(include=["a/*.xml"])
+    wildcard.watch_literals()
+    assert wildcard.literals is None
+
+
+def test_extract_literal_includes_stop_without_index(course_dir, tmp_path, reads):
+    mbz = pack(course_dir, tmp_path / "course.mbz", manifest_first=True)
+    result = mbz_utils.extract_mbz(str(mbz), str(tmp_path / "out"), include=["course/moodle_backup.xml"])
+    assert extracted(result) == {"moodle_backup.xml"}
+    assert reads == [2]
+
+
+@pytest.mark.parametrize("manifest_first", [True, False])
+def test_extract_sections_cold_cache(course_dir, tmp_path, reads, manifest_first):
+    mbz = pack(course_dir, tmp_path / "course.mbz", manifest_first)
+    with open(course_dir / "moodle_backup.xml", "rb") as f:
+        activity_sections = mbz_utils._parse_activity_sections(f)
+    activities = {folder for folder, section in activity_sections.items() if section == "1"}
+    
+    result = mbz_utils.extract_mbz(str(mbz), str(tmp_path / "out"), sections=[1], xml_only=True)
+    files = extracted(result)
+    assert {name.split("/")[1] for name in files if name.startswith("activities/")} == activities
+    assert {name.split("/")[1] for name in files if name.startswith("sections/")} == {"section_1"}
+    assert {"moodle_backup.xml", "files.xml", "course/course.xml"} <= files
+    
+    if manifest_first:
+        assert len(reads) == 1
+    else:
+        # The activities came before moodle_backup.xml: a second pass, stopping after the last of them
+        assert len(reads) == 2 and reads[1] < reads[0]
+    
+    mbz_utils.get_index(str(mbz))
+    warm = mbz_utils.extract_mbz(str(mbz), str(tmp_path / "warm"), sections=[1], xml_only=True)
+    assert extracted(warm) == files
+
+
+def test_extract_modules_with_index_stops_early(course_mbz, tmp_path, reads):
+    mbz_utils.get_index(str(course_mbz))
+    total = reads[0]
+    result = mbz_utils.extract_mbz(str(course_mbz), str(tmp_path / "out"), include=["course/moodle_backup.xml"])
+    assert extracted(result) == {"moodle_backup.xml"}
+    assert reads[1] < total
+
+
+def test_xml_files_agree_with_folder_scan(tmp_path):
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "a.xml").write_text("<a/>")
+    (source / "notes.txt").write_text("text")
+    mbz = tmp_path / "links.mbz"
+    with tarfile.open(mbz, "w:gz") as tar:
+        tar.add(source / "a.xml", arcname="course/a.xml")
+        tar.add(source / "notes.txt", arcname="course/notes.txt")
+        hardlink = tarfile.TarInfo("course/sub/b.xml")
+        hardlink.type, hardlink.linkname = tarfile.LNKTYPE, "course/a.xml"
+        tar.addfile(hardlink)
+        symlink = tarfile.TarInfo("course/c.xml")
+        symlink.type, symlink.linkname = tarfile.SYMTYPE, "a.xml"
+        tar.addfile(symlink)
+    
+    result = mbz_utils.extract_mbz(str(mbz), str(tmp_path / "out"), False)
+    listed = mbz_utils.list_xml_files(result)
+    assert isinstance(listed, list)
+    assert sorted(listed) == sorted(result.xml_files) == \
+        sorted(os.path.join(result, "course", *name.split("/")) for name in ("a.xml", "sub/b.xml"))
+    
+    lazy = mbz_utils.iter_xml_files(result)
+    first = next(lazy)
+    assert sorted([first, *lazy]) == sorted(listed)
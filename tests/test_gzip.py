@@ -0,0 +1,129 @@
+import gzip
+import io
+import random
+import tarfile
+import zlib
+
+import pytest
+
+import mbz_utils
+
+BLOCK = 16 * 1024
+MTIME = 1700000000
+
+
+def sample_files(count=12, size=10000):
+    """Files mixing text and random bytes, so every block compresses differently"""
+    rng = random.Random(1)
+    files = {}
+    for i in range(count):
+        text = f"<file id=\"{i}\">{'moodle ' * rng.randrange(50, 500)}</file>".encode()
+        files[f"course/files/{i:02d}.bin"] = text + rng.getrandbits(8 * size).to_bytes(size, "little")
+    return files
+
+
+def write_archive(fileobj, files, workers=4):
+    """Tar the files through a ParallelGzipWriter with small blocks, returning the tar stream"""
+    plain = io.BytesIO()
+    with tarfile.open(fileobj=plain, mode="w") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    
+    tar_bytes = plain.getvalue()
+    with mbz_utils.ParallelGzipWriter(fileobj, workers=workers, block_size=BLOCK, mtime=MTIME,
+                                      codec=mbz_utils._STDLIB_CODEC) as gz:
+        # Odd write sizes, so blocks are cut across writes
+        for start in range(0, len(tar_bytes), 7000):
+            gz.write(tar_bytes[start:start + 7000])
+        assert gz.tell() == len(tar_bytes)
+    return tar_bytes
+
+
+def read_tar(fileobj, mode):
+    with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+        return {member.name: tar.extractfile(member).read() for member in tar if member.isfile()}
+
+
+@pytest.fixture(scope="module")
+def archive(tmp_path_factory):
+    files = sample_files()
+    path = tmp_path_factory.mktemp("gzip") / "archive.tar.gz"
+    with open(path, "wb") as f:
+        tar_bytes = write_archive(f, files)
+    return path, files, tar_bytes
+
+
+def test_multi_block_archive_reads_back(archive):
+    path, files, tar_bytes = archive
+    assert len(tar_bytes) > 8 * BLOCK
+    
+    with tarfile.open(path, "r:gz") as tar:
+        assert {member.name: tar.extractfile(member).read() for member in tar} == files
+    with gzip.open(path, "rb") as gz:
+        assert gz.read() == tar_bytes
+    with open(path, "rb") as raw:
+        assert read_tar(mbz_utils._GzipReader(raw), "r|") == files
+
+
+def test_multi_block_archive_matches_single_worker(archive):
+    path, files, _ = archive
+    single = io.BytesIO()
+    write_archive(single, files, workers=1)
+    assert single.getvalue() == path.read_bytes()
+
+
+def test_checkpoints_at_member_boundaries(archive):
+    path, _, tar_bytes = archive
+    compressed = path.read_bytes()
+    
+    # Every block is a standalone gzip member, so the boundaries follow from their lengths
+    boundaries = [(0, 0)]
+    for start in range(0, len(tar_bytes), BLOCK):
+        member = mbz_utils._gzip_member(tar_bytes[start:start + BLOCK], 9, MTIME)
+        boundaries.append((boundaries[-1][0] + len(member), start + BLOCK))
+    end = boundaries.pop()
+    assert end[0] == len(compressed)
+    
+    with open(path, "rb") as raw:
+        reader = mbz_utils._GzipReader(raw, span=BLOCK, chunk_size=4096)
+        assert reader.read() == tar_bytes
+    assert reader.checkpoints == boundaries
+    
+    # Decompression restarts at any checkpoint without what comes before it
+    for compressed_offset, uncompressed_offset in boundaries:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        data = decompressor.decompress(compressed[compressed_offset:])
+        expected = tar_bytes[uncompressed_offset:uncompressed_offset + BLOCK]
+        assert data == expected
+
+
+def test_checkpoint_span_skips_boundaries(archive):
+    path, _, _ = archive
+    with open(path, "rb") as raw:
+        reader = mbz_utils._GzipReader(raw, span=3 * BLOCK)
+        reader.read()
+    offsets = [uncompressed for _, uncompressed in reader.checkpoints]
+    assert offsets == list(range(0, offsets[-1] + 1, 3 * BLOCK))
+
+
+def test_close_without_write_is_valid_gzip():
+    out = io.BytesIO()
+    writer = mbz_utils.ParallelGzipWriter(out, workers=2, mtime=MTIME)
+    writer.close()
+    writer.close()
+    
+    assert out.getvalue()
+    assert gzip.decompress(out.getvalue()) == b""
+    assert mbz_utils._GzipReader(io.BytesIO(out.getvalue())).read() == b""
+    with pytest.raises(ValueError):
+        writer.write(b"late")
+
+
+def test_empty_tar_reads_back(tmp_path):
+    path = tmp_path / "empty.tar.gz"
+    with open(path, "wb") as f:
+        write_archive(f, {})
+    with tarfile.open(path, "r:gz") as tar:
+        assert tar.getmembers() == []
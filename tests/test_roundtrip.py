@@ -0,0 +1,78 @@
+import tarfile
+
+import pytest
+
+import mbz_utils
+
+
+def test_create_error_cancels_reads_ahead(course_dir, tmp_path, monkeypatch):
+    def fail(self, name, data=None):
+        raise OSError("disk full")
+    monkeypatch.setattr(mbz_utils._SourcePacker, "add", fail)
+    success, message = mbz_utils.create_mbz(str(course_dir), str(tmp_path / "out.mbz"))
+    assert not success
+    assert "disk full" in message
+
+
+def test_analyze_streams_index_to_cache(course_mbz, monkeypatch):
+    scan = mbz_utils._scan_archive
+    kept = []
+    
+    def recording_scan(*args, **kwargs):
+        summary, index = scan(*args, **kwargs)
+        kept.append(index and index["members"])
+        return summary, index
+    monkeypatch.setattr(mbz_utils, "_scan_archive", recording_scan)
+    
+    info = mbz_utils.analyze_mbz(str(course_mbz))
+    assert not info["cached"] and "error" not in info
+    assert kept == [None]
+    
+    assert mbz_utils.analyze_mbz(str(course_mbz))["cached"]
+    cached = mbz_utils.get_index(str(course_mbz))
+    fresh = mbz_utils.get_index(str(course_mbz), use_cache=False)
+    assert cached["members"] == fresh["members"]
+    assert cached["checkpoints"] == fresh["checkpoints"]
+
+
+def test_validate(course_mbz):
+    info = mbz_utils.validate_mbz(str(course_mbz))
+    assert info["valid"], info["problems"]
+    assert info["checked"]["activities"] == 8
+    assert mbz_utils.validate_mbz(str(course_mbz))["valid"]
+
+
+def test_validate_single_stream_streams_even_when_cached(course_dir, tmp_path, monkeypatch):
+    mbz = tmp_path / "moodle.mbz"
+    with tarfile.open(mbz, "w:gz") as tar:
+        tar.add(str(course_dir), arcname=".")
+    mbz_utils.analyze_mbz(str(mbz))
+    # As in a new process, which only has the cached index
+    monkeypatch.setattr(mbz_utils, "_window_snapshots", mbz_utils.OrderedDict())
+    
+    def no_random_access(*args, **kwargs):
+        raise AssertionError("read_member used on a single gzip stream")
+    monkeypatch.setattr(mbz_utils, "read_member", no_random_access)
+    
+    info = mbz_utils.validate_mbz(str(mbz))
+    assert info["valid"], info["problems"]
+    assert not info["cached"]
+
+
+def test_read_member_progress_and_cancel(course_mbz):
+    index = mbz_utils.get_index(str(course_mbz))
+    # The last member, the furthest from the start of the stream
+    last = max(range(len(index["members"]["name"])), key=lambda row: index["members"]["offset_data"][row])
+    name = index["members"]["name"][last]
+    calls = []
+    
+    def progress(done, total, files):
+        calls.append((done, total))
+    data = mbz_utils.read_member(str(course_mbz), name, index=index, progress=progress)
+    assert data == mbz_utils.read_member(str(course_mbz), name, index=index)
+    assert calls and calls[-1][0] == calls[-1][1]
+    
+    def cancel(done, total, files):
+        raise mbz_utils.OperationCancelled()
+    with pytest.raises(mbz_utils.OperationCancelled):
+        mbz_utils.read_member(str(course_mbz), name, index=index, progress=cancel)
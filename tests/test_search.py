@@ -0,0 +1,74 @@
+from xml.etree import ElementTree
+
+import pytest
+
+import mbz_utils
+
+
+def findall(mbz, member, query):
+    """Serialized results of query on the whole member, parsed at once"""
+    root = ElementTree.fromstring(mbz_utils.read_member(str(mbz), member))
+    results = []
+    for element in root.findall(query):
+        element.tail = None
+        results.append(ElementTree.tostring(element, encoding="unicode")[:mbz_utils.SEARCH_TEXT_CHARS])
+    return results
+
+
+@pytest.mark.parametrize("member, query", [
+    ("course/files.xml", "file"),
+    ("course/files.xml", ".//filename"),
+    ("course/files.xml", "file[component='mod_resource']"),
+    ("course/files.xml", "*"),
+    ("course/moodle_backup.xml", ".//activity[modulename='quiz']"),
+    ("course/moodle_backup.xml", ".//section/title"),
+])
+def test_xpath_matches_whole_document(course_mbz, member, query):
+    matches = [match["match"] for match in mbz_utils.search_mbz(str(course_mbz), query, "xpath", path_filter=member)]
+    assert matches
+    assert matches == findall(course_mbz, member, query)
+
+
+@pytest.mark.parametrize("query", ["file[1]", ".//file[last()]", ".", ".[file]", ".//filename/..", "..", "file["])
+def test_xpath_rejects_unsupported_queries(course_mbz, query):
+    with pytest.raises(ValueError):
+        list(mbz_utils.search_mbz(str(course_mbz), query, "xpath"))
+
+
+def test_xpath_quoted_text_is_not_a_predicate(course_mbz):
+    assert list(mbz_utils.search_mbz(str(course_mbz), "file[filename='[1]..']", "xpath")) == []
+
+
+def test_substring_and_regex(course_mbz):
+    substring = list(mbz_utils.search_mbz(str(course_mbz), "QUIZ", ignore_case=True))
+    regex = list(mbz_utils.search_mbz(str(course_mbz), r"<modulename>qu\w+</modulename>", "regex"))
+    assert substring and regex
+    assert all(match["match"].lower() == "quiz" for match in substring)
+    assert {match["member"] for match in regex} <= {match["member"] for match in substring}
+    assert len(list(mbz_utils.search_mbz(str(course_mbz), "quiz", max_matches=2))) == 2
+
+
+def test_search_archives(course_mbz, tmp_path):
+    missing = tmp_path / "missing.mbz"
+    records = list(mbz_utils.search_archives([str(course_mbz), str(missing)], "modulename", workers=2))
+    done = {record["archive"]: record for record in records if record.get("done")}
+    matches = [record for record in records if not record.get("done")]
+    assert done[str(course_mbz)]["matches"] == len(matches) > 0
+    assert done[str(course_mbz)]["error"] is None
+    assert done[str(missing)]["error"]
+
+
+@pytest.mark.parametrize("query, mode", [("(", "regex"), ("file[1]", "xpath"), ("x", "fuzzy")])
+def test_search_archives_validates_before_starting(course_mbz, query, mode, monkeypatch):
+    def no_pool(*args, **kwargs):
+        raise AssertionError("the pool was started")
+    monkeypatch.setattr(mbz_utils, "ProcessPoolExecutor", no_pool)
+    with pytest.raises(ValueError):
+        next(mbz_utils.search_archives([str(course_mbz)] * 3, query, mode))
+
+
+def test_waiting_search_can_be_cancelled():
+    def waiting():
+        raise mbz_utils.OperationCancelled()
+    with pytest.raises(mbz_utils.OperationCancelled):
+        mbz_utils._next_search_result(mbz_utils.queue.Queue(), [], waiting)
@@ -0,0 +1,172 @@
+import hashlib
+import io
+import os
+import shutil
+import tarfile
+
+import pytest
+
+import mbz_utils
+
+
+def stored_blob(folder):
+    """Path of an extracted files/ pool member"""
+    for root, _, files in os.walk(folder):
+        if os.path.basename(os.path.dirname(root)) == "files" and files:
+            return os.path.join(root, files[0])
+    raise AssertionError("no files/ pool member")
+
+
+def test_editing_default_extraction_keeps_store(course_mbz, tmp_path):
+    store = tmp_path / "store"
+    first, second = tmp_path / "first", tmp_path / "second"
+    mbz_utils.extract_mbz(str(course_mbz), str(first), False, store=str(store))
+    mbz_utils.extract_mbz(str(course_mbz), str(second), False, store=str(store))
+    
+    blob = stored_blob(first)
+    original = open(blob, "rb").read()
+    with open(blob, "r+b") as f:
+        f.write(b"edited")
+    
+    digest = os.path.basename(blob)
+    object_path = store / "objects" / digest[:2] / digest
+    assert object_path.read_bytes() == original
+    assert open(os.path.join(second, os.path.relpath(blob, first)), "rb").read() == original
+
+
+def test_unknown_link_mode(tmp_path):
+    with pytest.raises(ValueError):
+        mbz_utils._BlobStore(str(tmp_path), "symlink")
+
+
+def course_blobs(course_dir):
+    """Size of every files/ pool member of the course, keyed by SHA-1"""
+    return {path.name: path.stat().st_size for path in (course_dir / "files").glob("*/*")}
+
+
+def store_objects(store):
+    return {path.name: path.stat().st_size for path in (store / "objects").glob("*/*")}
+
+
+def with_extra_blob(course_dir, folder, data):
+    """A copy of the course with one more files/ pool member, and its SHA-1"""
+    shutil.copytree(course_dir, folder)
+    digest = hashlib.sha1(data).hexdigest()
+    (folder / "files" / digest[:2]).mkdir(exist_ok=True)
+    (folder / "files" / digest[:2] / digest).write_bytes(data)
+    return digest
+
+
+def test_extractions_share_objects(course_mbz, course_dir, tmp_path):
+    store = tmp_path / "store"
+    folders = [mbz_utils.extract_mbz(str(course_mbz), str(tmp_path / name), False, store=str(store),
+                                     link_mode="hardlink")
+               for name in ("first", "second")]
+    
+    assert store_objects(store) == course_blobs(course_dir)
+    for digest in course_blobs(course_dir):
+        object_stat = os.stat(store / "objects" / digest[:2] / digest)
+        assert object_stat.st_nlink == 3
+        for folder in folders:
+            assert os.path.samestat(os.stat(os.path.join(folder, "course", "files", digest[:2], digest)),
+                                    object_stat)
+    for folder in folders:
+        assert all(bool(entry.get("stored")) == ("/files/" in name) for name, entry in folder.manifest.items())
+
+
+def test_misnamed_blob_stays_a_plain_file(tmp_path):
+    good = b"named after its digest"
+    good_name = hashlib.sha1(good).hexdigest()
+    bad_name = hashlib.sha1(b"something else").hexdigest()
+    mbz = tmp_path / "misnamed.mbz"
+    with tarfile.open(mbz, "w:gz") as tar:
+        for name, data in ((good_name, good), (bad_name, b"not what the name says")):
+            info = tarfile.TarInfo(f"course/files/{name[:2]}/{name}")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    
+    store = tmp_path / "store"
+    result = mbz_utils.extract_mbz(str(mbz), str(tmp_path / "out"), False, store=str(store), link_mode="none")
+    assert store_objects(store) == {good_name: len(good)}
+    
+    bad_path = os.path.join(result, "course", "files", bad_name[:2], bad_name)
+    assert open(bad_path, "rb").read() == b"not what the name says"
+    assert not os.path.exists(os.path.join(result, "course", "files", good_name[:2], good_name))
+    
+    bad_entry = result.manifest[f"course/files/{bad_name[:2]}/{bad_name}"]
+    assert not bad_entry.get("stored")
+    assert bad_entry["sha1"] == hashlib.sha1(b"not what the name says").hexdigest()
+    assert result.manifest[f"course/files/{good_name[:2]}/{good_name}"]["stored"]
+
+
+def test_repack_reads_blobs_from_store(course_mbz, course_dir, tmp_path):
+    store = tmp_path / "store"
+    folder = mbz_utils.extract_mbz(str(course_mbz), str(tmp_path / "out"), False, store=str(store), link_mode="none")
+    for digest in course_blobs(course_dir):
+        assert not os.path.exists(os.path.join(folder, "course", "files", digest[:2], digest))
+    
+    repacked = tmp_path / "repacked.mbz"
+    assert mbz_utils.create_mbz(folder, str(repacked)) == (True, "Success")
+    with tarfile.open(course_mbz, "r:gz") as original, tarfile.open(repacked, "r:gz") as copy:
+        expected = {"course/" + member.name: original.extractfile(member).read() for member in original}
+        assert {member.name: copy.extractfile(member).read() for member in copy} == expected
+    
+    # The store folder is only known from the manifest
+    shutil.move(str(store), str(tmp_path / "moved"))
+    assert not mbz_utils.create_mbz(folder, str(tmp_path / "missing.mbz"))[0]
+    assert mbz_utils.create_mbz(folder, str(tmp_path / "moved.mbz"), store=str(tmp_path / "moved"))[0]
+
+
+def test_gc_removes_objects_once_unreferenced(course_mbz, course_dir, tmp_path):
+    extra = with_extra_blob(course_dir, tmp_path / "extra" / "course", b"only in the second backup")
+    extra_mbz = tmp_path / "extra.mbz"
+    mbz_utils.create_mbz(str(tmp_path / "extra" / "course"), str(extra_mbz))
+    
+    store = tmp_path / "store"
+    first = mbz_utils.extract_mbz(str(course_mbz), str(tmp_path / "first"), False, store=str(store))
+    second = mbz_utils.extract_mbz(str(extra_mbz), str(tmp_path / "second"), False, store=str(store))
+    shared = course_blobs(course_dir)
+    assert set(store_objects(store)) == set(shared) | {extra}
+    
+    assert mbz_utils.gc_store(str(store)) == {"refs": 2, "removed_refs": 0, "objects": len(shared) + 1,
+                                              "removed_objects": 0, "freed_bytes": 0}
+    
+    shutil.rmtree(second)
+    dry_run = mbz_utils.gc_store(str(store), dry_run=True)
+    assert (dry_run["removed_refs"], dry_run["removed_objects"]) == (1, 1)
+    assert extra in store_objects(store)
+    
+    result = mbz_utils.gc_store(str(store))
+    assert result == {"refs": 1, "removed_refs": 1, "objects": len(shared), "removed_objects": 1,
+                      "freed_bytes": len(b"only in the second backup")}
+    assert set(store_objects(store)) == set(shared)
+    
+    shutil.rmtree(first)
+    assert mbz_utils.gc_store(str(store))["removed_objects"] == len(shared)
+    assert store_objects(store) == {}
+
+
+def test_store_stats(course_mbz, course_dir, tmp_path):
+    store = tmp_path / "store"
+    blobs = course_blobs(course_dir)
+    stored_bytes = sum(blobs.values())
+    for name, link_mode in (("first", "hardlink"), ("second", "none"), ("third", "copy")):
+        mbz_utils.extract_mbz(str(course_mbz), str(tmp_path / name), False, store=str(store), link_mode=link_mode)
+    
+    assert mbz_utils.store_stats(str(store)) == {
+        "objects": len(blobs),
+        "stored_bytes": stored_bytes,
+        "refs": 3,
+        "referenced_bytes": 3 * stored_bytes,
+        # Copies do not share their data with the store
+        "saved_bytes": stored_bytes,
+        "dedup_ratio": 2.0,
+        "unreferenced_objects": 0,
+        "unreferenced_bytes": 0
+    }
+    
+    for name in ("first", "second", "third"):
+        shutil.rmtree(tmp_path / name)
+    stats = mbz_utils.store_stats(str(store))
+    assert (stats["refs"], stats["referenced_bytes"], stats["dedup_ratio"]) == (0, 0, 0.0)
+    assert (stats["unreferenced_objects"], stats["unreferenced_bytes"]) == (len(blobs), stored_bytes)
@@ -0,0 +1,59 @@
+import pathlib
+import tarfile
+from xml.etree import ElementTree
+
+import mbz_utils
+
+
+def read_archive(mbz):
+    """Tar headers and file contents, keyed by member name"""
+    with tarfile.open(mbz, "r:gz") as tar:
+        return {member.name: (member.get_info(), tar.extractfile(member).read() if member.isfile() else None)
+                for member in tar}
+
+
+def test_transform_edits_drops_and_copies(course_mbz, tmp_path):
+    def edit_root(root):
+        root.set("edited", "yes")
+    
+    def replace_root(root):
+        replacement = ElementTree.Element("course_replaced")
+        replacement.text = root.tag
+        return replacement
+    
+    output = tmp_path / "transformed.mbz"
+    success, message = mbz_utils.transform_mbz(
+        str(course_mbz), str(output),
+        transforms={"course/activities/url_6/url.xml": lambda data: None,
+                    "course/activities/label_7/label.xml": lambda data: data.replace(b"<", b"\n<")},
+        xml_transforms={"course/moodle_backup.xml": edit_root, "course/course/course.xml": replace_root},
+        workers=2)
+    assert (success, message) == (True, "Success")
+    
+    source, transformed = read_archive(course_mbz), read_archive(output)
+    assert set(transformed) == set(source) - {"course/activities/url_6/url.xml"}
+    
+    edited = {"course/activities/label_7/label.xml", "course/moodle_backup.xml", "course/course/course.xml"}
+    for name in set(transformed) - edited:
+        assert transformed[name] == source[name], name
+    
+    label = transformed["course/activities/label_7/label.xml"]
+    assert label[1] == source["course/activities/label_7/label.xml"][1].replace(b"<", b"\n<")
+    assert label[0]["size"] == len(label[1])
+    assert label[0]["mtime"] == source["course/activities/label_7/label.xml"][0]["mtime"]
+    
+    folder = pathlib.Path(mbz_utils.extract_mbz(str(output), str(tmp_path / "out"), False))
+    assert not (folder / "course" / "activities" / "url_6" / "url.xml").exists()
+    assert (folder / "course" / "activities" / "label_7" / "label.xml").read_bytes() == label[1]
+    backup = ElementTree.parse(folder / "course" / "moodle_backup.xml").getroot()
+    assert backup.get("edited") == "yes"
+    assert backup.tag == ElementTree.fromstring(source["course/moodle_backup.xml"][1]).tag
+    course = ElementTree.parse(folder / "course" / "course" / "course.xml").getroot()
+    assert (course.tag, course.text) == ("course_replaced", "course")
+    assert (folder / "course" / "files.xml").read_bytes() == source["course/files.xml"][1]
+
+
+def test_transform_refuses_to_overwrite_source(course_mbz):
+    success, message = mbz_utils.transform_mbz(str(course_mbz), str(course_mbz))
+    assert not success
+    assert message.startswith("Error:")